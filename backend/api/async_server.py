@@ -0,0 +1,106 @@
+import asyncio
+import socketio
+from flask import Flask
+from flask_pymongo import PyMongo
+from loguru import logger
+from api.buckets import MAX_BUCKETS
+from api.instrumentation import register_connections_gauge, timed_event
+from api.metrics import (CACHE_REFRESH_INTERVAL, MAX_SERIES, answer_metrics_request, build_metric_deltas,
+                         maintain_metrics_cache, metrics_snapshot, subscriptions)
+from api.schemas import MetricsRequestSchema
+from api.subscriptions import subscription_key
+
+
+class AsyncMetricsServer:
+    """Serve the metrics socket events from a python-socketio AsyncServer.
+
+    Event names and payloads match the Flask-SocketIO handlers of init_metrics_module.
+    Connections, rooms and timers live on the event loop, so idle sockets cost no thread.
+    The shared query and cache code is synchronous PyMongo and runs in worker threads via
+    asyncio.to_thread. The delta pusher and the cache refresher start with the ASGI app.
+    """
+
+    def __init__(self, app: Flask, mongo: PyMongo, cors_allowed_origins='*'):
+        self.app = app
+        self.mongo = mongo
+        message_queue = app.config.get('SOCKETIO_MESSAGE_QUEUE')
+        client_manager = socketio.AsyncRedisManager(message_queue) if message_queue else None
+        self.sio = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins=cors_allowed_origins,
+                                        client_manager=client_manager)
+        self.max_buckets = app.config.get('METRICS_MAX_BUCKETS', MAX_BUCKETS)
+        self.max_series = app.config.get('METRICS_MAX_SERIES', MAX_SERIES)
+        self.push_interval = app.config.get('METRICS_PUSH_INTERVAL', 0.5)
+        self.refresh_interval = app.config.get('METRICS_CACHE_REFRESH_INTERVAL', CACHE_REFRESH_INTERVAL)
+        # Timed like the Flask-SocketIO handlers, under the same event labels
+        self.sio.on('request_metrics', timed_event('request_metrics')(self.handle_request_metrics))
+        self.sio.on('subscribe_metrics', timed_event('subscribe_metrics')(self.handle_subscribe_metrics))
+        # Sent by clients that missed a delta sequence number; also (re)subscribes them
+        self.sio.on('resync_metrics', timed_event('resync_metrics')(self.handle_subscribe_metrics))
+        self.sio.on('unsubscribe_metrics', timed_event('unsubscribe_metrics')(self.handle_unsubscribe_metrics))
+        self.sio.on('disconnect', timed_event('disconnect')(self.handle_disconnect))
+        # Sockets are served here, not by the Flask-SocketIO server app.py registered
+        register_connections_gauge(self.sio)
+
+    def asgi_app(self) -> socketio.ASGIApp:
+        """ASGI application serving Socket.IO on asyncio and every other route through the Flask app."""
+        from asgiref.wsgi import WsgiToAsgi
+
+        return socketio.ASGIApp(self.sio, other_asgi_app=WsgiToAsgi(self.app), on_startup=self.start_background_tasks)
+
+    def start_background_tasks(self) -> None:
+        self.sio.start_background_task(self._push_updates_forever)
+        if self.refresh_interval:
+            self.sio.start_background_task(self._maintain_cache_forever)
+
+    async def handle_request_metrics(self, sid, data):
+        try:
+            event, payload = await asyncio.to_thread(answer_metrics_request, data, self.mongo, self.max_buckets, self.max_series)
+            await self.sio.emit(event, payload, to=sid)
+        except Exception as e:
+            logger.error(f"Error handling request_metrics event: {e}")
+            await self.sio.emit('error', {'message': str(e)}, to=sid)
+
+    async def handle_subscribe_metrics(self, sid, data):
+        try:
+            validated_data = MetricsRequestSchema().load(data)
+            key = subscription_key(validated_data)
+            await self.sio.enter_room(sid, subscriptions.subscribe(sid, key))
+            snapshot = await asyncio.to_thread(metrics_snapshot, key, validated_data, self.mongo, self.max_buckets)
+            await self.sio.emit('metrics_snapshot', snapshot, to=sid)
+        except Exception as e:
+            logger.error(f"Error handling subscribe_metrics event: {e}")
+            await self.sio.emit('error', {'message': str(e)}, to=sid)
+
+    async def handle_unsubscribe_metrics(self, sid, data):
+        try:
+            room = subscriptions.unsubscribe(sid, subscription_key(MetricsRequestSchema().load(data)))
+        except Exception as e:
+            await self.sio.emit('error', {'message': f'Invalid subscription: {e}'}, to=sid)
+            return
+        if room is not None:
+            await self.sio.leave_room(sid, room)
+            await self.sio.emit('unsubscribed', {'room': room}, to=sid)
+
+    async def handle_disconnect(self, sid, *args):
+        subscriptions.drop(sid)
+
+    async def push_updates(self) -> int:
+        """Emit the coalesced ``metrics_delta`` of every subscription that changed since the last tick."""
+        try:
+            deltas = await asyncio.to_thread(build_metric_deltas, self.mongo, self.max_buckets)
+        except Exception as e:
+            logger.error(f'Error pushing metric updates: {e}')
+            return 0
+        for room, delta in deltas:
+            await self.sio.emit('metrics_delta', delta, to=room)
+        return len(deltas)
+
+    async def _push_updates_forever(self):
+        while True:
+            await self.sio.sleep(self.push_interval)
+            await self.push_updates()
+
+    async def _maintain_cache_forever(self):
+        while True:
+            await self.sio.sleep(self.refresh_interval)
+            await asyncio.to_thread(maintain_metrics_cache, self.mongo)
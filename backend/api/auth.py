@@ -1,23 +1,61 @@
 from flask import Blueprint, request, jsonify, abort
-from flask_login import login_user, logout_user, login_required
-from flask_jwt_extended import create_access_token, get_jwt_identity, jwt_required
+from flask_login import current_user, login_user, logout_user, login_required
+from flask_jwt_extended import create_access_token, get_jwt, get_jwt_identity, jwt_required
 from flask_limiter import Limiter
 from loguru import logger
 from typing import Tuple, Dict, Optional
 from http import HTTPStatus
 from datetime import timedelta
+import hashlib
+from api.cache import LRUCache
 from models import User, LoginRequest
 
+USER_CACHE_TTL = 60  # seconds a cached user is trusted before it is read again
+USER_CACHE_MAX_ENTRIES = 10000
+USER_CACHE_MISS_TTL = 5  # seconds an unknown id is remembered, so a user created meanwhile is soon found
+# Users by _id (None for unknown ids), so session and token checks skip MongoDB on a hit
+user_cache = LRUCache(max_entries=USER_CACHE_MAX_ENTRIES, ttl=USER_CACHE_TTL)
+user_cache_miss_ttl = USER_CACHE_MISS_TTL
+_MISSING = object()
 
 
+def credentials_version(user_data: Dict) -> str:
+    """Fingerprint of the stored password hash. Tokens carry it, so changing the password revokes them."""
+    return hashlib.sha256(user_data['password'].encode('utf-8')).hexdigest()[:16]
+
+def cache_user(user_data: Dict) -> User:
+    """Cache the user of a users document, keeping its credentials version instead of the password hash."""
+    user = User({**{key: value for key, value in user_data.items() if key != 'password'},
+                 'credentials_version': credentials_version(user_data)})
+    user_cache.set(user_data['_id'], user)
+    return user
+
+def cached_user(mongo, user_id: int) -> Optional[User]:
+    """The user with ``user_id``, read from MongoDB only on a cache miss."""
+    user = user_cache.get(user_id, _MISSING)
+    if user is _MISSING:
+        user_data = mongo.db.users.find_one({'_id': user_id})
+        if user_data is None:
+            if user_cache_miss_ttl:
+                user_cache.set(user_id, None, ttl=user_cache_miss_ttl)
+            return None
+        user = cache_user(user_data)
+    return user
+
+def invalidate_user(user_id) -> None:
+    """Drop a cached user. Call it after changing a user's password or any other stored field."""
+    user_cache.pop(int(user_id))
+
 def init_auth_module(app, mongo, login_manager, _bcrypt, limiter: Limiter):
+    global user_cache, user_cache_miss_ttl
     auth_bp = Blueprint('auth', __name__)
+    user_cache = LRUCache(max_entries=app.config.get('USER_CACHE_MAX_ENTRIES', USER_CACHE_MAX_ENTRIES),
+                          ttl=app.config.get('USER_CACHE_TTL', USER_CACHE_TTL))
+    user_cache_miss_ttl = min(app.config.get('USER_CACHE_MISS_TTL', USER_CACHE_MISS_TTL), user_cache.ttl or float('inf'))
 
-    
     @login_manager.user_loader
     def load_user(user_id: str) -> Optional[User]:
-        user_data = mongo.db.users.find_one({'_id': int(user_id)})
-        return User(user_data) if user_data else None
+        return cached_user(mongo, int(user_id))
 
     @login_manager.unauthorized_handler
     def unauthorized():
@@ -34,9 +72,10 @@ def init_auth_module(app, mongo, login_manager, _bcrypt, limiter: Limiter):
 
         user_data = mongo.db.users.find_one({'username': req.username})
         if user_data and _bcrypt.check_password_hash(user_data['password'], req.password.encode('utf-8')):
-            user = User(user_data)
+            user = cache_user(user_data)
             login_user(user, remember=True)
-            access_token = create_access_token(identity=str(user_data['_id']), expires_delta=timedelta(hours=1))
+            access_token = create_access_token(identity=str(user_data['_id']), expires_delta=timedelta(hours=1),
+                                               additional_claims={'cred': user.user_data['credentials_version']})
             logger.info(f"User {req.username} logged in")
             return jsonify({'message': 'Login successful', 'token': access_token}), HTTPStatus.OK
         else:
@@ -46,6 +85,7 @@ def init_auth_module(app, mongo, login_manager, _bcrypt, limiter: Limiter):
     @login_required
     @limiter.limit("10 per minute")
     def logout() -> Tuple[Dict, int]:
+        invalidate_user(current_user.get_id())
         logout_user()
         return jsonify({'message': 'Logout successful'}), HTTPStatus.OK
 
@@ -53,16 +93,30 @@ def init_auth_module(app, mongo, login_manager, _bcrypt, limiter: Limiter):
     @jwt_required()
     @limiter.limit("5 per minute")
     def validate_token() -> Tuple[Dict, int]:
-        try:
-            current_user_id = get_jwt_identity()
-            user_data = mongo.db.users.find_one({'_id': int(current_user_id)})
+        """Check that the token's user exists and that its password is unchanged since the token
+        was issued. The user comes from the cache, so MongoDB is read only on a cache miss.
 
-            if user_data:
+        The signed ``sub`` and ``cred`` claims alone are deliberately not trusted: a worker
+        that has not cached the user could not see a password change or a deleted user made
+        through another worker until the token expires (an hour). The cache bounds that to
+        USER_CACHE_TTL instead, at one MongoDB read per user and TTL.
+        """
+        try:
+            user = cached_user(mongo, int(get_jwt_identity()))
+            # Tokens issued before a password change carry an outdated credentials version,
+            # and tokens without one predate the check
+            cred = get_jwt().get('cred')
+            if user and cred is not None and cred == user.user_data['credentials_version']:
                 return jsonify({'valid': True}), HTTPStatus.OK
             else:
                 return jsonify({'valid': False, 'message': 'User not found'}), HTTPStatus.UNAUTHORIZED
         except Exception as e:
             logger.error(f'Token validation error: {str(e)}')
             abort(HTTPStatus.INTERNAL_SERVER_ERROR)
-            
+
+    @auth_bp.route('/user_cache_stats', methods=['GET'])
+    @login_required
+    def user_cache_stats() -> Tuple[Dict, int]:
+        return jsonify(user_cache.stats()), HTTPStatus.OK
+
     app.register_blueprint(auth_bp)
@@ -1,7 +1,18 @@
-from flask import Blueprint, jsonify, request
+import itertools
+import json
+import threading
+import time
+from typing import Dict, Iterator, Optional
+from bson import ObjectId
+from pymongo import ReturnDocument
+from flask import Blueprint, Response, jsonify, request, stream_with_context
 from flask_login import login_required
 from loguru import logger
-from marshmallow import Schema, fields, ValidationError
+from marshmallow import Schema, fields, validate, validates, ValidationError
+
+BOOK_FIELDS = ('title', 'author', 'isbn')
+BOOKS_PAGE_SIZE = 100
+VERSIONS_COLLECTION = 'collection_versions'
 
 # Create a schema to validate book data
 class BookSchema(Schema):
@@ -9,22 +20,111 @@ class BookSchema(Schema):
     author = fields.Str(required=True)
     isbn = fields.Str(required=True)
 
+class BookListQuerySchema(Schema):
+    after = fields.Str(missing=None)  # _id of the last book of the previous page
+    limit = fields.Int(missing=None, validate=validate.Range(min=1, max=1000))  # Without limit and after, every book
+    projection = fields.Str(data_key='fields', missing=None)  # Comma-separated subset of BOOK_FIELDS; _id is always returned
+
+    @validates('after')
+    def validate_after(self, value, **kwargs):
+        if value is not None and not ObjectId.is_valid(value):
+            raise ValidationError('Not a valid book id.')
+
+    @validates('projection')
+    def validate_projection(self, value, **kwargs):
+        if value is not None and not set(value.split(',')) <= set(BOOK_FIELDS):
+            raise ValidationError(f"Fields must be among {', '.join(BOOK_FIELDS)}.")
+
+
+class CollectionVersion:
+    """Version counter of a collection, bumped on every write, for ETags of its listings.
+
+    The counter lives in VERSIONS_COLLECTION so every worker agrees on it, and is re-read
+    at most every ``ttl`` seconds; in between, a listing whose ETag matches is answered
+    without MongoDB. Writes made by this process are seen immediately, those of other
+    workers within ``ttl`` seconds.
+    """
+
+    def __init__(self, collection: str, ttl: float = 5.0, clock=time.monotonic):
+        self.collection = collection
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._version: Optional[int] = None
+        self._read_at = 0.0
+
+    def current(self, db) -> int:
+        with self._lock:
+            if self._version is not None and self.clock() - self._read_at < self.ttl:
+                return self._version
+        doc = db[VERSIONS_COLLECTION].find_one({'_id': self.collection})
+        return self._remember(doc['version'] if doc else 0)
+
+    def bump(self, db) -> int:
+        doc = db[VERSIONS_COLLECTION].find_one_and_update({'_id': self.collection}, {'$inc': {'version': 1}},
+                                                          upsert=True, return_document=ReturnDocument.AFTER)
+        return self._remember(doc['version'])
+
+    def _remember(self, version: int) -> int:
+        with self._lock:
+            self._version = version
+            self._read_at = self.clock()
+        return version
+
+
+def book_projection(requested: Optional[str]) -> Optional[Dict]:
+    return None if requested is None else {field: 1 for field in requested.split(',')}
+
+def stream_books(books: Iterator[Dict], limit: Optional[int]) -> Iterator[str]:
+    """A page as ``{"books": [...], "next": ...}``, serialized one book at a time.
+
+    The status is already sent, so a failure while reading further batches is logged and
+    re-raised to abort the response rather than end it as valid JSON.
+    """
+    yield '{"books": ['
+    last_id = None
+    count = 0
+    try:
+        for book in books:
+            last_id = book['_id'] = str(book['_id'])
+            yield (',' if count else '') + json.dumps(book, default=str)
+            count += 1
+    except Exception as e:
+        logger.error(f"Error streaming /books after {count} books: {e}")
+        raise
+    # Keyset pagination: pass ``next`` as ``after`` to get the following page
+    yield f'], "next": {json.dumps(last_id if count == limit else None)}}}'
+
 
 def init_books_module(app, mongo, login_manager):
     books_bp = Blueprint('books', __name__)
-    
+    books_version = CollectionVersion('books', ttl=app.config.get('BOOKS_VERSION_TTL', 5.0))
+
     @books_bp.route('/', methods=['GET', 'POST','OPTIONS'])
     #@login_required
     def get_books():
         try:
-            books_collection = mongo.db.books
-            books_data = list(books_collection.find())
-
-            # Convert ObjectId to string for each book
-            for book in books_data:
-                book['_id'] = str(book['_id'])
-
-            return jsonify({'books': books_data}), 200
+            query = BookListQuerySchema().load(request.args)
+        except ValidationError as e:
+            return jsonify({'message': 'Invalid input data', 'errors': e.messages}), 400
+        try:
+            version = books_version.current(mongo.db)
+            etag = f"books-{version}-{query['after']}-{query['limit']}-{query['projection']}"
+            if request.method == 'GET' and request.if_none_match.contains(etag):
+                return Response(status=304, headers={'ETag': f'"{etag}"'})
+            criteria = {'_id': {'$gt': ObjectId(query['after'])}} if query['after'] else {}
+            cursor = mongo.db.books.find(criteria, book_projection(query['projection'])).sort('_id', 1)
+            if query['limit'] is None and query['after'] is not None:
+                query['limit'] = BOOKS_PAGE_SIZE
+            if query['limit'] is not None:
+                cursor = cursor.limit(query['limit'])
+            # Read the first batch here, so a failing query still gets the 500 below
+            first = next(cursor, None)
+            books = itertools.chain([first], cursor) if first is not None else iter(())
+            response = Response(stream_with_context(stream_books(books, query['limit'])), status=200,
+                                mimetype='application/json')
+            response.set_etag(etag)
+            return response
         except Exception as e:
             logger.error(f"Error in /books route: {e}")
             return jsonify({'message': 'Internal Server Error'}), 500
@@ -46,6 +146,7 @@ def init_books_module(app, mongo, login_manager):
             result = books_collection.insert_one(book_data)
 
             if result.inserted_id:
+                books_version.bump(mongo.db)
                 return jsonify({'message': 'Book added successfully', 'book_id': str(result.inserted_id)}), 201
             else:
                 return jsonify({'message': 'Failed to add book'}), 500
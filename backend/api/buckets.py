@@ -0,0 +1,65 @@
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional
+import numpy as np
+
+NUMPY_UNITS = {'minute': 'm', 'hour': 'h', 'day': 'D'}
+MAX_BUCKETS = 600000  # a little over a year of minute buckets
+
+
+class TooManyBuckets(ValueError):
+    pass
+
+
+def to_datetime64(timestamp: datetime, interval: str) -> np.datetime64:
+    """Truncate a timestamp to the start of its ``interval`` bucket as a UTC datetime64."""
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return np.datetime64(timestamp, NUMPY_UNITS[interval])
+
+def bucket_count(start_date: datetime, end_date: datetime, interval: str) -> int:
+    return int((to_datetime64(end_date, interval) - to_datetime64(start_date, interval)).astype(np.int64)) + 1
+
+def check_bucket_count(start_date: datetime, end_date: datetime, interval: str, max_buckets: Optional[int] = MAX_BUCKETS) -> int:
+    count = bucket_count(start_date, end_date, interval)
+    if max_buckets is not None and count > max_buckets:
+        raise TooManyBuckets(f'Requested range spans {count} {interval} buckets; the limit is {max_buckets}. '
+                             f'Narrow the range or use a coarser interval.')
+    return count
+
+def bucket_range(start_date: datetime, end_date: datetime, interval: str, max_buckets: Optional[int] = MAX_BUCKETS) -> np.ndarray:
+    """Every bucket start from the bucket of ``start_date`` to that of ``end_date``."""
+    count = check_bucket_count(start_date, end_date, interval, max_buckets)
+    return to_datetime64(start_date, interval) + np.arange(count)
+
+def _suffix_table(slots: int, minutes_per_slot: int) -> np.ndarray:
+    suffixes = [f' {m // 60:02d}:{m % 60:02d}' for m in range(0, slots * minutes_per_slot, minutes_per_slot)]
+    return np.array(suffixes, dtype='S6').view(np.uint8).reshape(slots, 6)
+
+# ' HH:MM' for every hour/minute of a day, as rows of ASCII bytes
+TIME_SUFFIXES = {'hour': _suffix_table(24, 60), 'minute': _suffix_table(1440, 1)}
+
+
+def bucket_labels(buckets: np.ndarray, interval: str) -> np.ndarray:
+    """Format bucket starts like the aggregation's ``_id`` (see rollups.BUCKET_FORMATS), in bulk.
+
+    Only the distinct days go through datetime_as_string; the time of day is looked up in a
+    precomputed table and both are assembled as raw bytes.
+    """
+    if interval == 'day' or len(buckets) == 0:
+        return np.datetime_as_string(buckets.astype('datetime64[D]'))
+    days = buckets.astype('datetime64[D]')
+    day_offsets = (days - days[0]).astype(np.int64)
+    day_labels = np.datetime_as_string(days[0] + np.arange(day_offsets[-1] + 1)).astype('S10').view(np.uint8).reshape(-1, 10)
+    slots = (buckets - days).astype(np.int64)
+    labels = np.empty((len(buckets), 16), dtype=np.uint8)
+    labels[:, :10] = day_labels[day_offsets]
+    labels[:, 10:] = TIME_SUFFIXES[interval][slots]
+    return labels.view('S16').ravel().astype('U16')
+
+def fill_missing_dates(data: List[Dict], start_date: datetime, end_date: datetime, interval: str,
+                       max_buckets: Optional[int] = MAX_BUCKETS, fields: Iterable[str] = ('average_value',)) -> List[Dict]:
+    """Return one entry per bucket between the two dates, with every one of ``fields`` 0 where ``data`` has none."""
+    labels = bucket_labels(bucket_range(start_date, end_date, interval, max_buckets), interval).tolist()
+    data_dict = {d['_id']: d for d in data}
+    zeros = dict.fromkeys(fields, 0)
+    return [data_dict.get(label) or {'_id': label, **zeros} for label in labels]
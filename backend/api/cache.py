@@ -0,0 +1,540 @@
+import itertools
+import sys
+import threading
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+from bson import ObjectId
+from api.rollups import ROLLUP_INTERVALS, as_utc, bucket_start, merge_stats, point_stats
+
+SeriesKey = Tuple[str, str]
+BucketFetcher = Callable[[datetime, datetime], Dict[datetime, Dict]]
+# Fetches buckets of several series in one query: (names, first, last) -> {name: buckets}
+MultiBucketFetcher = Callable[[List[str], datetime, datetime], Dict[str, Dict[datetime, Dict]]]
+
+# Approximate footprint of one cached bucket: datetime key, stats dict with float values and the dict slot
+BUCKET_BYTES = (sys.getsizeof(datetime.now(timezone.utc))
+                + sys.getsizeof(point_stats(0.0)) + 4 * sys.getsizeof(0.0) + 3 * 8)
+# Each quantile sketch entry: a short key string, an int count and its dict slot
+SKETCH_ENTRY_BYTES = sys.getsizeof('p-1000') + sys.getsizeof(1000) + 32
+SKETCH_SAMPLE = 32
+COVERED_RANGE_BYTES = sys.getsizeof([None, None]) + 2 * sys.getsizeof(datetime.now(timezone.utc))
+# Start a new series' high-water mark slightly in the past to absorb clock skew between writers
+HIGH_WATER_SKEW = timedelta(minutes=1)
+
+
+class LRUCache:
+    """Thread-safe LRU cache bounded by entry count and an approximate byte budget.
+
+    Each entry carries its own expiry (``ttl`` seconds from when it was last set). Sizes
+    come from ``sizeof`` and are re-measured whenever an entry is set again.
+    """
+
+    def __init__(self, max_entries: int = 1000, max_bytes: int = 256 * 1024 * 1024, ttl: Optional[float] = None,
+                 sizeof: Callable[[Any], int] = sys.getsizeof, on_evict: Optional[Callable[[Hashable, Any], None]] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.on_evict = on_evict
+        self.clock = clock
+        self._entries: OrderedDict[Hashable, Tuple[Any, int, Optional[float]]] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2] <= self.clock():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """Return an entry without touching its recency or the hit/miss counters."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return default if entry is None else entry[0]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            size = self.sizeof(value)
+            self._entries[key] = (value, size, self.clock() + ttl if ttl else None)
+            self._bytes += size
+            self._evict()
+
+    def resize(self, key: Hashable) -> None:
+        """Re-measure an entry whose value was mutated in place, evicting if over budget."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            value, size, expires_at = entry
+            new_size = self.sizeof(value)
+            self._entries[key] = (value, new_size, expires_at)
+            self._bytes += new_size - size
+            self._evict()
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if key not in self._entries:
+                return default
+            return self._remove(key)
+
+    def expire(self) -> List[Hashable]:
+        now = self.clock()
+        with self._lock:
+            expired = [key for key, (_, _, expires_at) in self._entries.items() if expires_at is not None and expires_at <= now]
+            for key in expired:
+                self._remove(key)
+            self.expirations += len(expired)
+            return expired
+
+    def items(self) -> List[Tuple[Hashable, Any]]:
+        with self._lock:
+            return [(key, value) for key, (value, _, _) in self._entries.items()]
+
+    def clear(self) -> None:
+        """Drop every entry and reset the statistics."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _evict(self) -> None:
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            key, (value, _, _) = next(iter(self._entries.items()))
+            self._remove(key)
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(key, value)
+
+    def _remove(self, key: Hashable) -> Any:
+        value, size, _ = self._entries.pop(key)
+        self._bytes -= size
+        return value
+
+
+class SingleFlight:
+    """Coalesces concurrent calls: while a call for a key runs, callers with the same key
+    wait for it and share its result (or its exception) instead of repeating the work."""
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error: Optional[BaseException] = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, 'SingleFlight._Call'] = {}
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = SingleFlight._Call()
+                self.calls += 1
+            else:
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {'calls': self.calls, 'shared': self.shared, 'in_flight': len(self._calls)}
+
+
+class SeriesBuckets:
+    """Aggregated buckets of one (name, interval) series and the bucket ranges known to be complete.
+
+    ``covered`` holds sorted, disjoint, inclusive [first, last] ranges of bucket starts. Only
+    closed buckets (entirely in the past) are ever covered, so a covered range can be served
+    from memory; buckets missing inside it simply had no data. ``high_water`` is the ObjectId
+    of the newest raw point accounted for; ObjectIds follow insertion time, so points newer
+    than it include late data for old buckets.
+    """
+
+    def __init__(self, width: timedelta):
+        self.width = width
+        self.buckets: Dict[datetime, Dict] = {}
+        self.covered: List[List[datetime]] = []
+        self.high_water = ObjectId.from_datetime(datetime.now(timezone.utc) - HIGH_WATER_SKEW)
+        self.version = 0
+
+    def next_bucket(self, bucket: datetime) -> Optional[datetime]:
+        try:
+            return bucket + self.width
+        except OverflowError:
+            return None
+
+    def is_covered(self, bucket: datetime) -> bool:
+        i = bisect_right(self.covered, [bucket, datetime.max.replace(tzinfo=timezone.utc)]) - 1
+        return i >= 0 and self.covered[i][0] <= bucket <= self.covered[i][1]
+
+    def missing(self, first: datetime, last: datetime) -> List[Tuple[datetime, datetime]]:
+        gaps = []
+        cursor = first
+        for lo, hi in self.covered:
+            if cursor is None or lo > last:
+                break
+            if hi < cursor:
+                continue
+            if lo > cursor:
+                gaps.append((cursor, lo - self.width))
+            cursor = self.next_bucket(hi)
+        if cursor is not None and cursor <= last:
+            gaps.append((cursor, last))
+        return gaps
+
+    def cover(self, first: datetime, last: datetime) -> None:
+        ranges = sorted(self.covered + [[first, last]])
+        merged = [ranges[0]]
+        for lo, hi in ranges[1:]:
+            end = self.next_bucket(merged[-1][1])
+            if end is None or lo <= end:
+                merged[-1][1] = max(merged[-1][1], hi)
+            else:
+                merged.append([lo, hi])
+        self.covered = merged
+
+    def uncover(self, bucket: datetime) -> None:
+        """Forget ``bucket``, so the next query reads it again."""
+        self.buckets.pop(bucket, None)
+        covered = []
+        for lo, hi in self.covered:
+            if lo <= bucket <= hi:
+                if lo < bucket:
+                    covered.append([lo, bucket - self.width])
+                following = self.next_bucket(bucket)
+                if following is not None and following <= hi:
+                    covered.append([following, hi])
+            else:
+                covered.append([lo, hi])
+        self.covered = covered
+
+    def approx_bytes(self) -> int:
+        # Sketch sizes vary with the spread of values, so estimate them from a sample of buckets
+        sample = list(itertools.islice(self.buckets.values(), SKETCH_SAMPLE))
+        sketch_entries = sum(len(stats.get('sketch', ())) for stats in sample) / len(sample) if sample else 0
+        bucket_bytes = BUCKET_BYTES + sys.getsizeof({}) + sketch_entries * SKETCH_ENTRY_BYTES
+        return int(sys.getsizeof(self) + len(self.buckets) * bucket_bytes + len(self.covered) * COVERED_RANGE_BYTES)
+
+    def select(self, first: datetime, last: datetime) -> Dict[datetime, Dict]:
+        steps = (last - first) // self.width + 1
+        if steps <= len(self.buckets):
+            selected = {}
+            bucket = first
+            while bucket is not None and bucket <= last:
+                if bucket in self.buckets:
+                    selected[bucket] = self.buckets[bucket]
+                bucket = self.next_bucket(bucket)
+            return selected
+        return {bucket: stats for bucket, stats in self.buckets.items() if first <= bucket <= last}
+
+
+class SeriesStore:
+    """Second-level store for cached series shared by every worker (see shared_cache.RedisSeriesStore).
+
+    The base class shares nothing, which is the single-process setup.
+    """
+
+    def get(self, key: SeriesKey) -> Optional[SeriesBuckets]:
+        return None
+
+    def set(self, key: SeriesKey, series: SeriesBuckets) -> None:
+        pass
+
+    def delete(self, keys: Iterable[SeriesKey]) -> None:
+        pass
+
+
+class BucketCache:
+    """Cache of aggregated buckets per (name, interval).
+
+    Overlapping windows share buckets: a query is answered from the covered buckets and
+    only the missing sub-ranges are fetched. Closed buckets are kept as immutable, while
+    the open (current) bucket and anything after it is fetched again on every query.
+    Series live in an LRUCache, bounded by series count and approximate bytes, and
+    expire ``ttl`` seconds after they were filled or last changed by a refresh. With a
+    shared ``store``, series missing locally are looked up there before querying MongoDB,
+    and filled series are written back for the other workers.
+    """
+
+    def __init__(self, max_series: int = 1000, max_bytes: int = 256 * 1024 * 1024, ttl: Optional[float] = 1800):
+        self._series = LRUCache(max_series, max_bytes, ttl, sizeof=SeriesBuckets.approx_bytes)
+        self._lock = threading.RLock()
+        self._versions = itertools.count(1)
+        # Ids of points this worker already folded in (ingested here or received from the bus),
+        # so merge_new_points does not count them again; pruned as the high-water marks pass them
+        self._accounted: Dict[ObjectId, None] = {}
+        self.store = SeriesStore()
+        self.hits = 0
+        self.partial_hits = 0
+        self.misses = 0
+
+    def configure(self, max_series: int, max_bytes: int, ttl: Optional[float], store: Optional[SeriesStore] = None) -> None:
+        with self._lock:
+            self.store = store or SeriesStore()
+            self._series.max_entries = max_series
+            self._series.max_bytes = max_bytes
+            self._series.ttl = ttl
+            self._series.expire()
+
+    def get_buckets(self, name: str, interval: str, first: datetime, last: datetime,
+                    fetch: BucketFetcher, now: Optional[datetime] = None) -> Dict[datetime, Dict]:
+        now = now or datetime.now(timezone.utc)
+        key = (name, interval)
+        with self._lock:
+            series, gaps = self._lookup(key, first, last)
+            if not gaps:
+                return series.select(first, last)
+        fetched = [(lo, hi, fetch(lo, hi)) for lo, hi in gaps]
+        with self._lock:
+            return self._commit(key, series, fetched, first, last, now)
+
+    def get_many_buckets(self, names: List[str], interval: str, first: datetime, last: datetime,
+                         fetch: MultiBucketFetcher, now: Optional[datetime] = None) -> Dict[str, Dict[datetime, Dict]]:
+        """Like get_buckets for several series at once, fetching every missing range in one query.
+
+        The query spans from the earliest to the latest gap of any series; only buckets that
+        fall inside a series' own gaps are stored for it.
+        """
+        now = now or datetime.now(timezone.utc)
+        result = {}
+        pending = {}
+        with self._lock:
+            for name in names:
+                series, gaps = self._lookup((name, interval), first, last)
+                if gaps:
+                    pending[name] = (series, gaps)
+                else:
+                    result[name] = series.select(first, last)
+        if not pending:
+            return result
+        lo = min(gaps[0][0] for _, gaps in pending.values())
+        hi = max(gaps[-1][1] for _, gaps in pending.values())
+        fetched = fetch(list(pending), lo, hi)
+        with self._lock:
+            for name, (series, gaps) in pending.items():
+                buckets = fetched.get(name, {})
+                per_gap = [(gap_lo, gap_hi, {bucket: stats for bucket, stats in buckets.items() if gap_lo <= bucket <= gap_hi})
+                           for gap_lo, gap_hi in gaps]
+                result[name] = self._commit((name, interval), series, per_gap, first, last, now)
+        return result
+
+    def _lookup(self, key: SeriesKey, first: datetime, last: datetime) -> Tuple[SeriesBuckets, List[Tuple[datetime, datetime]]]:
+        """The cached (or a new) series for ``key`` and its missing ranges, counting the query."""
+        series = self._series.get(key)
+        if series is None:
+            series = self.store.get(key) or SeriesBuckets(ROLLUP_INTERVALS[key[1]])
+            series.version = next(self._versions)
+        gaps = series.missing(first, last)
+        if not gaps:
+            self.hits += 1
+        elif gaps == [(first, last)]:
+            self.misses += 1
+        else:
+            self.partial_hits += 1
+        return series, gaps
+
+    def _commit(self, key: SeriesKey, series: SeriesBuckets, fetched: List[Tuple[datetime, datetime, Dict]],
+                first: datetime, last: datetime, now: datetime) -> Dict[datetime, Dict]:
+        self._store(series, fetched, bucket_start(now, key[1]))
+        if key in self._series:
+            self._series.resize(key)
+        else:
+            self._series.set(key, series)
+        self.store.set(key, series)
+        return series.select(first, last)
+
+    def apply_points(self, docs: Iterable[Dict], shared: bool = True, now: Optional[datetime] = None) -> None:
+        """Fold freshly ingested points into covered buckets of cached series (late data).
+
+        A point carrying an _id is remembered once it landed in every cached series of its
+        name, so the refresher does not handle it again, and skipped if the refresher already
+        did. Any other point is left to the refresher: a series it missed may be filling that
+        range from a read taken before the insert. With ``shared``, shared copies of series
+        that received late points are dropped from the store; pass False for points another
+        worker already accounted for.
+        """
+        docs = list(docs)
+        now = now or datetime.now(timezone.utc)
+        with self._lock:
+            by_name = {}
+            for (name, interval), series in self._series.items():
+                by_name.setdefault(name, []).append((interval, series))
+            for doc in docs:
+                if '_id' in doc and doc['_id'] in self._accounted:
+                    continue
+                cached = by_name.get(doc['name'], ())
+                landed = [self._merge_point(series, interval, doc) for interval, series in cached]
+                if '_id' in doc and cached and all(landed):
+                    self._accounted[doc['_id']] = None
+        if shared:
+            # Only closed buckets are ever covered, so points in the open buckets change no cached series
+            self.store.delete({(doc['name'], interval) for doc in docs for interval in ROLLUP_INTERVALS
+                               if bucket_start(as_utc(doc['timestamp']), interval) < bucket_start(now, interval)})
+
+    def high_waters(self) -> Dict[SeriesKey, ObjectId]:
+        return {key: series.high_water for key, series in self._series.items()}
+
+    def merge_new_points(self, name: str, points: List[Dict], now: Optional[datetime] = None) -> Dict[str, List[Dict]]:
+        """Account for raw points inserted after the high-water marks of ``name``'s series.
+
+        ``points`` are read from the raw collection. Those not already applied through
+        apply_points were stored by another worker, or written straight to the raw
+        collection, in which case they never reach the rollups. Rather than merging them,
+        the covered buckets they fall in are dropped, so the next query reads those buckets
+        from the rollups again and the cache always agrees with them. Points in the open
+        tail need nothing since those buckets are read fresh. Each mark then advances past
+        the points, and for idle series to shortly before ``now``. Returns the points of
+        dropped buckets by interval of the series that lost any.
+        """
+        now = now or datetime.now(timezone.utc)
+        floor = ObjectId.from_datetime(now - HIGH_WATER_SKEW)
+        with self._lock:
+            new = [point for point in points if point['_id'] not in self._accounted]
+            changed = {}
+            for interval in ROLLUP_INTERVALS:
+                key = (name, interval)
+                series = self._series.peek(key)
+                if series is None:
+                    continue
+                landed = [point for point in new
+                          if point['_id'] > series.high_water and self._drop_point_bucket(series, interval, point)]
+                series.high_water = max([series.high_water, floor] + [point['_id'] for point in points])
+                if landed:
+                    changed[interval] = landed
+                    # set, not resize: a refresh that changed the series restarts its ttl
+                    self._series.set(key, series)
+                    self.store.set(key, series)
+            for point in new:
+                self._accounted[point['_id']] = None
+            return changed
+
+    def prune_accounted(self, now: Optional[datetime] = None) -> None:
+        """Forget applied point ids that no series can read again: those below every
+        high-water mark and below the mark a new series starts from."""
+        now = now or datetime.now(timezone.utc)
+        with self._lock:
+            floor = min([ObjectId.from_datetime(now - HIGH_WATER_SKEW)]
+                        + [series.high_water for _, series in self._series.items()])
+            self._accounted = {point_id: None for point_id in self._accounted if point_id > floor}
+
+    def _merge_point(self, series: SeriesBuckets, interval: str, doc: Dict) -> bool:
+        bucket = bucket_start(as_utc(doc['timestamp']), interval)
+        if not series.is_covered(bucket):
+            return False
+        if bucket in series.buckets:
+            merge_stats(series.buckets[bucket], point_stats(doc['value']))
+        else:
+            series.buckets[bucket] = point_stats(doc['value'])
+        series.version = next(self._versions)
+        return True
+
+    def _drop_point_bucket(self, series: SeriesBuckets, interval: str, doc: Dict) -> bool:
+        bucket = bucket_start(as_utc(doc['timestamp']), interval)
+        if not series.is_covered(bucket):
+            return False
+        series.uncover(bucket)
+        series.version = next(self._versions)
+        return True
+
+    def version(self, name: str, interval: str) -> Optional[int]:
+        """Cache-wide unique stamp that changes whenever a bucket of the series changes, for keying derived results."""
+        series = self._series.peek((name, interval))
+        return None if series is None else series.version
+
+    def expire(self) -> List[SeriesKey]:
+        return self._series.expire()
+
+    def series_keys(self) -> List[SeriesKey]:
+        return [key for key, _ in self._series.items()]
+
+    def clear(self) -> None:
+        """Drop every series and reset the statistics."""
+        with self._lock:
+            self._series.clear()
+            self._accounted.clear()
+            self.hits = self.partial_hits = self.misses = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            queries = self.hits + self.partial_hits + self.misses
+            return {
+                'series': self._series.stats(),
+                'buckets': sum(len(series.buckets) for _, series in self._series.items()),
+                'queries': {
+                    'hits': self.hits,
+                    'partial_hits': self.partial_hits,
+                    'misses': self.misses,
+                    'hit_rate': round(self.hits / queries, 4) if queries else 0.0,
+                },
+            }
+
+    def __len__(self) -> int:
+        return len(self._series)
+
+    def _store(self, series: SeriesBuckets, fetched: List[Tuple[datetime, datetime, Dict]], open_bucket: datetime) -> None:
+        for lo, hi, buckets in fetched:
+            if any(series.buckets.get(bucket) != stats for bucket, stats in buckets.items()):
+                series.version = next(self._versions)
+            series.buckets.update(buckets)
+            closed_last = min(hi, open_bucket - series.width)
+            if closed_last >= lo:
+                series.cover(lo, closed_last)
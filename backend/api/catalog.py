@@ -0,0 +1,200 @@
+import re
+import threading
+from bisect import bisect_left, bisect_right, insort
+from typing import Dict, Iterable, List, Optional
+from flask_pymongo import PyMongo
+from loguru import logger
+from pymongo import ReturnDocument, UpdateOne
+from api.rollups import as_utc
+
+CATALOG_COLLECTION = 'metric_catalog'
+# Holds a counter bumped by every write to CATALOG_COLLECTION
+CATALOG_VERSION_COLLECTION = 'metric_catalog_version'
+GLOB_CHARS = '*?'
+
+
+def catalog_updates(docs: Iterable[Dict]) -> List[UpdateOne]:
+    """Combine points per name into upserts of first/last seen, point count and last value.
+
+    last_value is set by a second update that only matches while the point is still the
+    newest one, so concurrent writers cannot roll it back.
+    """
+    combined = {}
+    for doc in docs:
+        timestamp = as_utc(doc['timestamp'])
+        entry = combined.get(doc['name'])
+        if entry is None:
+            combined[doc['name']] = {'first_seen': timestamp, 'last_seen': timestamp, 'count': 1, 'last_value': doc['value']}
+            continue
+        entry['count'] += 1
+        entry['first_seen'] = min(entry['first_seen'], timestamp)
+        if timestamp >= entry['last_seen']:
+            entry['last_seen'], entry['last_value'] = timestamp, doc['value']
+    updates = []
+    for name, entry in combined.items():
+        updates.append(UpdateOne({'_id': name},
+                                 {'$min': {'first_seen': entry['first_seen']}, '$max': {'last_seen': entry['last_seen']},
+                                  '$inc': {'count': entry['count']}},
+                                 upsert=True))
+        updates.append(UpdateOne({'_id': name, 'last_seen': entry['last_seen']}, {'$set': {'last_value': entry['last_value']}}))
+    return updates
+
+def catalog_version(db) -> int:
+    doc = db[CATALOG_VERSION_COLLECTION].find_one({'_id': CATALOG_COLLECTION})
+    return doc['version'] if doc else 0
+
+def bump_catalog_version(db) -> int:
+    """Mark the catalog as changed, so every MetricCatalog copy reloads on its next refresh()."""
+    doc = db[CATALOG_VERSION_COLLECTION].find_one_and_update(
+        {'_id': CATALOG_COLLECTION}, {'$inc': {'version': 1}}, upsert=True, return_document=ReturnDocument.AFTER)
+    return doc['version']
+
+def rebuild_catalog(db, raw_collection: str = 'metrics') -> None:
+    """Recompute the catalog from raw metrics, replacing existing entries."""
+    db[raw_collection].aggregate([
+        {'$sort': {'timestamp': 1}},
+        {'$group': {'_id': '$name', 'first_seen': {'$first': '$timestamp'}, 'last_seen': {'$last': '$timestamp'},
+                    'count': {'$sum': 1}, 'last_value': {'$last': '$value'}}},
+        {'$merge': {'into': CATALOG_COLLECTION, 'whenMatched': 'replace', 'whenNotMatched': 'insert'}},
+    ], allowDiskUse=True)
+    bump_catalog_version(db)
+
+def glob_to_regex(pattern: str) -> str:
+    """Anchored regex for a name glob (``*`` and ``?``)."""
+    parts = []
+    for char in pattern:
+        if char == '*':
+            parts.append('.*')
+        elif char == '?':
+            parts.append('.')
+        else:
+            parts.append(re.escape(char))
+    return '^' + ''.join(parts) + '$'
+
+def glob_prefix(pattern: str) -> str:
+    """Literal part of a name glob before its first wildcard."""
+    match = re.search(f'[{re.escape(GLOB_CHARS)}]', pattern)
+    return pattern if match is None else pattern[:match.start()]
+
+
+class MetricCatalog:
+    """In-memory copy of the ``metric_catalog`` collection: one entry per metric name.
+
+    Ingest writes the catalog next to the rollups and folds the same points into this copy,
+    so listing names never touches the raw points. Names are kept sorted: prefix searches
+    and keyset pages cost a bisection plus the entries returned. The copy is loaded on
+    first use and reloaded after invalidate(), which refresh() does when the catalog version
+    (CATALOG_VERSION_COLLECTION) moved past the one the copy reflects, i.e. another process
+    added names, or rebuilt or deleted entries. Updates to names already listed do not move
+    the version: other workers fold those points in from the invalidation bus. Code changing
+    the collection directly must call bump_catalog_version().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict] = {}
+        self._names: List[str] = []
+        self._loaded = False
+        self._version = None
+
+    def load(self, mongo: PyMongo) -> None:
+        # Read before the entries, so writes racing with the load show up as a newer version
+        version = catalog_version(mongo.db)
+        entries = {}
+        for doc in mongo.db[CATALOG_COLLECTION].find():
+            entries[doc['_id']] = {'name': doc['_id'], 'first_seen': as_utc(doc['first_seen']),
+                                   'last_seen': as_utc(doc['last_seen']), 'count': doc['count'],
+                                   'last_value': doc.get('last_value')}
+        with self._lock:
+            self._entries = entries
+            self._names = sorted(entries)
+            self._loaded = True
+            self._version = version
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._loaded = False
+
+    def refresh(self, mongo: PyMongo) -> bool:
+        """Reload the copy if the collection changed behind its back."""
+        with self._lock:
+            known = self._version if self._loaded else None
+        if known is not None and catalog_version(mongo.db) == known:
+            return False
+        self.load(mongo)
+        return True
+
+    def record(self, docs: List[Dict], mongo: PyMongo) -> None:
+        """Write stored points to the catalog collection and the in-memory copy."""
+        if not docs:
+            return
+        try:
+            result = mongo.db[CATALOG_COLLECTION].bulk_write(catalog_updates(docs), ordered=True)
+            # Only a new name is worth a reload elsewhere; details of known names travel with the points
+            version = bump_catalog_version(mongo.db) if result.upserted_count else None
+        except Exception as e:
+            logger.error(f'Failed to update {CATALOG_COLLECTION}: {e}')
+            self.invalidate()
+            return
+        self.apply(docs)
+        if version is None:
+            return
+        with self._lock:
+            # Only this write happened since the copy was current, so it stays current
+            if self._loaded and version == self._version + 1:
+                self._version = version
+
+    def apply(self, docs: Iterable[Dict]) -> None:
+        """Fold points into the in-memory copy only, e.g. points stored by another worker."""
+        with self._lock:
+            for doc in docs:
+                timestamp = as_utc(doc['timestamp'])
+                entry = self._entries.get(doc['name'])
+                if entry is None:
+                    self._entries[doc['name']] = {'name': doc['name'], 'first_seen': timestamp, 'last_seen': timestamp,
+                                                  'count': 1, 'last_value': doc['value']}
+                    insort(self._names, doc['name'])
+                    continue
+                entry['count'] += 1
+                entry['first_seen'] = min(entry['first_seen'], timestamp)
+                if timestamp >= entry['last_seen']:
+                    entry['last_seen'], entry['last_value'] = timestamp, doc['value']
+
+    def names(self, mongo: PyMongo, prefix: str = '', after: Optional[str] = None,
+              limit: Optional[int] = None) -> List[str]:
+        """Names starting with ``prefix``, in order, after the ``after`` cursor, at most ``limit`` of them."""
+        self._ensure_loaded(mongo)
+        with self._lock:
+            if after is not None and after >= prefix:
+                start = bisect_right(self._names, after)
+            else:
+                start = bisect_left(self._names, prefix)
+            end = len(self._names) if limit is None else min(len(self._names), start + limit)
+            names = []
+            for index in range(start, end):
+                if not self._names[index].startswith(prefix):
+                    break
+                names.append(self._names[index])
+            return names
+
+    def entries(self, mongo: PyMongo, prefix: str = '', after: Optional[str] = None,
+                limit: Optional[int] = None) -> List[Dict]:
+        names = self.names(mongo, prefix, after, limit)
+        with self._lock:
+            return [dict(self._entries[name]) for name in names]
+
+    def match(self, mongo: PyMongo, pattern: str) -> List[str]:
+        """Names matching a glob, scanning only the names that share its literal prefix."""
+        regex = re.compile(glob_to_regex(pattern))
+        return [name for name in self.names(mongo, glob_prefix(pattern)) if regex.match(name)]
+
+    def _ensure_loaded(self, mongo: PyMongo) -> None:
+        with self._lock:
+            loaded = self._loaded
+        if not loaded:
+            self.load(mongo)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
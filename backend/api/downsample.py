@@ -0,0 +1,58 @@
+from typing import Dict, List
+import numpy as np
+
+DOWNSAMPLE_METHODS = ('lttb', 'minmax')
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """Indices kept by Largest-Triangle-Three-Buckets for ``threshold`` output points.
+
+    The first and last points are always kept; every bucket in between contributes the
+    point forming the largest triangle with the previously kept point and the average
+    of the next bucket.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    every = (n - 2) / (threshold - 2)
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        indices[i + 1] = a
+    return indices
+
+def minmax_indices(y: np.ndarray, threshold: int) -> np.ndarray:
+    """Indices of the minimum and maximum of each of ``threshold // 2`` equal slices (envelope decimation)."""
+    n = len(y)
+    if threshold >= n or threshold < 2:
+        return np.arange(n)
+    edges = np.linspace(0, n, threshold // 2 + 1).astype(np.int64)
+    keep = set()
+    for start, end in zip(edges[:-1], edges[1:]):
+        if end > start:
+            window = y[start:end]
+            keep.add(start + int(np.argmin(window)))
+            keep.add(start + int(np.argmax(window)))
+    return np.array(sorted(keep), dtype=np.int64)
+
+def downsample(data: List[Dict], max_points: int, method: str = 'lttb', field: str = 'average_value') -> List[Dict]:
+    """Reduce aggregated buckets (as returned by get_metrics_data) to at most ``max_points``,
+    choosing points by the shape of ``field``."""
+    if len(data) <= max_points:
+        return data
+    y = np.array([d[field] for d in data], dtype=np.float64)
+    if method == 'minmax':
+        indices = minmax_indices(y, max_points)
+    else:
+        x = np.array([d['_id'] for d in data], dtype='datetime64[m]').astype(np.float64)
+        indices = lttb_indices(x, y, max_points)
+    return [data[i] for i in indices.tolist()]
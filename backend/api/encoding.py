@@ -0,0 +1,115 @@
+import gzip
+import io
+from typing import Dict, List, Optional, Sequence
+import numpy as np
+from flask import Request, Response
+
+ROWS_JSON = 'application/json'
+COLUMNS_JSON = 'application/vnd.metrics.columns+json'
+MSGPACK = 'application/msgpack'
+ARROW_STREAM = 'application/vnd.apache.arrow.stream'
+# Representations of a metrics response, offered in this order when the client accepts several equally
+RESPONSE_TYPES = (ROWS_JSON, COLUMNS_JSON, MSGPACK, 'application/x-msgpack', ARROW_STREAM)
+COMPRESS_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4  # Far faster than the default 11 at a slightly larger size
+
+
+class UnsupportedEncoding(ValueError):
+    """The negotiated encoding needs a library that is not installed."""
+
+
+def negotiate(request: Request) -> str:
+    """The response type to use for the request's Accept header; rows of JSON by default."""
+    return request.accept_mimetypes.best_match(RESPONSE_TYPES, default=ROWS_JSON)
+
+def series_columns(metrics: List[Dict], fields: Optional[Sequence[str]] = None) -> Dict[str, np.ndarray]:
+    """Rows of get_metrics_data as parallel arrays: bucket starts in epoch milliseconds
+    (``timestamps``, int64) and one float64 array per statistic (NaN where it has no value).
+
+    ``fields`` names the statistic columns, so a series without buckets still has all of
+    them; by default they are taken from the first row.
+    """
+    timestamps = np.array([row['_id'] for row in metrics], dtype='datetime64[m]').astype('datetime64[ms]').astype(np.int64)
+    if fields is None:
+        fields = [field for field in metrics[0] if field != '_id'] if metrics else []
+    return {'timestamps': timestamps,
+            **{field: np.array([row.get(field) for row in metrics], dtype=np.float64) for field in fields}}
+
+def binary_columns(columns: Dict[str, np.ndarray]) -> Dict[str, bytes]:
+    """Columns as little-endian buffers, read by clients with Int64Array/Float64Array views."""
+    return {field: array.astype(array.dtype.newbyteorder('<')).tobytes() for field, array in columns.items()}
+
+def encode_columns(series: Dict[str, List[Dict]], mimetype: str, fields: Optional[Sequence[str]] = None) -> bytes:
+    """``{'series': {name: columns}}`` for the rows of each series, encoded as ``mimetype``."""
+    columns = {name: series_columns(metrics, fields) for name, metrics in series.items()}
+    try:
+        if mimetype == COLUMNS_JSON:
+            import orjson
+
+            return orjson.dumps({'series': columns}, option=orjson.OPT_SERIALIZE_NUMPY)
+        if mimetype == ARROW_STREAM:
+            return arrow_stream(columns, fields)
+        import msgpack
+
+        return msgpack.packb({'series': {name: binary_columns(c) for name, c in columns.items()}})
+    except ImportError as e:
+        raise UnsupportedEncoding(f'{mimetype} responses are not available: {e}')
+
+def arrow_stream(columns: Dict[str, Dict[str, np.ndarray]], fields: Optional[Sequence[str]] = None) -> bytes:
+    """Apache Arrow IPC stream with one record batch per series: name, timestamp and the statistics.
+
+    Every batch has the same schema (``fields``, or the statistics of the first series), empty
+    series included.
+    """
+    import pyarrow as pa
+
+    if fields is None:
+        fields = [field for field in next(iter(columns.values()), {}) if field != 'timestamps']
+    schema = pa.schema([('name', pa.dictionary(pa.int32(), pa.string())), ('timestamp', pa.timestamp('ms', tz='UTC')),
+                        *((field, pa.float64()) for field in fields)])
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for name, series in columns.items():
+            writer.write_batch(pa.record_batch([
+                pa.array([name] * len(series['timestamps']), pa.string()).dictionary_encode(),
+                pa.array(series['timestamps'], pa.timestamp('ms', tz='UTC')),
+                *(pa.array(series[field], pa.float64(), from_pandas=True) for field in fields)], schema=schema))
+    return sink.getvalue()
+
+def columnar_response(series: Dict[str, List[Dict]], mimetype: str, fields: Optional[Sequence[str]] = None) -> Response:
+    response = Response(encode_columns(series, mimetype, fields), status=200, mimetype=mimetype)
+    response.vary.add('Accept')
+    return response
+
+def available_encodings() -> List[str]:
+    encodings = ['gzip']
+    try:
+        import brotli  # noqa: F401
+
+        encodings.insert(0, 'br')
+    except ImportError:
+        pass
+    return encodings
+
+def compress_response(response: Response, request: Request, min_size: int = COMPRESS_MIN_BYTES) -> Response:
+    """Compress a complete response of at least ``min_size`` bytes with brotli or gzip, as the client accepts."""
+    if (response.is_streamed or response.direct_passthrough or response.status_code != 200
+            or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < min_size:
+        return response
+    encoding: Optional[str] = request.accept_encodings.best_match(available_encodings())
+    if encoding == 'br':
+        import brotli
+
+        data = brotli.compress(data, quality=BROTLI_QUALITY)
+    elif encoding == 'gzip':
+        data = gzip.compress(data, compresslevel=GZIP_LEVEL)
+    else:
+        return response
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    return response
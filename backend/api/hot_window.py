@@ -0,0 +1,206 @@
+import itertools
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Iterable, Optional
+import numpy as np
+from api.rollups import ROLLUP_INTERVALS, as_utc, bucket_start
+from api.sketch import LOG_GAMMA, MIN_INDEXABLE_VALUE
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+# Timestamp and value of one point
+POINT_BYTES = np.dtype(np.int64).itemsize + np.dtype(np.float64).itemsize
+
+
+def to_micros(timestamp: datetime) -> int:
+    return (as_utc(timestamp) - EPOCH) // MICROSECOND
+
+def from_micros(micros: int) -> datetime:
+    return EPOCH + timedelta(microseconds=int(micros))
+
+
+class RingBuffer:
+    """The most recent points of one metric as fixed-size NumPy arrays of timestamps and values.
+
+    Slots are overwritten oldest-written first once the buffer is full. ``complete_since``
+    (microseconds) is the time from which the buffer holds every point: it starts when the
+    buffer starts being fed and moves past the timestamp of every point overwritten.
+    """
+
+    def __init__(self, capacity: int, complete_since: int):
+        self.timestamps = np.empty(capacity, dtype=np.int64)
+        self.values = np.empty(capacity, dtype=np.float64)
+        self.start = 0
+        self.size = 0
+        self.complete_since = complete_since
+
+    @property
+    def capacity(self) -> int:
+        return len(self.timestamps)
+
+    def append(self, timestamps: np.ndarray, values: np.ndarray) -> None:
+        # Points older than the complete range would not make it any more complete
+        keep = timestamps >= self.complete_since
+        timestamps, values = timestamps[keep], values[keep]
+        capacity = self.capacity
+        if len(timestamps) > capacity:
+            self.complete_since = max(self.complete_since, int(timestamps[:-capacity].max()) + 1)
+            timestamps, values = timestamps[-capacity:], values[-capacity:]
+        overflow = self.size + len(timestamps) - capacity
+        if overflow > 0:
+            evicted = (self.start + np.arange(overflow)) % capacity
+            self.complete_since = max(self.complete_since, int(self.timestamps[evicted].max()) + 1)
+            self.start = (self.start + overflow) % capacity
+            self.size -= overflow
+        slots = (self.start + self.size + np.arange(len(timestamps))) % capacity
+        self.timestamps[slots] = timestamps
+        self.values[slots] = values
+        self.size += len(timestamps)
+
+    def points(self):
+        """Timestamps and values of the held points, in no particular order."""
+        if self.size == self.capacity:
+            return self.timestamps, self.values
+        # The buffer only wraps once full, so the points of a partly filled one are a prefix
+        return self.timestamps[:self.size], self.values[:self.size]
+
+
+class HotWindow:
+    """Ring buffers of the latest points per metric, fed by ingest, answering recent ranges without MongoDB.
+
+    Each metric keeps at most ``points_per_metric`` points (16 bytes each) and at most
+    ``max_metrics`` metrics are held, dropping the least recently written, so memory stays
+    below points_per_metric * max_metrics * 16 bytes. A bucket is served from memory only
+    when it starts after the metric's ``complete_since``, so the answer equals MongoDB's
+    as long as every stored point passes through add() - on every worker, which the
+    invalidation bus takes care of when METRICS_REDIS_URL is set.
+    """
+
+    def __init__(self, points_per_metric: int = 0, max_metrics: int = 1000,
+                 clock: Callable[[], datetime] = lambda: datetime.now(timezone.utc)):
+        self._lock = threading.Lock()
+        self._buffers: OrderedDict[str, RingBuffer] = OrderedDict()
+        # Version stamps come from one counter and are never reused, so a metric that is dropped
+        # and added again cannot match a result derived from its earlier points
+        self._counter = itertools.count(1)
+        self._versions: Dict[str, int] = {}
+        self._dropped_version = 0
+        self.clock = clock
+        self.configure(points_per_metric, max_metrics)
+
+    def configure(self, points_per_metric: int, max_metrics: int) -> None:
+        """Size the window and start feeding it now; points already stored are not in it."""
+        with self._lock:
+            self.points_per_metric = points_per_metric
+            self.max_metrics = max_metrics
+            self._buffers.clear()
+            self._versions.clear()
+            self._dropped_version = next(self._counter)
+            # New buffers are complete from here; raised past the points of dropped buffers
+            self._floor = to_micros(self.clock())
+
+    @property
+    def enabled(self) -> bool:
+        return self.points_per_metric > 0 and self.max_metrics > 0
+
+    def add(self, docs: Iterable[Dict]) -> None:
+        if not self.enabled:
+            return
+        by_name = {}
+        for doc in docs:
+            by_name.setdefault(doc['name'], []).append((to_micros(doc['timestamp']), doc['value']))
+        with self._lock:
+            for name, points in by_name.items():
+                buffer = self._buffers.get(name)
+                if buffer is None:
+                    buffer = self._buffers[name] = RingBuffer(self.points_per_metric, self._floor)
+                    self._evict()
+                else:
+                    self._buffers.move_to_end(name)
+                timestamps, values = zip(*points)
+                buffer.append(np.array(timestamps, dtype=np.int64), np.array(values, dtype=np.float64))
+                self._versions[name] = next(self._counter)
+
+    def first_bucket(self, name: str, interval: str) -> Optional[datetime]:
+        """Start of the first ``interval`` bucket held completely in memory, or None if the metric is not held."""
+        with self._lock:
+            buffer = self._buffers.get(name)
+            if buffer is None:
+                return None
+            complete_since = from_micros(buffer.complete_since)
+        first = bucket_start(complete_since, interval)
+        return first if first == complete_since else first + ROLLUP_INTERVALS[interval]
+
+    def buckets(self, name: str, interval: str, first: datetime, last: datetime,
+                sketches: bool = True) -> Dict[datetime, Dict]:
+        """Sum/count/min/max (and quantile sketches) per ``interval`` bucket from ``first`` to ``last``,
+        in the shape of get_rollup_buckets, computed with vectorized bucketing."""
+        width = ROLLUP_INTERVALS[interval] // MICROSECOND
+        lo = to_micros(first)
+        hi = to_micros(last) + width
+        with self._lock:
+            buffer = self._buffers.get(name)
+            if buffer is None:
+                return {}
+            timestamps, values = buffer.points()
+            in_range = (timestamps >= lo) & (timestamps < hi)
+            timestamps, values = timestamps[in_range], values[in_range]
+        if not len(timestamps):
+            return {}
+        index = (timestamps - lo) // width
+        counts = np.bincount(index)
+        sums = np.bincount(index, weights=values)
+        order = np.argsort(index, kind='stable')
+        index, values = index[order], values[order]
+        present = np.flatnonzero(counts)
+        starts = np.searchsorted(index, present)
+        mins = np.minimum.reduceat(values, starts)
+        maxs = np.maximum.reduceat(values, starts)
+        result = {}
+        for i, bucket in enumerate(present):
+            result[first + timedelta(microseconds=int(bucket) * width)] = {
+                'sum': float(sums[bucket]), 'count': int(counts[bucket]),
+                'min': float(mins[i]), 'max': float(maxs[i]), 'sketch': {}}
+        if sketches:
+            self._add_sketches(result, first, width, index, values)
+        return result
+
+    def version(self, name: str) -> int:
+        """Changes whenever points of ``name`` are added or metrics are dropped, for keying results derived from the window."""
+        with self._lock:
+            return self._versions.get(name, self._dropped_version)
+
+    def clear(self) -> None:
+        self.configure(self.points_per_metric, self.max_metrics)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'metrics': len(self._buffers),
+                'max_metrics': self.max_metrics,
+                'points': sum(buffer.size for buffer in self._buffers.values()),
+                'points_per_metric': self.points_per_metric,
+                'bytes': len(self._buffers) * self.points_per_metric * POINT_BYTES,
+            }
+
+    def _evict(self) -> None:
+        while len(self._buffers) > self.max_metrics:
+            name, buffer = self._buffers.popitem(last=False)
+            self._versions.pop(name, None)
+            self._dropped_version = next(self._counter)
+            timestamps, _ = buffer.points()
+            if len(timestamps):
+                self._floor = max(self._floor, int(timestamps.max()) + 1)
+
+    @staticmethod
+    def _add_sketches(result: Dict[datetime, Dict], first: datetime, width: int, index: np.ndarray, values: np.ndarray) -> None:
+        """sketch.sketch_key for every value at once, then counted per (bucket, key)."""
+        sign = np.where(values > MIN_INDEXABLE_VALUE, 1, np.where(values < -MIN_INDEXABLE_VALUE, -1, 0))
+        magnitude = np.where(sign != 0, np.abs(values), 1.0)
+        exponent = np.where(sign != 0, np.ceil(np.log(magnitude) / LOG_GAMMA), 0).astype(np.int64)
+        keys, counts = np.unique(np.stack([index, sign, exponent], axis=1), axis=0, return_counts=True)
+        prefixes = {1: 'p', -1: 'n'}
+        for (bucket, key_sign, key_exponent), count in zip(keys.tolist(), counts.tolist()):
+            key = f'{prefixes[key_sign]}{key_exponent}' if key_sign else 'z'
+            result[first + timedelta(microseconds=bucket * width)]['sketch'][key] = count
@@ -0,0 +1,194 @@
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+from pymongo import ASCENDING
+from api.catalog import CATALOG_COLLECTION
+from api.rollups import ROLLUP_COLLECTIONS, rollup_query
+
+MIGRATIONS_COLLECTION = 'schema_migrations'
+# A plan is inefficient when it examines this many documents or keys per document it returns
+INEFFICIENT_RATIO = 10
+# Stages whose nReturned counts the documents an access path let through, outermost first
+ACCESS_STAGES = ('FETCH', 'COLLSCAN', 'IXSCAN', 'PROJECTION_COVERED')
+
+# Stands for the raw points collection in index specs; migrate() resolves it (see api.storage)
+RAW_COLLECTION = None
+
+# Versioned index changes, applied in order and recorded in MIGRATIONS_COLLECTION. Each
+# migration creates its indexes before dropping any, so queries never lose their index.
+# Index specs are (collection, key pattern, options); drops match on the key pattern.
+MIGRATIONS = [
+    {
+        'version': 1,
+        'description': 'Compound (name, timestamp) index for raw range queries; drop the redundant name and the unused value indexes',
+        'create': [
+            (RAW_COLLECTION, [('name', ASCENDING), ('timestamp', ASCENDING)], {}),
+            (RAW_COLLECTION, [('timestamp', ASCENDING)], {}),
+            *[(collection, [('name', ASCENDING), ('bucket', ASCENDING)], {'unique': True})
+              for collection in ROLLUP_COLLECTIONS.values()],
+        ],
+        'drop': [
+            (RAW_COLLECTION, [('name', ASCENDING)]),
+            (RAW_COLLECTION, [('value', ASCENDING)]),
+        ],
+    },
+]
+
+
+def key_pattern(keys: Iterable) -> Tuple:
+    return tuple((field, direction) for field, direction in keys)
+
+def find_index(collection, keys: Iterable) -> Optional[str]:
+    """Name of the index of ``collection`` with exactly the key pattern ``keys``, if any."""
+    wanted = key_pattern(keys)
+    for name, info in collection.index_information().items():
+        if key_pattern(info['key']) == wanted:
+            return name
+    return None
+
+def applied_versions(db) -> List[int]:
+    return sorted(doc['_id'] for doc in db[MIGRATIONS_COLLECTION].find({}, {'_id': 1}))
+
+def migration_steps(steps: Iterable[Tuple], raw_collection: str, timeseries: bool) -> List[Tuple]:
+    """``steps`` with RAW_COLLECTION resolved to ``raw_collection``. A time-series raw
+    collection is skipped: its store creates the indexes it needs (TimeSeriesMetricStore.ensure)."""
+    resolved = []
+    for collection, *rest in steps:
+        if collection is RAW_COLLECTION:
+            if timeseries:
+                continue
+            collection = raw_collection
+        resolved.append((collection, *rest))
+    return resolved
+
+def migrate(db, dry_run: bool = False, commit_quorum=None, target: Optional[int] = None,
+            raw_collection: str = 'metrics', timeseries: bool = False) -> List[str]:
+    """Apply the pending MIGRATIONS up to ``target`` (default: all) and return what was done.
+
+    Each step checks the live indexes first, so re-running a migration, or running it on a
+    database where some of its indexes already exist, is harmless. Indexes are built one at
+    a time; ``commit_quorum`` is passed to the builds on replica sets (MongoDB 4.4+) to bound
+    how many members must finish before an index is used. With ``dry_run`` nothing changes.
+    ``raw_collection`` and ``timeseries`` describe where the raw points live (see api.storage).
+    """
+    done = set(applied_versions(db))
+    actions = []
+    for migration in MIGRATIONS:
+        version = migration['version']
+        if version in done or (target is not None and version > target):
+            continue
+        actions.append(f"migration {version}: {migration['description']}")
+        for collection, keys, options in migration_steps(migration['create'], raw_collection, timeseries):
+            if find_index(db[collection], keys) is not None:
+                continue
+            actions.append(f'create {collection} {key_pattern(keys)}')
+            if not dry_run:
+                if commit_quorum is not None:
+                    options = {**options, 'commitQuorum': commit_quorum}
+                db[collection].create_index(keys, **options)
+        for collection, keys in migration_steps(migration['drop'], raw_collection, timeseries):
+            name = find_index(db[collection], keys)
+            if name is None:
+                continue
+            actions.append(f'drop {collection} {name}')
+            if not dry_run:
+                db[collection].drop_index(name)
+        if not dry_run:
+            db[MIGRATIONS_COLLECTION].update_one(
+                {'_id': version},
+                {'$set': {'description': migration['description'], 'applied_at': datetime.now(timezone.utc)}},
+                upsert=True)
+    return actions
+
+def redundant_indexes(collection) -> List[Tuple[str, str]]:
+    """(index, covering index) pairs where the first is a key prefix of the second.
+
+    Unique indexes are never reported, since they enforce a constraint besides serving queries.
+    """
+    indexes = {name: (key_pattern(info['key']), info.get('unique', False))
+               for name, info in collection.index_information().items()}
+    redundant = []
+    for name, (keys, unique) in indexes.items():
+        if name == '_id_' or unique:
+            continue
+        for other, (other_keys, _) in indexes.items():
+            if len(other_keys) > len(keys) and other_keys[:len(keys)] == keys:
+                redundant.append((name, other))
+                break
+    return redundant
+
+def plan_stages(plan: Dict) -> List[Dict]:
+    """Every stage of an explain plan tree, outermost first."""
+    stages = [plan] if 'stage' in plan else []
+    for key in ('inputStage', 'queryPlan', 'thenStage', 'elseStage', 'outerStage', 'innerStage'):
+        if isinstance(plan.get(key), dict):
+            stages.extend(plan_stages(plan[key]))
+    for child in plan.get('inputStages', ()):
+        stages.extend(plan_stages(child))
+    return stages
+
+def query_explain(explain: Dict) -> Dict:
+    """The part of an explain result holding queryPlanner/executionStats, for finds and aggregates."""
+    if 'queryPlanner' in explain:
+        return explain
+    for stage in explain.get('stages', ()):
+        if '$cursor' in stage:
+            return stage['$cursor']
+    return explain
+
+def analyze_plan(explain: Dict) -> Dict:
+    """Stages, work done and problems (COLLSCAN, blocking sort, too much examined) of an explain."""
+    explain = query_explain(explain)
+    stages = [stage['stage'] for stage in plan_stages(explain.get('queryPlanner', {}).get('winningPlan', {}))]
+    execution = explain.get('executionStats', {})
+    returned = execution.get('nReturned', 0)
+    for stage in plan_stages(execution.get('executionStages', {})):
+        if stage['stage'] in ACCESS_STAGES:
+            returned = stage.get('nReturned', returned)
+            break
+    examined = max(execution.get('totalDocsExamined', 0), execution.get('totalKeysExamined', 0))
+    problems = []
+    if 'COLLSCAN' in stages:
+        problems.append('collection scan')
+    if 'SORT' in stages:
+        problems.append('blocking in-memory sort')
+    if examined > INEFFICIENT_RATIO * max(returned, 1):
+        problems.append(f'examined {examined} documents or keys for {returned} returned')
+    return {'stages': stages, 'examined': examined, 'returned': returned, 'problems': problems}
+
+def explain_command(db, command: Dict) -> Dict:
+    return db.command('explain', command, verbosity='executionStats')
+
+def hot_queries(name: str, high_water, now: Optional[datetime] = None,
+                raw_collection: str = 'metrics') -> List[Tuple[str, Dict]]:
+    """Explain commands for the queries api.metrics runs, over the last day of ``name``."""
+    now = now or datetime.now(timezone.utc)
+    start = now - timedelta(days=1)
+    queries = [('cache refresh (refresh_metrics_cache)',
+                {'find': raw_collection, 'filter': {'$or': [{'name': name, '_id': {'$gt': high_water}}]}})]
+    for interval in ROLLUP_COLLECTIONS:
+        collection, query = rollup_query([name], start, now, interval)
+        queries.append((f'{interval} rollup range (get_many_rollup_buckets)', {'find': collection, 'filter': query}))
+    collection, _ = rollup_query([name], start, now, 'hour')
+    queries.append(('series extent (series_extent)',
+                    {'find': collection, 'filter': {'name': name}, 'sort': {'bucket': -1}, 'limit': 1}))
+    return queries
+
+def advise(db, name: Optional[str] = None, raw_collection: str = 'metrics') -> Dict:
+    """Explain the hot queries against the live database and inspect its indexes.
+
+    ``name`` picks the series to explain with; it defaults to the one of the newest point.
+    ``raw_collection`` is where the raw points live (see api.storage).
+    """
+    report = {'indexes': {}, 'queries': [], 'pending_migrations': [m['version'] for m in MIGRATIONS
+                                                                   if m['version'] not in applied_versions(db)]}
+    for collection in (raw_collection, *ROLLUP_COLLECTIONS.values(), CATALOG_COLLECTION):
+        report['indexes'][collection] = {
+            'indexes': {index: list(info['key']) for index, info in db[collection].index_information().items()},
+            'redundant': redundant_indexes(db[collection]),
+        }
+    newest = db[raw_collection].find_one({}, {'name': 1}, sort=[('_id', -1)])
+    if newest is None:
+        return report
+    for label, command in hot_queries(name or newest['name'], newest['_id'], raw_collection=raw_collection):
+        report['queries'].append({'query': label, **analyze_plan(explain_command(db, command))})
+    return report
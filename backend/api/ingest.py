@@ -0,0 +1,183 @@
+import atexit
+import threading
+import time
+import weakref
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+from loguru import logger
+
+# Buffers still open at interpreter exit are flushed by one handler, without atexit holding on to them
+_open_buffers = weakref.WeakSet()
+
+
+@atexit.register
+def _close_open_buffers() -> None:
+    for buffer in list(_open_buffers):
+        buffer.close()
+
+
+class IngestQueueFull(Exception):
+    pass
+
+
+class IngestBuffer:
+    """In-process write-behind queue that group-commits metric documents.
+
+    Documents are handed to ``writer`` in batches by a background thread, as soon as
+    ``flush_size`` documents are waiting or ``flush_interval`` seconds after the oldest
+    one arrived, whichever comes first. At most ``max_size`` documents are held;
+    ``submit`` raises IngestQueueFull beyond that so callers can apply backpressure.
+
+    A batch the writer fails on is kept and retried ``flush_interval`` seconds later, ahead
+    of the queue, up to ``max_retries`` times; after that it is dropped, logged and counted
+    under ``dropped``.
+    """
+
+    def __init__(self, writer: Callable[[List[Dict]], None], flush_size: int = 500,
+                 flush_interval: float = 1.0, max_size: int = 50000, max_retries: int = 3):
+        self.writer = writer
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.max_retries = max_retries
+        self._queue: Deque[Dict] = deque()
+        # The batch that last failed, how many times it was tried and when to try it again
+        self._retry: Optional[Tuple[List[Dict], int]] = None
+        self._retry_at = None
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._oldest_at = None
+        self._thread = None
+        self._closed = False
+        self.counters = {'enqueued': 0, 'flushed': 0, 'failed': 0, 'retried': 0, 'dropped': 0, 'rejected': 0, 'flushes': 0}
+        self.flush_latency = {'last_ms': 0.0, 'max_ms': 0.0, 'total_ms': 0.0}
+        _open_buffers.add(self)
+
+    def submit(self, docs: List[Dict]) -> None:
+        with self._condition:
+            if self._closed:
+                raise IngestQueueFull('Ingest buffer is closed')
+            if len(self._queue) + self._retry_size() + len(docs) > self.max_size:
+                self.counters['rejected'] += len(docs)
+                raise IngestQueueFull(f'Ingest queue is full ({self.max_size} metrics waiting)')
+            if not self._queue:
+                self._oldest_at = time.monotonic()
+            self._queue.extend(docs)
+            self.counters['enqueued'] += len(docs)
+            if len(self._queue) >= self.flush_size:
+                self._condition.notify()
+            self._ensure_started()
+
+    def flush(self, retry_early: bool = True) -> int:
+        """Write everything currently queued, flush_size documents per writer call.
+
+        Stops at the first failing batch, which is kept for the next flush. Without
+        ``retry_early`` nothing is written while that batch waits for its retry time.
+        """
+        flushed = 0
+        with self._flush_lock:
+            while True:
+                with self._condition:
+                    if self._retry is not None and not retry_early and time.monotonic() < self._retry_at:
+                        return flushed
+                    if self._retry is not None:
+                        (batch, attempts), self._retry = self._retry, None
+                    else:
+                        batch = [self._queue.popleft() for _ in range(min(self.flush_size, len(self._queue)))]
+                        attempts = 0
+                    self._oldest_at = time.monotonic() if self._queue else None
+                if not batch:
+                    return flushed
+                started = time.perf_counter()
+                try:
+                    self.writer(batch)
+                except Exception as e:
+                    self._failed(batch, attempts + 1, e)
+                    return flushed
+                finally:
+                    self._record_latency((time.perf_counter() - started) * 1000)
+                flushed += len(batch)
+                with self._condition:
+                    self.counters['flushed'] += len(batch)
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+        _open_buffers.discard(self)
+        with self._condition:
+            left = self._retry_size() + len(self._queue)
+            self._retry = None
+            self._queue.clear()
+            self.counters['dropped'] += left
+        if left:
+            logger.error(f'Dropped {left} metrics left unwritten at shutdown')
+
+    def stats(self) -> Dict:
+        with self._condition:
+            queue_depth = len(self._queue) + self._retry_size()
+            counters = dict(self.counters)
+            latency = dict(self.flush_latency)
+        flushes = counters['flushes']
+        return {
+            'queue_depth': queue_depth,
+            'max_size': self.max_size,
+            **counters,
+            'flush_latency_ms': {
+                'last': round(latency['last_ms'], 3),
+                'max': round(latency['max_ms'], 3),
+                'avg': round(latency['total_ms'] / flushes, 3) if flushes else 0.0,
+            },
+        }
+
+    def _failed(self, batch: List[Dict], attempts: int, error: Exception) -> None:
+        with self._condition:
+            self.counters['failed'] += len(batch)
+            if attempts > self.max_retries:
+                self.counters['dropped'] += len(batch)
+            else:
+                self.counters['retried'] += len(batch)
+                self._retry = (batch, attempts)
+                self._retry_at = time.monotonic() + self.flush_interval
+        if attempts > self.max_retries:
+            logger.error(f'Dropped {len(batch)} metrics after {attempts} failed writes: {error}')
+        else:
+            logger.error(f'Ingest flush of {len(batch)} metrics failed (attempt {attempts}), retrying: {error}')
+
+    def _retry_size(self) -> int:
+        return len(self._retry[0]) if self._retry is not None else 0
+
+    def _record_latency(self, elapsed_ms: float) -> None:
+        with self._condition:
+            self.counters['flushes'] += 1
+            self.flush_latency['last_ms'] = elapsed_ms
+            self.flush_latency['max_ms'] = max(self.flush_latency['max_ms'], elapsed_ms)
+            self.flush_latency['total_ms'] += elapsed_ms
+
+    def _ensure_started(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='metrics-ingest-flusher', daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._queue and self._retry is None and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                while not self._closed:
+                    if self._retry is not None:
+                        # A failed batch waits out its interval however full the queue is
+                        remaining = self._retry_at - time.monotonic()
+                    elif self._queue and len(self._queue) < self.flush_size:
+                        remaining = self._oldest_at + self.flush_interval - time.monotonic()
+                    else:
+                        break
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+            self.flush(retry_early=False)
@@ -0,0 +1,250 @@
+import bisect
+import functools
+import inspect
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from flask import Blueprint, Response, g, request
+from loguru import logger
+from pymongo import monitoring
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Upper bounds in seconds, from sub-millisecond cache hits to multi-second scans
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Cumulative latency histogram per label set, in the Prometheus histogram layout."""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, label_names: Iterable[str] = (), buckets: Iterable[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # label values -> (count per bucket, +Inf last; sum)
+        self._series: Dict[Labels, List] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple((name, str(labels[name])) for name in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def time(self, **labels: str):
+        """Context manager observing the duration of its block."""
+        return _Timer(self, labels)
+
+    def totals(self) -> Tuple[int, float]:
+        """Observation count and sum over every label set."""
+        with self._lock:
+            return sum(sum(counts) for counts, _ in self._series.values()), sum(total for _, total in self._series.values())
+
+    def samples(self) -> List[Tuple[str, Labels, float]]:
+        with self._lock:
+            series = [(key, list(counts), total) for key, (counts, total) in self._series.items()]
+        samples = []
+        for key, counts, total in sorted(series):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float('inf')), counts):
+                cumulative += count
+                samples.append((f'{self.name}_bucket', (*key, ('le', format_value(float(bound)))), cumulative))
+            samples.append((f'{self.name}_sum', key, total))
+            samples.append((f'{self.name}_count', key, cumulative))
+        return samples
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: Dict[str, str]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+class Gauge:
+    """Value read from ``collect`` at scrape time: a number, or a list of (labels dict, number)."""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, collect: Callable[[], object], kind: str = 'gauge'):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.kind = kind
+
+    def samples(self) -> List[Tuple[str, Labels, float]]:
+        value = self.collect()
+        if isinstance(value, (int, float)):
+            return [(self.name, (), value)]
+        return [(self.name, tuple(sorted(labels.items())), number) for labels, number in value]
+
+
+class Registry:
+    """The instruments exposed on the scrape endpoint, by name."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._instruments: Dict[str, object] = {}
+
+    def register(self, instrument):
+        with self._lock:
+            self._instruments[instrument.name] = instrument
+        return instrument
+
+    def gauge(self, name: str, help: str, collect: Callable[[], object], kind: str = 'gauge') -> Gauge:
+        """Register a gauge (or, with ``kind='counter'``, a counter) read by ``collect``; replaces one of the same name."""
+        return self.register(Gauge(name, help, collect, kind))
+
+    def instruments(self) -> List:
+        with self._lock:
+            return list(self._instruments.values())
+
+    def render(self) -> str:
+        """Every instrument in the Prometheus text exposition format. A failing collector is skipped."""
+        lines = []
+        for instrument in self.instruments():
+            try:
+                samples = instrument.samples()
+            except Exception:
+                continue
+            lines.append(f'# HELP {instrument.name} {instrument.help}')
+            lines.append(f'# TYPE {instrument.name} {instrument.kind}')
+            lines.extend(f'{name}{format_labels(labels)} {format_value(value)}' for name, labels, value in samples)
+        return '\n'.join(lines) + '\n'
+
+
+class CommandTimer(monitoring.CommandListener):
+    """PyMongo command listener feeding mongodb_command_seconds; pass it to the client's event_listeners."""
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.histogram.observe(event.duration_micros / 1e6, command=event.command_name, outcome='success')
+
+    def failed(self, event):
+        self.histogram.observe(event.duration_micros / 1e6, command=event.command_name, outcome='failure')
+
+
+registry = Registry()
+http_request_seconds = registry.register(Histogram(
+    'http_request_seconds', 'Latency of HTTP requests by route, method and status.', ('route', 'method', 'status')))
+socketio_event_seconds = registry.register(Histogram(
+    'socketio_event_seconds', 'Latency of Socket.IO event handlers by event.', ('event',)))
+mongodb_command_seconds = registry.register(Histogram(
+    'mongodb_command_seconds', 'Latency of MongoDB commands by command name and outcome.', ('command', 'outcome')))
+cache_refresh_seconds = registry.register(Histogram(
+    'metrics_cache_refresh_seconds', 'Duration of the metrics cache maintenance passes.'))
+command_timer = CommandTimer(mongodb_command_seconds)
+
+
+def timed_event(event: str):
+    """Decorator timing a Socket.IO event handler, plain or async, into socketio_event_seconds."""
+    def decorator(handler):
+        if inspect.iscoroutinefunction(handler):
+            @functools.wraps(handler)
+            async def async_wrapper(*args, **kwargs):
+                with socketio_event_seconds.time(event=event):
+                    return await handler(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            with socketio_event_seconds.time(event=event):
+                return handler(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def socket_connections(server) -> int:
+    """Clients connected to this worker on the default namespace of a python-socketio
+    server (Flask-SocketIO's ``socketio.server`` or an AsyncServer)."""
+    return len(server.manager.rooms.get('/', {}).get(None, {}))
+
+def register_connections_gauge(server) -> None:
+    """Report the connections of ``server``; the last server registered wins."""
+    registry.gauge('socketio_connections', 'Socket.IO clients connected to this worker.', lambda: socket_connections(server))
+
+def self_metrics() -> Dict[str, float]:
+    """Scalar readings of the registry for self-ingest: each gauge without labels, plus the
+    observation count and mean of every histogram."""
+    readings = {}
+    for instrument in registry.instruments():
+        if isinstance(instrument, Histogram):
+            count, total = instrument.totals()
+            readings[f'{instrument.name}_count'] = count
+            readings[f'{instrument.name}_mean'] = total / count if count else 0.0
+        elif isinstance(instrument, Gauge):
+            try:
+                value = instrument.collect()
+            except Exception:
+                continue
+            if isinstance(value, (int, float)):
+                readings[instrument.name] = value
+    return readings
+
+
+def init_instrumentation_module(app, socketio, self_ingest: Optional[Callable[[Dict[str, float]], None]] = None):
+    """Time every request, expose the registry at INSTRUMENTATION_PATH and, with
+    INSTRUMENTATION_SELF_INGEST_INTERVAL set, hand self_metrics() to ``self_ingest`` periodically."""
+    instrumentation_bp = Blueprint('instrumentation', __name__)
+
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        started = g.pop('request_started', None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            http_request_seconds.observe(time.perf_counter() - started, route=route, method=request.method,
+                                         status=str(response.status_code))
+        return response
+
+    register_connections_gauge(socketio.server)
+
+    @instrumentation_bp.route(app.config.get('INSTRUMENTATION_PATH', '/prometheus'), methods=['GET'])
+    def scrape():
+        return Response(registry.render(), status=200, content_type=PROMETHEUS_CONTENT_TYPE)
+
+    app.register_blueprint(instrumentation_bp)
+
+    interval = app.config.get('INSTRUMENTATION_SELF_INGEST_INTERVAL', 0)
+    if self_ingest is not None and interval:
+        def self_ingest_forever():
+            while True:
+                socketio.sleep(interval)
+                try:
+                    self_ingest(self_metrics())
+                except Exception as e:
+                    logger.error(f'Error ingesting self metrics: {e}')
+
+        socketio.start_background_task(self_ingest_forever)
@@ -1,50 +1,202 @@
 from flask import Blueprint, request, jsonify
 from loguru import logger
 from datetime import datetime, timezone, timedelta
-from collections import OrderedDict
-import asyncio
-from typing import List, Dict, Tuple, Generator
-from flask_socketio import SocketIO
+import json
+import threading
+from itertools import islice
+from typing import List, Dict, Tuple, Iterable, Iterator, Optional
+from flask_socketio import SocketIO, join_room, leave_room
 from flask_pymongo import PyMongo
-from api.schemas import MetricSchema, MetricsRequestSchema
+from pymongo.errors import BulkWriteError
+from marshmallow import ValidationError
+from api.schemas import CatalogQuerySchema, MetricSchema, MetricsRequestSchema, MultiMetricsRequestSchema
+from api.ingest import IngestBuffer, IngestQueueFull
+from api.rollups import ROLLUP_INTERVALS, as_utc, bucket_start, format_buckets, get_many_rollup_buckets, get_rollup_buckets, percentile, retry_rollups, series_extent, stat_field, update_rollups
+from api.buckets import MAX_BUCKETS, TooManyBuckets, check_bucket_count, fill_missing_dates
+from api.cache import BucketCache, LRUCache, SingleFlight
+from api.catalog import MetricCatalog
+from api.storage import MetricStore, store_from_config
+from api.downsample import downsample
+from api.instrumentation import cache_refresh_seconds, registry, timed_event
+from api.encoding import COMPRESS_MIN_BYTES, ROWS_JSON, UnsupportedEncoding, binary_columns, columnar_response, compress_response, negotiate, series_columns
+from api.hot_window import HotWindow
+from api.retention import RetentionPolicy
+from api.subscriptions import SubscriptionIndex, SubscriptionKey, subscription_key, subscription_request
+from api.shared_cache import InvalidationBus, RedisSeriesStore, redis_client
 
 
 CACHE_EXPIRATION_TIME = timedelta(minutes=30)
-metric_cache: OrderedDict[str, Tuple[List[Dict], datetime]] = OrderedDict()
-
-def cache_key(name: str, start_date: datetime, end_date: datetime, interval: str, include_zeros: bool) -> str:
-    return f'{name}_{start_date.isoformat()}_{end_date.isoformat()}_{interval}_{include_zeros}'
-
-def date_range(start_date: datetime, end_date: datetime, increment: timedelta) -> Generator[datetime, None, None]:
-    current_date = start_date
-    while current_date <= end_date:
-        yield current_date
-        current_date += increment
-
-def fill_missing_dates(data: List[Dict], start_date: datetime, end_date: datetime, interval: str) -> List[Dict]:
-    increments = {'day': timedelta(days=1), 'hour': timedelta(hours=1), 'minute': timedelta(minutes=1)}
-    formats = {'day': "%Y-%m-%d", 'hour': "%Y-%m-%d %H", 'minute': "%Y-%m-%d %H:%M"}
-    time_increment = increments[interval]
-    date_format = formats[interval]
-    data_dict = {d['_id']: d for d in data}
-    return [data_dict.get(date.strftime(date_format), {'_id': date.strftime(date_format), 'average_value': 0})
-            for date in date_range(start_date, end_date, time_increment)]
-
-def get_aggregated_metrics(name: str, start_date: datetime, end_date: datetime, interval: str, mongo: PyMongo) -> List[Dict]:
-    date_format = {'day': '%Y-%m-%d', 'hour': '%Y-%m-%d %H:00', 'minute': '%Y-%m-%d %H:%M'}.get(interval, '%Y-%m-%d')
-    pipeline = [
-        {'$match': {'name': name, 'timestamp': {'$gte': start_date, '$lte': end_date}}},
-        {'$group': {'_id': {'$dateToString': {'format': date_format, 'date': '$timestamp'}}, 'average_value': {'$avg': '$value'}}},
-        {'$sort': {'_id': 1}}
-    ]
-    try:
-        return list(mongo.db.metrics.aggregate(pipeline))
-    except Exception as e:
-        logger.error(f'MongoDB aggregation error: {e}')
-        return []
+CACHE_REFRESH_INTERVAL = 300  # seconds between cache maintenance passes
+BATCH_CHUNK_SIZE = 1000
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/ndjson')
+MAX_SERIES = 100
+# Response header naming the interval a metrics response is bucketed at (see served_interval)
+INTERVAL_HEADER = 'X-Metrics-Interval'
+HOT_WINDOW_POINTS = 0  # per metric; 0 disables the hot window (see METRICS_HOT_WINDOW_POINTS)
+HOT_WINDOW_METRICS = 1000
+CATALOG_PAGE_SIZE = 100
+# Where raw points live; init_metrics_module picks the backend from METRICS_STORAGE
+metric_store = MetricStore()
+metric_cache = BucketCache()
+# Downsampled responses, keyed by request and the version of the series they were built from
+downsample_cache = LRUCache(max_entries=500, max_bytes=64 * 1024 * 1024, ttl=CACHE_EXPIRATION_TIME.total_seconds(),
+                            sizeof=lambda metrics: 64 + 200 * len(metrics))
+subscriptions = SubscriptionIndex()
+# Concurrent identical get_metrics_data calls share one computation
+metrics_flight = SingleFlight()
+# Latest raw points per metric in NumPy ring buffers, answering recent ranges from memory
+hot_window = HotWindow()
+# Metric names with first/last seen, point count and last value, kept in step with ingest
+metric_catalog = MetricCatalog()
+# How long raw points and each rollup tier are kept; queries step up to a tier that still holds their range
+retention = RetentionPolicy()
+# Shares stored points with the other workers once init_metrics_module connects it to Redis
+invalidation_bus = InvalidationBus()
+
+
+class TooManySeries(ValueError):
+    pass
+
+
+def store_metrics(docs: List[Dict], mongo: PyMongo) -> Tuple[int, List[Tuple[int, str]]]:
+    """Write metric documents with unordered insert_many, BATCH_CHUNK_SIZE at a time,
+    and fold the inserted ones into the minute/hour/day rollups.
+
+    Returns the number of inserted documents and a list of (index, message) write errors,
+    where index is the position of the failed document in ``docs``.
+    """
+    inserted = 0
+    write_errors = []
+    for offset in range(0, len(docs), BATCH_CHUNK_SIZE):
+        chunk = docs[offset:offset + BATCH_CHUNK_SIZE]
+        try:
+            inserted += len(metric_store.insert_many(mongo.db, chunk).inserted_ids)
+            chunk_errors = []
+        except BulkWriteError as e:
+            inserted += e.details.get('nInserted', 0)
+            chunk_errors = [(offset + err['index'], err.get('errmsg', 'Write error'))
+                            for err in e.details.get('writeErrors', [])]
+            write_errors.extend(chunk_errors)
+        failed = {index - offset for index, _ in chunk_errors}
+        stored = [doc for i, doc in enumerate(chunk) if i not in failed]
+        hot_window.add(stored)
+        update_rollups(stored, mongo)
+        # After the rollup write, so a worker refilling a dropped shared series reads the new buckets
+        metric_cache.apply_points(stored)
+        metric_catalog.record(stored, mongo)
+        subscriptions.mark_points(stored)
+        invalidation_bus.publish(stored)
+    return inserted, write_errors
+
+def apply_remote_points(docs: List[Dict]) -> None:
+    """Account for points stored by another worker, as received from the invalidation bus."""
+    metric_cache.apply_points(docs, shared=False)
+    hot_window.add(docs)
+    metric_catalog.apply(docs)
+    subscriptions.mark_points(docs)
+
+def write_buffered_metrics(docs: List[Dict], mongo: PyMongo) -> None:
+    inserted, write_errors = store_metrics(docs, mongo)
+    if write_errors:
+        logger.error(f'Failed to write {len(write_errors)} of {len(docs)} buffered metrics: {write_errors[0][1]}')
+
+def iter_batch_records() -> Iterator:
+    """Yield raw records from the request body, either a JSON array or an NDJSON stream.
+
+    NDJSON lines that are not valid JSON are yielded as ValueError instances so that the
+    caller can report them against their position in the batch.
+    """
+    if request.mimetype in NDJSON_MIMETYPES:
+        for line in request.stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                yield ValueError(f'Invalid JSON: {e}')
+    else:
+        records = request.get_json(silent=True)
+        if not isinstance(records, list):
+            raise ValueError('Expected a JSON array of metrics')
+        yield from records
+
+def ingest_metric_batch(records: Iterable, mongo: PyMongo) -> Tuple[int, List[Dict]]:
+    """Validate and store records chunk by chunk.
+
+    Returns the inserted count and the per-record errors.
+    """
+    metric_schema = MetricSchema()
+    inserted = 0
+    errors = []
+    records = iter(records)
+    base_index = 0
+    while True:
+        chunk = list(islice(records, BATCH_CHUNK_SIZE))
+        if not chunk:
+            break
+        parse_errors = {i: {'_schema': [str(record)]} for i, record in enumerate(chunk) if isinstance(record, ValueError)}
+        chunk_errors = dict(parse_errors)
+        try:
+            loaded = metric_schema.load([{} if i in parse_errors else record for i, record in enumerate(chunk)], many=True)
+        except ValidationError as e:
+            loaded = e.valid_data
+            chunk_errors = {**e.messages, **parse_errors}
+        docs = []
+        positions = []
+        for i, item in enumerate(loaded):
+            if i in chunk_errors:
+                errors.append({'index': base_index + i, 'errors': chunk_errors[i]})
+                continue
+            docs.append({'name': item['name'], 'value': item['value'], 'timestamp': as_utc(item['timestamp'])})
+            positions.append(base_index + i)
+        chunk_inserted, write_errors = store_metrics(docs, mongo)
+        inserted += chunk_inserted
+        for doc_index, message in write_errors:
+            errors.append({'index': positions[doc_index], 'errors': {'_schema': [message]}})
+        base_index += len(chunk)
+    errors.sort(key=lambda err: err['index'])
+    return inserted, errors
 
 def init_metrics_module(app, mongo: PyMongo, socketio: SocketIO, login_manager):
+    global metric_store
     metrics_bp = Blueprint('metrics', __name__)
+    metric_store = store_from_config(app.config)
+    try:
+        metric_store.ensure(mongo.db)
+    except Exception as e:
+        logger.error(f'Failed to prepare {metric_store.collection_name} for metrics storage: {e}')
+    max_buckets = app.config.get('METRICS_MAX_BUCKETS', MAX_BUCKETS)
+    max_series = app.config.get('METRICS_MAX_SERIES', MAX_SERIES)
+    ingest_buffer = None
+    if app.config.get('INGEST_WRITE_BEHIND', True):
+        ingest_buffer = IngestBuffer(lambda docs: write_buffered_metrics(docs, mongo),
+                                     flush_size=app.config.get('INGEST_FLUSH_SIZE', 500),
+                                     flush_interval=app.config.get('INGEST_FLUSH_INTERVAL', 1.0),
+                                     max_size=app.config.get('INGEST_MAX_QUEUE', 50000),
+                                     max_retries=app.config.get('INGEST_MAX_RETRIES', 3))
+    app.extensions['metrics_ingest'] = ingest_buffer
+    if ingest_buffer is not None:
+        registry.gauge('metrics_ingest_queue_depth', 'Metrics waiting in the write-behind ingest queue.',
+                       lambda: ingest_buffer.stats()['queue_depth'])
+    cache_ttl = app.config.get('METRICS_CACHE_TTL', CACHE_EXPIRATION_TIME.total_seconds())
+    shared_store = None
+    redis_url = app.config.get('METRICS_REDIS_URL')
+    if redis_url:
+        client = redis_client(redis_url)
+        shared_store = RedisSeriesStore(client, ttl=cache_ttl)
+        invalidation_bus.connect(client, apply_remote_points)
+    metric_catalog.invalidate()
+    retention.configure(raw=app.config.get('METRICS_RETENTION_RAW_DAYS'),
+                        minute=app.config.get('METRICS_RETENTION_MINUTE_DAYS'),
+                        hour=app.config.get('METRICS_RETENTION_HOUR_DAYS'),
+                        day=app.config.get('METRICS_RETENTION_DAY_DAYS'))
+    hot_window.configure(app.config.get('METRICS_HOT_WINDOW_POINTS', HOT_WINDOW_POINTS),
+                         app.config.get('METRICS_HOT_WINDOW_METRICS', HOT_WINDOW_METRICS))
+    metric_cache.configure(max_series=app.config.get('METRICS_CACHE_MAX_SERIES', 1000),
+                           max_bytes=app.config.get('METRICS_CACHE_MAX_BYTES', 256 * 1024 * 1024),
+                           ttl=cache_ttl, store=shared_store)
+    register_cache_gauges()
 
     @metrics_bp.route('/log_metrics', methods=['POST'])
     def log_metrics():
@@ -54,11 +206,17 @@ def init_metrics_module(app, mongo: PyMongo, socketio: SocketIO, login_manager):
             name = data['name']
             value = data['value']
             timestamp = datetime.now(timezone.utc)
-            result = mongo.db.metrics.insert_one({
-                'name': name, 'value': value, 'timestamp': timestamp
-            })
-            if result.inserted_id:
-                socketio.emit('metrics_update', {'name': name, 'value': value, 'timestamp': timestamp.isoformat()})
+            doc = {'name': name, 'value': value, 'timestamp': timestamp}
+            if ingest_buffer is not None:
+                try:
+                    ingest_buffer.submit([doc])
+                except IngestQueueFull as e:
+                    logger.warning(f"Rejected metric {name}: {e}")
+                    return jsonify({'message': 'Too many metrics queued, retry later'}), 429
+                logged = True
+            else:
+                logged = store_metrics([doc], mongo)[0] == 1
+            if logged:
                 return jsonify({'message': 'Metric logged successfully'}), 200
             else:
                 return jsonify({'message': 'Failed to log metric'}), 500
@@ -66,74 +224,487 @@ def init_metrics_module(app, mongo: PyMongo, socketio: SocketIO, login_manager):
             logger.error(f"Error in /log_metrics route: {e}")
             return jsonify({'message': 'Internal Server Error'}), 500
 
+    @metrics_bp.route('/log_metrics_batch', methods=['POST'])
+    def log_metrics_batch():
+        try:
+            inserted, errors = ingest_metric_batch(iter_batch_records(), mongo)
+        except ValueError as e:
+            return jsonify({'message': 'Invalid input data', 'errors': str(e)}), 400
+        except Exception as e:
+            logger.error(f"Error in /log_metrics_batch route: {e}")
+            return jsonify({'message': 'Internal Server Error'}), 500
+        response = {'inserted': inserted, 'failed': len(errors), 'errors': errors}
+        if not errors:
+            return jsonify({'message': 'Metrics logged successfully', **response}), 200
+        if inserted:
+            return jsonify({'message': 'Metrics partially logged', **response}), 207
+        return jsonify({'message': 'Failed to log metrics', **response}), 400
+
+    @metrics_bp.route('/ingest_stats', methods=['GET'])
+    def ingest_stats():
+        if ingest_buffer is None:
+            return jsonify({'write_behind': False}), 200
+        return jsonify({'write_behind': True, **ingest_buffer.stats()}), 200
+
+    @metrics_bp.route('/cache_stats', methods=['GET'])
+    def cache_stats():
+        return jsonify({**metric_cache.stats(), 'hot_window': hot_window.stats(), 'single_flight': metrics_flight.stats()}), 200
+
     @socketio.on('request_metrics')
+    @timed_event('request_metrics')
     def handle_request_metrics(data):
-        metrics_request_schema = MetricsRequestSchema()
         try:
-            validated_data = metrics_request_schema.load(data)
-            metrics_data = get_metrics_data(validated_data, mongo)
-            socketio.emit('metrics_data', metrics_data)
+            event, payload = answer_metrics_request(data, mongo, max_buckets, max_series)
+            socketio.emit(event, payload, to=request.sid)
         except Exception as e:
             logger.error(f"Error handling request_metrics event: {e}")
-            socketio.emit('error', {'message': str(e)})
+            socketio.emit('error', {'message': str(e)}, to=request.sid)
+
+    push_interval = app.config.get('METRICS_PUSH_INTERVAL', 0.5)
+    pusher_lock = threading.Lock()
+    pusher = []
+
+    def push_updates_forever():
+        while True:
+            socketio.sleep(push_interval)
+            try:
+                push_metric_updates(socketio, mongo, max_buckets)
+            except Exception as e:
+                logger.error(f'Error pushing metric updates: {e}')
+
+    def send_snapshot(validated_data):
+        key = subscription_key(validated_data)
+        room = subscriptions.subscribe(request.sid, key)
+        join_room(room)
+        with pusher_lock:
+            if not pusher:
+                pusher.append(socketio.start_background_task(push_updates_forever))
+        socketio.emit('metrics_snapshot', metrics_snapshot(key, validated_data, mongo, max_buckets), to=request.sid)
+
+    @socketio.on('subscribe_metrics')
+    @timed_event('subscribe_metrics')
+    def handle_subscribe_metrics(data):
+        try:
+            send_snapshot(MetricsRequestSchema().load(data))
+        except Exception as e:
+            logger.error(f"Error handling subscribe_metrics event: {e}")
+            socketio.emit('error', {'message': str(e)}, to=request.sid)
+
+    @socketio.on('resync_metrics')
+    @timed_event('resync_metrics')
+    def handle_resync_metrics(data):
+        # Sent by clients that missed a delta sequence number; also (re)subscribes them
+        try:
+            send_snapshot(MetricsRequestSchema().load(data))
+        except Exception as e:
+            logger.error(f"Error handling resync_metrics event: {e}")
+            socketio.emit('error', {'message': str(e)}, to=request.sid)
+
+    @socketio.on('unsubscribe_metrics')
+    @timed_event('unsubscribe_metrics')
+    def handle_unsubscribe_metrics(data):
+        try:
+            room = subscriptions.unsubscribe(request.sid, subscription_key(MetricsRequestSchema().load(data)))
+        except Exception as e:
+            socketio.emit('error', {'message': f'Invalid subscription: {e}'}, to=request.sid)
+            return
+        if room is not None:
+            leave_room(room)
+            socketio.emit('unsubscribed', {'room': room}, to=request.sid)
+
+    @socketio.on('disconnect')
+    @timed_event('disconnect')
+    def handle_disconnect():
+        subscriptions.drop(request.sid)
+
+    compress_min_bytes = app.config.get('METRICS_COMPRESS_MIN_BYTES', COMPRESS_MIN_BYTES)
+
+    @metrics_bp.after_request
+    def compress(response):
+        return compress_response(response, request, compress_min_bytes)
 
     @metrics_bp.route('/get_metrics', methods=['POST'])
     def get_metrics():
         metrics_request_schema = MetricsRequestSchema()
         try:
+            mimetype = negotiate(request)
             data = metrics_request_schema.load(request.get_json())
-            metrics_data = get_metrics_data(data, mongo)
-            return jsonify({'metrics': metrics_data}), 200
+            metrics_data = get_metrics_data(data, mongo, max_buckets)
+            interval = served_interval(data, mongo)
+            if mimetype != ROWS_JSON:
+                response = columnar_response({data['name']: metrics_data}, mimetype, stat_fields(data))
+            else:
+                response = jsonify({'metrics': metrics_data, 'interval': interval})
+            response.headers[INTERVAL_HEADER] = interval
+            return response, 200
+        except ValidationError as e:
+            return jsonify({'message': 'Invalid input data', 'errors': e.messages}), 400
+        except TooManyBuckets as e:
+            return jsonify({'message': str(e)}), 400
+        except UnsupportedEncoding as e:
+            return jsonify({'message': str(e)}), 406
         except Exception as e:
             logger.error(f"Error in /get_metrics route: {e}")
             return jsonify({'message': 'Internal Server Error'}), 500
 
+    @metrics_bp.route('/get_metrics_multi', methods=['POST'])
+    def get_metrics_multi():
+        metrics_request_schema = MultiMetricsRequestSchema()
+        try:
+            mimetype = negotiate(request)
+            data = metrics_request_schema.load(request.get_json())
+            series = get_multi_metrics_data(data, mongo, max_buckets, max_series)
+            interval = served_interval(data, mongo, max_series)
+            if mimetype != ROWS_JSON:
+                response = columnar_response(series, mimetype, stat_fields(data))
+            else:
+                response = jsonify({'series': series, 'interval': interval})
+            response.headers[INTERVAL_HEADER] = interval
+            return response, 200
+        except ValidationError as e:
+            return jsonify({'message': 'Invalid input data', 'errors': e.messages}), 400
+        except (TooManyBuckets, TooManySeries) as e:
+            return jsonify({'message': str(e)}), 400
+        except UnsupportedEncoding as e:
+            return jsonify({'message': str(e)}), 406
+        except Exception as e:
+            logger.error(f"Error in /get_metrics_multi route: {e}")
+            return jsonify({'message': 'Internal Server Error'}), 500
+
     @metrics_bp.route('/get_metric_names', methods=['GET'])
     def get_metric_names():
         try:
-            metric_names = mongo.db.metrics.distinct('name')
+            query = CatalogQuerySchema().load(request.args)
+            metric_names = metric_catalog.names(mongo, query['prefix'], query['after'], query['limit'])
             return jsonify(metric_names), 200
+        except ValidationError as e:
+            return jsonify({'message': 'Invalid input data', 'errors': e.messages}), 400
         except Exception as e:
             logger.error(f"Error fetching metric names: {e}")
             return jsonify({'message': 'Internal Server Error'}), 500
 
+    @metrics_bp.route('/catalog', methods=['GET'])
+    def get_metric_catalog():
+        try:
+            query = CatalogQuerySchema().load(request.args)
+            limit = query['limit'] or CATALOG_PAGE_SIZE
+            entries = metric_catalog.entries(mongo, query['prefix'], query['after'], limit)
+        except ValidationError as e:
+            return jsonify({'message': 'Invalid input data', 'errors': e.messages}), 400
+        except Exception as e:
+            logger.error(f"Error fetching metric catalog: {e}")
+            return jsonify({'message': 'Internal Server Error'}), 500
+        for entry in entries:
+            entry['first_seen'] = entry['first_seen'].isoformat()
+            entry['last_seen'] = entry['last_seen'].isoformat()
+        # Keyset pagination: pass ``next`` as ``after`` to get the following page
+        next_cursor = entries[-1]['name'] if len(entries) == limit else None
+        return jsonify({'metrics': entries, 'next': next_cursor}), 200
+
     app.register_blueprint(metrics_bp, url_prefix='/metrics')
-    loop = asyncio.get_event_loop()
-    loop.create_task(update_metrics_cache(mongo, socketio))
+    refresh_interval = app.config.get('METRICS_CACHE_REFRESH_INTERVAL', CACHE_REFRESH_INTERVAL)
+    if app.config.get('METRICS_BACKGROUND_TASKS', True) and refresh_interval:
+        def maintain_cache_forever():
+            while True:
+                socketio.sleep(refresh_interval)
+                maintain_metrics_cache(mongo)
+
+        socketio.start_background_task(maintain_cache_forever)
+
+def register_cache_gauges() -> None:
+    """Expose the bucket cache, hot window and ingest queue on the instrumentation registry."""
+    def cache_queries(field):
+        return lambda: metric_cache.stats()['queries'][field]
+
+    registry.gauge('metrics_cache_hits_total', 'Bucket cache lookups answered from the cache.', cache_queries('hits'), 'counter')
+    registry.gauge('metrics_cache_partial_hits_total', 'Bucket cache lookups that queried part of their range.',
+                   cache_queries('partial_hits'), 'counter')
+    registry.gauge('metrics_cache_misses_total', 'Bucket cache lookups that queried their whole range.',
+                   cache_queries('misses'), 'counter')
+    registry.gauge('metrics_cache_series', 'Series held by the bucket cache.', lambda: metric_cache.stats()['series']['entries'])
+    registry.gauge('metrics_cache_bytes', 'Approximate size of the bucket cache.', lambda: metric_cache.stats()['series']['bytes'])
+    registry.gauge('metrics_cache_evictions_total', 'Series evicted from the bucket cache.',
+                   lambda: metric_cache.stats()['series']['evictions'], 'counter')
+    registry.gauge('metrics_hot_window_points', 'Points held by the hot window.', lambda: hot_window.stats()['points'])
+
+def ingest_self_metrics(readings: Dict[str, float], mongo: PyMongo) -> None:
+    """Store instrumentation readings as metrics named ``metricshandler.<reading>``, so the dashboard can chart the service."""
+    now = datetime.now(timezone.utc)
+    store_metrics([{'name': f'metricshandler.{name}', 'value': float(value), 'timestamp': now}
+                   for name, value in readings.items()], mongo)
+
+def get_metrics_data(data: Dict, mongo: PyMongo, max_buckets: int = MAX_BUCKETS) -> List[Dict]:
+    """compute_metrics_data, shared by every concurrent caller asking for the same series,
+    window and options, so a burst of identical requests runs one set of queries."""
+    key = (subscription_key(data), max_buckets)
+    return metrics_flight.do(key, lambda: compute_metrics_data(data, mongo, max_buckets))
+
+def compute_metrics_data(data: Dict, mongo: PyMongo, max_buckets: int = MAX_BUCKETS) -> List[Dict]:
+    """Aggregate metric values per bucket for a request validated by MetricsRequestSchema.
 
-def get_metrics_data(data: Dict, mongo: PyMongo) -> List[Dict]:
+    Each bucket carries one field per requested statistic: ``average_value`` for avg,
+    ``count``/``sum``/``min``/``max``, and percentiles estimated from the bucket sketches.
+
+    A missing startDate or endDate is clamped to the first or last bucket holding data,
+    and requests spanning more than ``max_buckets`` buckets raise TooManyBuckets. With
+    ``max_points`` set, the series is downsampled (LTTB or min/max envelope) to at most
+    that many points and the result is cached until the series changes.
+
+    Buckets held completely by the hot window are computed from memory; only the older
+    part of the range goes through the bucket cache and the rollups. A range starting
+    before the retention of the requested interval is answered at the finest coarser
+    interval that still holds it.
+    """
     name = data['name']
+    window = resolve_window(data, name, mongo)
+    if window is None:
+        return []
+    start_date, end_date = window
+    data = retained_interval(data, start_date)
+    interval = data['interval']
+    check_bucket_count(start_date, end_date, interval, max_buckets)
+    first_bucket, last_bucket = bucket_start(start_date, interval), bucket_start(end_date, interval)
+    hot_first = hot_window.first_bucket(name, interval)
+    try:
+        buckets = {}
+        if hot_first is None or first_bucket < hot_first:
+            cold_last = last_bucket if hot_first is None else min(last_bucket, hot_first - ROLLUP_INTERVALS[interval])
+            buckets = metric_cache.get_buckets(name, interval, first_bucket, cold_last,
+                                               lambda first, last: get_rollup_buckets(name, first, last, interval, mongo))
+        if hot_first is not None and hot_first <= last_bucket:
+            sketches = any(percentile(stat) is not None for stat in data.get('stats') or ())
+            buckets.update(hot_window.buckets(name, interval, max(first_bucket, hot_first), last_bucket, sketches))
+    except Exception as e:
+        logger.error(f'MongoDB rollup query error: {e}')
+        return []
+    return render_series(name, buckets, data, start_date, end_date, max_buckets)
+
+def get_multi_metrics_data(data: Dict, mongo: PyMongo, max_buckets: int = MAX_BUCKETS,
+                           max_series: int = MAX_SERIES) -> Dict[str, List[Dict]]:
+    """get_metrics_data for every series named by a MultiMetricsRequestSchema request.
+
+    Series missing from the cache are read together with a single ``$in`` query, and the
+    result maps each metric name to its buckets. Open dates are clamped to the extent of
+    all the series, so they share one window.
+    """
+    names = resolve_metric_names(data, mongo, max_series)
+    if not names:
+        return {}
+    window = resolve_window(data, names, mongo)
+    if window is None:
+        return {name: [] for name in names}
+    start_date, end_date = window
+    data = retained_interval(data, start_date)
+    interval = data['interval']
+    check_bucket_count(start_date, end_date, interval, max_buckets)
+    first_bucket, last_bucket = bucket_start(start_date, interval), bucket_start(end_date, interval)
+    try:
+        series = metric_cache.get_many_buckets(
+            names, interval, first_bucket, last_bucket,
+            lambda pending, first, last: get_many_rollup_buckets(pending, first, last, interval, mongo))
+    except Exception as e:
+        logger.error(f'MongoDB rollup query error: {e}')
+        return {name: [] for name in names}
+    return {name: render_series(name, series[name], data, start_date, end_date, max_buckets) for name in names}
+
+def resolve_window(data: Dict, name, mongo: PyMongo) -> Optional[Tuple[datetime, datetime]]:
+    """The request's date range, with open ends clamped to the data of ``name`` (a name or a
+    list of names). None when there is nothing to return."""
     start_date_str = data['startDate']
     end_date_str = data['endDate']
+    start_date = datetime.fromisoformat(start_date_str).replace(tzinfo=timezone.utc) if start_date_str else None
+    end_date = datetime.fromisoformat(end_date_str).replace(tzinfo=timezone.utc) if end_date_str else None
+    if start_date is None or end_date is None:
+        try:
+            extent = series_extent(name, data['interval'], mongo)
+        except Exception as e:
+            logger.error(f'MongoDB rollup query error: {e}')
+            return None
+        if extent is None:
+            return None
+        start_date = start_date or extent[0]
+        end_date = end_date or extent[1]
+        if start_date > end_date:
+            return None
+    return start_date, end_date
+
+def served_interval(data: Dict, mongo: PyMongo, max_series: int = MAX_SERIES) -> str:
+    """The interval a request is answered at: its own, or the coarser one retained_interval raises it to."""
+    interval = data['interval']
+    if retention.query_interval(interval, datetime.min.replace(tzinfo=timezone.utc)) == interval:
+        return interval  # Nothing of this interval expires
+    start_date = datetime.fromisoformat(data['startDate']).replace(tzinfo=timezone.utc) if data['startDate'] else None
+    if start_date is None:
+        name = data['name'] if data.get('name') else resolve_metric_names(data, mongo, max_series)
+        window = resolve_window(data, name, mongo) if name else None
+        if window is None:
+            return interval
+        start_date = window[0]
+    return retained_interval(data, start_date)['interval']
+
+def retained_interval(data: Dict, start_date: datetime) -> Dict:
+    """``data`` with its interval raised to the finest one whose rollups are still kept at ``start_date``."""
+    interval = retention.query_interval(data['interval'], start_date)
+    return data if interval == data['interval'] else {**data, 'interval': interval}
+
+def render_series(name: str, buckets: Dict[datetime, Dict], data: Dict, start_date: datetime, end_date: datetime,
+                  max_buckets: int = MAX_BUCKETS) -> List[Dict]:
+    """Turn cached buckets into the response for one series: requested statistics, zero
+    filling and downsampling (cached by series version)."""
     interval = data['interval']
     include_zeros = data['include_zeros']
-    start_date = datetime.fromisoformat(start_date_str).replace(tzinfo=timezone.utc) if start_date_str else datetime.min.replace(tzinfo=timezone.utc)
-    end_date = datetime.fromisoformat(end_date_str).replace(tzinfo=timezone.utc) if end_date_str else datetime.max.replace(tzinfo=timezone.utc)
-    key = cache_key(name, start_date, end_date, interval, include_zeros)
-    if key in metric_cache:
-        return metric_cache[key][0]
-    metrics_data = get_aggregated_metrics(name, start_date, end_date, interval, mongo)
+    stats = tuple(data.get('stats') or ('avg',))
+    max_points = data.get('max_points')
+    if max_points:
+        method = data.get('downsample', 'lttb')
+        downsample_key = (name, interval, bucket_start(start_date, interval), bucket_start(end_date, interval),
+                          include_zeros, stats, max_points, method, metric_cache.version(name, interval),
+                          hot_window.version(name))
+        cached = downsample_cache.get(downsample_key)
+        if cached is not None:
+            return cached
+    fields = [stat_field(stat) for stat in stats]
+    metrics_data = format_buckets(buckets, interval, stats)
     if include_zeros:
-        metrics_data = fill_missing_dates(metrics_data, start_date, end_date, interval)
-    metric_cache[key] = (metrics_data, datetime.now(timezone.utc))
+        metrics_data = fill_missing_dates(metrics_data, start_date, end_date, interval, max_buckets, fields)
+    if max_points:
+        metrics_data = downsample(metrics_data, max_points, method, fields[0])
+        downsample_cache.set(downsample_key, metrics_data)
     return metrics_data
 
-async def update_metrics_cache(mongo: PyMongo, socketio: SocketIO):
-    while True:
-        await asyncio.sleep(300)
-        current_time = datetime.now(timezone.utc)
-        keys_to_delete = [key for key, (_, timestamp) in metric_cache.items() if current_time - timestamp >= CACHE_EXPIRATION_TIME]
-        for key in keys_to_delete:
-            del metric_cache[key]
-        for key in metric_cache.keys():
-            name, start_date_str, end_date_str, interval, include_zeros_str = key.split('_')
-            include_zeros = include_zeros_str == 'True'
-            start_date = datetime.fromisoformat(start_date_str).replace(tzinfo=timezone.utc)
-            end_date = datetime.fromisoformat(end_date_str).replace(tzinfo=timezone.utc)
-            new_data = get_aggregated_metrics(name, start_date, end_date, interval, mongo)
-            if include_zeros:
-                new_data = fill_missing_dates(new_data, start_date, end_date, interval)
-            old_data, _ = metric_cache[key]
-            if new_data != old_data:
-                metric_cache[key] = (new_data, datetime.now(timezone.utc))
-                socketio.emit('metrics_update', {'metrics': new_data, 'key': key})
+def resolve_metric_names(data: Dict, mongo: PyMongo, max_series: int = MAX_SERIES) -> List[str]:
+    """Metric names requested by ``names`` or matched by the ``pattern`` glob, in order.
+
+    Raises TooManySeries when more than ``max_series`` names are requested or matched.
+    """
+    if data.get('names'):
+        names = list(dict.fromkeys(data['names']))
+    else:
+        names = metric_catalog.match(mongo, data['pattern'])
+    if len(names) > max_series:
+        raise TooManySeries(f'Request covers {len(names)} series; the limit is {max_series}.')
+    return names
+
+def refresh_metrics_cache(mongo: PyMongo) -> List[Tuple[str, str]]:
+    """Fold raw points inserted since each cached series' high-water mark into the cache.
+
+    One query reads the new points of every cached name, each from the oldest mark of its
+    series. The covered buckets of points not ingested through this worker are dropped and
+    read again from the rollups on the next query, and subscribers are marked for the next
+    push. Returns the series that lost buckets.
+    """
+    high_waters = {}
+    for (name, _), high_water in metric_cache.high_waters().items():
+        high_waters[name] = min(high_water, high_waters.get(name, high_water))
+    if not high_waters:
+        metric_cache.prune_accounted()
+        return []
+    points_by_name = {}
+    for point in metric_store.find_since(mongo.db, high_waters):
+        points_by_name.setdefault(point['name'], []).append(point)
+    changed = []
+    for name in sorted(high_waters):
+        merged = metric_cache.merge_new_points(name, points_by_name.get(name, []))
+        changed.extend((name, interval) for interval in merged)
+        if merged:
+            subscriptions.mark_points(list({point['_id']: point for points in merged.values() for point in points}.values()))
+    metric_cache.prune_accounted()
+    return changed
+
+def maintain_metrics_cache(mongo: PyMongo) -> List[Tuple[str, str]]:
+    """One cache maintenance pass: drop expired series and refresh the rest from new inserts.
+
+    The metric catalog is reloaded too if another process changed it, and rollup updates
+    left by failed writes are written again.
+    """
+    with cache_refresh_seconds.time():
+        metric_cache.expire()
+        try:
+            metric_catalog.refresh(mongo)
+        except Exception as e:
+            logger.error(f'Error refreshing metric catalog: {e}')
+        try:
+            retry_rollups(mongo)
+        except Exception as e:
+            logger.error(f'Error retrying rollup updates: {e}')
+        try:
+            return refresh_metrics_cache(mongo)
+        except Exception as e:
+            logger.error(f'Error refreshing metrics cache: {e}')
+            return []
+
+def answer_metrics_request(data, mongo: PyMongo, max_buckets: int = MAX_BUCKETS,
+                           max_series: int = MAX_SERIES) -> Tuple[str, object]:
+    """Event name and payload replying to a request_metrics event, for one series or several.
+
+    With ``columnar`` set, each series is sent as binary column buffers (see socket_columns).
+    """
+    if isinstance(data, dict) and ('names' in data or 'pattern' in data):
+        validated_data = MultiMetricsRequestSchema().load(data)
+        series = get_multi_metrics_data(validated_data, mongo, max_buckets, max_series)
+        if validated_data['columnar']:
+            series = {name: socket_columns(metrics, validated_data) for name, metrics in series.items()}
+        return 'metrics_series', {'interval': served_interval(validated_data, mongo, max_series), 'series': series}
+    validated_data = MetricsRequestSchema().load(data)
+    metrics_data = get_metrics_data(validated_data, mongo, max_buckets)
+    if validated_data['columnar']:
+        return 'metrics_data', {'name': validated_data['name'], 'interval': served_interval(validated_data, mongo),
+                                'columns': socket_columns(metrics_data, validated_data)}
+    return 'metrics_data', metrics_data
+
+def socket_columns(metrics: List[Dict], data: Dict) -> Dict[str, bytes]:
+    """A series as little-endian int64 ``timestamps`` (epoch ms) and float64 buffers of the
+    statistics ``data`` requested, which Socket.IO sends as binary attachments instead of JSON text."""
+    return binary_columns(series_columns(metrics, stat_fields(data)))
+
+def stat_fields(data: Dict) -> List[str]:
+    """Response fields of the statistics requested by ``data``."""
+    return [stat_field(stat) for stat in data.get('stats') or ('avg',)]
+
+def metrics_snapshot(key: SubscriptionKey, data: Dict, mongo: PyMongo, max_buckets: int = MAX_BUCKETS) -> Dict:
+    """Full series for a subscription, stamped with the last delta sequence number it includes."""
+    seq = subscriptions.sequence(key)
+    metrics_data = get_metrics_data(data, mongo, max_buckets)
+    snapshot = {'room': subscriptions.room(key), 'seq': seq, 'interval': served_interval(data, mongo)}
+    if data.get('columnar'):
+        return {**snapshot, 'columns': socket_columns(metrics_data, data)}
+    return {**snapshot, 'metrics': metrics_data}
+
+def get_bucket_delta(data: Dict, buckets: Iterable[datetime], mongo: PyMongo) -> List[Dict]:
+    """Render only ``buckets`` of the series requested by ``data``, in get_metrics_data's shape."""
+    name, interval = data['name'], data['interval']
+    buckets = sorted(buckets)
+    series = metric_cache.get_buckets(name, interval, buckets[0], buckets[-1],
+                                      lambda first, last: get_rollup_buckets(name, first, last, interval, mongo))
+    changed = {bucket: series[bucket] for bucket in buckets if bucket in series}
+    return format_buckets(changed, interval, data['stats'])
+
+def build_metric_deltas(mongo: PyMongo, max_buckets: int = MAX_BUCKETS) -> List[Tuple[str, Dict]]:
+    """Drain the pending changes into one (room, ``metrics_delta`` payload) per subscription.
+
+    A delta carries the subscription's room, its sequence number and the changed buckets;
+    downsampled subscriptions get the whole series instead (``full``), since a new bucket
+    can move which points are kept.
+    """
+    deltas = []
+    for key, (seq, buckets) in subscriptions.drain().items():
+        data = subscription_request(key)
+        try:
+            if data['max_points']:
+                delta = {'full': True, 'metrics': get_metrics_data(data, mongo, max_buckets)}
+            else:
+                delta = {'full': False, 'metrics': get_bucket_delta(data, buckets, mongo)}
+        except Exception as e:
+            # The skipped sequence number makes subscribers resync
+            logger.error(f'Error building metrics delta: {e}')
+            continue
+        room = subscriptions.room(key)
+        deltas.append((room, {'room': room, 'seq': seq, **delta}))
+    return deltas
+
+def push_metric_updates(socketio: SocketIO, mongo: PyMongo, max_buckets: int = MAX_BUCKETS) -> int:
+    """Emit the coalesced ``metrics_delta`` of every subscription that changed since the last tick."""
+    deltas = build_metric_deltas(mongo, max_buckets)
+    for room, delta in deltas:
+        socketio.emit('metrics_delta', delta, to=room)
+    return len(deltas)
@@ -0,0 +1,96 @@
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+from pymongo import ASCENDING
+from api.rollups import ROLLUP_COLLECTIONS, ROLLUP_INTERVALS
+
+# Storage tiers from finest to coarsest: raw points, then the rollups
+TIERS = ('raw', *ROLLUP_INTERVALS)
+
+
+class RetentionPolicy:
+    """How long each tier keeps data: raw points, then minute, hour and day rollups.
+
+    A tier without a retention keeps data forever. Rollups are written when points are
+    stored, so every point is downsampled long before any tier expires it; the policy only
+    has to keep coarser rollups at least as long as finer ones.
+    """
+
+    def __init__(self, **days: Optional[float]):
+        self.retention: Dict[str, Optional[timedelta]] = {tier: None for tier in TIERS}
+        self.configure(**days)
+
+    def configure(self, **days: Optional[float]) -> None:
+        """Set retentions in days per tier (``raw=30, minute=90``); 0 or None keeps data forever."""
+        unknown = set(days) - set(TIERS)
+        if unknown:
+            raise ValueError(f'Unknown retention tiers: {", ".join(sorted(unknown))}')
+        retention = {tier: timedelta(days=days[tier]) if days.get(tier) else None for tier in TIERS}
+        rollups = list(ROLLUP_INTERVALS)
+        for finer, coarser in zip(rollups, rollups[1:]):
+            if retention[coarser] is not None and (retention[finer] is None or retention[coarser] < retention[finer]):
+                raise ValueError(f'{coarser} rollups must be kept at least as long as {finer} rollups')
+        self.retention = retention
+
+    def keeps(self, tier: str, timestamp: datetime, now: Optional[datetime] = None) -> bool:
+        """Whether ``tier`` still holds data for ``timestamp``."""
+        retention = self.retention[tier]
+        return retention is None or timestamp >= (now or datetime.now(timezone.utc)) - retention
+
+    def query_interval(self, interval: str, start_date: datetime, now: Optional[datetime] = None) -> str:
+        """The finest interval, starting at ``interval``, whose rollups still hold ``start_date``.
+
+        Falls back to the coarsest interval when none does.
+        """
+        intervals = list(ROLLUP_INTERVALS)
+        for candidate in intervals[intervals.index(interval):]:
+            if self.keeps(candidate, start_date, now):
+                return candidate
+        return intervals[-1]
+
+    def expire_after(self, tier: str) -> Optional[int]:
+        retention = self.retention[tier]
+        return None if retention is None else int(retention.total_seconds())
+
+
+def ttl_targets(raw_collection: str = 'metrics') -> Dict[str, tuple]:
+    """Collection and time field that each tier expires on."""
+    return {'raw': (raw_collection, 'timestamp'),
+            **{interval: (collection, 'bucket') for interval, collection in ROLLUP_COLLECTIONS.items()}}
+
+def apply_retention(db, policy: RetentionPolicy, raw_collection: str = 'metrics', timeseries: bool = False,
+                    dry_run: bool = False) -> List[str]:
+    """Make MongoDB expire every tier as ``policy`` says, returning what was changed.
+
+    Each tier gets a TTL index on its time field (``expireAfterSeconds``); an existing TTL is
+    changed in place with collMod, while adding or removing one rebuilds the index. A
+    time-series raw collection expires through its own ``expireAfterSeconds`` option
+    instead. Running it again changes nothing.
+    """
+    actions = []
+    for tier, (collection, field) in ttl_targets(raw_collection).items():
+        expire_after = policy.expire_after(tier)
+        if tier == 'raw' and timeseries:
+            options = db.command('listCollections', filter={'name': collection})['cursor']['firstBatch']
+            current = options[0]['options'].get('expireAfterSeconds') if options else None
+            if current != expire_after:
+                actions.append(f'{collection}: expireAfterSeconds {current} -> {expire_after}')
+                if not dry_run:
+                    db.command('collMod', collection, expireAfterSeconds='off' if expire_after is None else expire_after)
+            continue
+        index = next((info for info in db[collection].index_information().items()
+                      if list(info[1]['key']) == [(field, ASCENDING)]), None)
+        current = index[1].get('expireAfterSeconds') if index else None
+        if current == expire_after:
+            continue
+        if current is None or expire_after is None:
+            options = {} if expire_after is None else {'expireAfterSeconds': expire_after}
+            actions.append(f'{collection}: index on {field} expireAfterSeconds {current} -> {expire_after}')
+            if not dry_run:
+                if index is not None:
+                    db[collection].drop_index(index[0])
+                db[collection].create_index([(field, ASCENDING)], **options)
+        else:
+            actions.append(f'{collection}: {index[0]} expireAfterSeconds {current} -> {expire_after}')
+            if not dry_run:
+                db.command('collMod', collection, index={'keyPattern': {field: 1}, 'expireAfterSeconds': expire_after})
+    return actions
@@ -0,0 +1,241 @@
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+from flask_pymongo import PyMongo
+from loguru import logger
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+from .sketch import LOG_GAMMA, MIN_INDEXABLE_VALUE, sketch_add, sketch_merge, sketch_quantile
+
+# Rollup granularities from finest to coarsest; each one is built from the previous one
+ROLLUP_INTERVALS = {'minute': timedelta(minutes=1), 'hour': timedelta(hours=1), 'day': timedelta(days=1)}
+ROLLUP_COLLECTIONS = {interval: f'metrics_{interval}' for interval in ROLLUP_INTERVALS}
+BUCKET_FORMATS = {'day': '%Y-%m-%d', 'hour': '%Y-%m-%d %H:00', 'minute': '%Y-%m-%d %H:%M'}
+# Statistics a query may ask for besides percentiles ('p50', 'p99.9', ...), and the
+# response field each one is returned under
+STAT_FIELDS = {'avg': 'average_value', 'count': 'count', 'sum': 'sum', 'min': 'min', 'max': 'max'}
+# Rollup updates a bulk write failed on, by collection, waiting to be applied again
+_pending_lock = threading.Lock()
+_pending: List[Tuple[str, List[UpdateOne]]] = []
+
+
+def as_utc(timestamp: datetime) -> datetime:
+    if timestamp.tzinfo is None:
+        return timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.astimezone(timezone.utc)
+
+def bucket_start(timestamp: datetime, interval: str) -> datetime:
+    if interval == 'day':
+        return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    if interval == 'hour':
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    return timestamp.replace(second=0, microsecond=0)
+
+def coarsest_rollup(interval: str) -> str:
+    """Pick the coarsest rollup whose buckets nest exactly inside buckets of ``interval``."""
+    width = ROLLUP_INTERVALS[interval]
+    candidates = [rollup for rollup, size in ROLLUP_INTERVALS.items() if size <= width and width % size == timedelta(0)]
+    return max(candidates, key=ROLLUP_INTERVALS.get)
+
+def rollup_updates(docs: Iterable[Dict], interval: str) -> List[UpdateOne]:
+    """Combine points per (name, bucket) and turn them into $inc/$min/$max upserts.
+
+    The bucket's quantile sketch is kept up to date with the same $inc.
+    """
+    combined = {}
+    for doc in docs:
+        key = (doc['name'], bucket_start(doc['timestamp'], interval))
+        value = doc['value']
+        stats = combined.get(key)
+        if stats is None:
+            combined[key] = point_stats(value)
+        else:
+            merge_stats(stats, point_stats(value))
+    return [UpdateOne({'name': name, 'bucket': bucket},
+                      {'$inc': {'sum': stats['sum'], 'count': stats['count'],
+                                **{f'sketch.{key}': count for key, count in stats['sketch'].items()}},
+                       '$min': {'min': stats['min']}, '$max': {'max': stats['max']}},
+                      upsert=True)
+            for (name, bucket), stats in combined.items()]
+
+def update_rollups(docs: List[Dict], mongo: PyMongo) -> None:
+    """Fold stored points into every rollup collection.
+
+    The raw points are already stored, so a failed rollup write is not raised: the updates
+    it did not apply are kept and written again by retry_rollups(), which runs first here
+    and on every cache maintenance pass.
+    """
+    retry_rollups(mongo)
+    if not docs:
+        return
+    for interval, collection in ROLLUP_COLLECTIONS.items():
+        write_rollups(collection, rollup_updates(docs, interval), mongo)
+
+def write_rollups(collection: str, updates: List[UpdateOne], mongo: PyMongo) -> bool:
+    """Apply ``updates`` to ``collection``, keeping the ones that failed for retry_rollups()."""
+    try:
+        mongo.db[collection].bulk_write(updates, ordered=False)
+        return True
+    except BulkWriteError as e:
+        # Unordered: everything but the reported writes was applied
+        failed = [updates[err['index']] for err in e.details.get('writeErrors', [])]
+        error = e
+    except Exception as e:
+        failed, error = updates, e
+    logger.error(f'Failed to update {collection} rollups ({len(failed)} buckets kept for retry): {error}')
+    with _pending_lock:
+        _pending.append((collection, failed))
+    return False
+
+def retry_rollups(mongo: PyMongo) -> int:
+    """Write the rollup updates kept by failed writes again; returns how many batches are still pending."""
+    with _pending_lock:
+        if not _pending:
+            return 0
+        pending = list(_pending)
+        _pending.clear()
+    for collection, updates in pending:
+        write_rollups(collection, updates, mongo)
+    return pending_rollups()
+
+def pending_rollups() -> int:
+    with _pending_lock:
+        return len(_pending)
+
+def get_rollup_buckets(name: str, first_bucket: datetime, last_bucket: datetime, interval: str, mongo: PyMongo) -> Dict[datetime, Dict]:
+    """Return sum/count/min/max and the quantile sketch of ``name`` for each ``interval`` bucket
+    from ``first_bucket`` to ``last_bucket`` (inclusive bucket starts), read from the coarsest suitable rollup."""
+    return get_many_rollup_buckets([name], first_bucket, last_bucket, interval, mongo).get(name, {})
+
+def rollup_query(names: List[str], first_bucket: datetime, last_bucket: datetime, interval: str) -> Tuple[str, Dict]:
+    """Rollup collection and filter holding the ``interval`` buckets of ``names`` in a range."""
+    try:
+        upper = last_bucket + ROLLUP_INTERVALS[interval]
+        bucket_filter = {'$gte': first_bucket, '$lt': upper}
+    except OverflowError:
+        bucket_filter = {'$gte': first_bucket}
+    name_filter = names[0] if len(names) == 1 else {'$in': names}
+    return ROLLUP_COLLECTIONS[coarsest_rollup(interval)], {'name': name_filter, 'bucket': bucket_filter}
+
+def get_many_rollup_buckets(names: List[str], first_bucket: datetime, last_bucket: datetime, interval: str,
+                            mongo: PyMongo) -> Dict[str, Dict[datetime, Dict]]:
+    """get_rollup_buckets for several series in one ``$in`` query, grouped by (name, bucket)."""
+    collection, query = rollup_query(names, first_bucket, last_bucket, interval)
+    series = {}
+    for doc in mongo.db[collection].find(query, {'name': 1, 'bucket': 1, 'sum': 1, 'count': 1, 'min': 1, 'max': 1, 'sketch': 1}):
+        buckets = series.setdefault(doc['name'], {})
+        bucket = bucket_start(as_utc(doc['bucket']), interval)
+        doc.setdefault('sketch', {})
+        stats = buckets.get(bucket)
+        if stats is None:
+            buckets[bucket] = {'sum': doc['sum'], 'count': doc['count'], 'min': doc['min'], 'max': doc['max'],
+                               'sketch': dict(doc['sketch'])}
+        else:
+            merge_stats(stats, doc)
+    return series
+
+def point_stats(value: float) -> Dict:
+    stats = {'sum': value, 'count': 1, 'min': value, 'max': value, 'sketch': {}}
+    sketch_add(stats['sketch'], value)
+    return stats
+
+def merge_stats(stats: Dict, other: Dict) -> None:
+    stats['sum'] += other['sum']
+    stats['count'] += other['count']
+    stats['min'] = min(stats['min'], other['min'])
+    stats['max'] = max(stats['max'], other['max'])
+    sketch_merge(stats['sketch'], other['sketch'])
+
+def percentile(stat: str) -> Optional[float]:
+    """The quantile (0-1) named by a ``pNN`` statistic, or None if ``stat`` is not a percentile."""
+    if not stat.startswith('p'):
+        return None
+    try:
+        q = float(stat[1:]) / 100
+    except ValueError:
+        return None
+    return q if 0 <= q <= 1 else None
+
+def stat_field(stat: str) -> str:
+    return STAT_FIELDS.get(stat, stat)
+
+def stat_value(stats: Dict, stat: str) -> Optional[float]:
+    if stat == 'avg':
+        return stats['sum'] / stats['count']
+    if stat in STAT_FIELDS:
+        return stats[stat]
+    return sketch_quantile(stats['sketch'], percentile(stat))
+
+def format_buckets(buckets: Dict[datetime, Dict], interval: str, stats: Iterable[str] = ('avg',)) -> List[Dict]:
+    """Render buckets in the shape returned by get_metrics_data, ordered by bucket,
+    with one field per requested statistic (see STAT_FIELDS; percentiles keep their name)."""
+    date_format = BUCKET_FORMATS[interval]
+    fields = [(stat, stat_field(stat)) for stat in stats]
+    return [{'_id': bucket.strftime(date_format), **{field: stat_value(values, stat) for stat, field in fields}}
+            for bucket, values in sorted(buckets.items()) if values['count']]
+
+def series_extent(name: Union[str, List[str]], interval: str, mongo: PyMongo) -> Optional[Tuple[datetime, datetime]]:
+    """First and last bucket start holding data for ``name`` (or any of a list of names), at ``interval`` precision."""
+    collection = mongo.db[ROLLUP_COLLECTIONS[coarsest_rollup(interval)]]
+    name_filter = {'$in': name} if isinstance(name, list) else name
+    first = collection.find_one({'name': name_filter}, {'bucket': 1}, sort=[('bucket', ASCENDING)])
+    if first is None:
+        return None
+    last = collection.find_one({'name': name_filter}, {'bucket': 1}, sort=[('bucket', DESCENDING)])
+    return bucket_start(as_utc(first['bucket']), interval), bucket_start(as_utc(last['bucket']), interval)
+
+def ensure_rollup_indexes(db) -> None:
+    for collection in ROLLUP_COLLECTIONS.values():
+        db[collection].create_index([('name', ASCENDING), ('bucket', ASCENDING)], unique=True)
+
+def _sketch_key_expression(value: str) -> Dict:
+    """Aggregation expression computing sketch.sketch_key of a numeric field."""
+    def index(magnitude):
+        return {'$toString': {'$toLong': {'$ceil': {'$divide': [{'$ln': magnitude}, LOG_GAMMA]}}}}
+    return {'$switch': {'branches': [
+        {'case': {'$gt': [value, MIN_INDEXABLE_VALUE]}, 'then': {'$concat': ['p', index(value)]}},
+        {'case': {'$lt': [value, -MIN_INDEXABLE_VALUE]}, 'then': {'$concat': ['n', index({'$abs': value})]}},
+    ], 'default': 'z'}}
+
+def rebuild_rollups(db, name: Optional[str] = None, raw_collection: str = 'metrics') -> None:
+    """Recompute every rollup collection from raw metrics, replacing existing buckets.
+
+    The minute rollup is built from ``raw_collection``; each coarser rollup is then built from
+    the one before it, so raw points are scanned only once. Sketches are merged in a
+    second pass per collection. Requires MongoDB 5.0+.
+    """
+    ensure_rollup_indexes(db)
+    source = raw_collection
+    for interval, collection in ROLLUP_COLLECTIONS.items():
+        raw = source == raw_collection
+        time_field = '$timestamp' if raw else '$bucket'
+        match = {'$match': {'name': name} if name else {}}
+        bucket = {'$dateTrunc': {'date': time_field, 'unit': interval}}
+        pipeline = [
+            match,
+            {'$group': {
+                '_id': {'name': '$name', 'bucket': bucket},
+                'sum': {'$sum': '$value' if raw else '$sum'},
+                'count': {'$sum': 1 if raw else '$count'},
+                'min': {'$min': '$value' if raw else '$min'},
+                'max': {'$max': '$value' if raw else '$max'},
+            }},
+            {'$project': {'_id': 0, 'name': '$_id.name', 'bucket': '$_id.bucket', 'sum': 1, 'count': 1, 'min': 1, 'max': 1}},
+            {'$merge': {'into': collection, 'on': ['name', 'bucket'], 'whenMatched': 'replace', 'whenNotMatched': 'insert'}},
+        ]
+        db[source].aggregate(pipeline, allowDiskUse=True)
+        if raw:
+            entries = [{'$project': {'name': 1, 'bucket': bucket, 'entry': {'k': _sketch_key_expression('$value'), 'v': 1}}}]
+        else:
+            entries = [{'$project': {'name': 1, 'bucket': bucket, 'entry': {'$objectToArray': {'$ifNull': ['$sketch', {}]}}}},
+                       {'$unwind': '$entry'}]
+        sketch_pipeline = [
+            match,
+            *entries,
+            {'$group': {'_id': {'name': '$name', 'bucket': '$bucket', 'k': '$entry.k'}, 'v': {'$sum': '$entry.v'}}},
+            {'$group': {'_id': {'name': '$_id.name', 'bucket': '$_id.bucket'}, 'sketch': {'$push': {'k': '$_id.k', 'v': '$v'}}}},
+            {'$project': {'_id': 0, 'name': '$_id.name', 'bucket': '$_id.bucket', 'sketch': {'$arrayToObject': '$sketch'}}},
+            {'$merge': {'into': collection, 'on': ['name', 'bucket'], 'whenMatched': 'merge', 'whenNotMatched': 'insert'}},
+        ]
+        db[source].aggregate(sketch_pipeline, allowDiskUse=True)
+        source = collection
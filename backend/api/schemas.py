@@ -1,4 +1,4 @@
-from marshmallow import Schema, fields, validates, ValidationError, validates_schema
+from marshmallow import Schema, fields, validate, validates, ValidationError, validates_schema
 from datetime import datetime, timezone
 
 class MetricSchema(Schema):
@@ -14,6 +14,7 @@ class AggregatedMetricSchema(Schema):
         fields = ('_id', 'average_value')
 from marshmallow import Schema, fields, validates, ValidationError, validates_schema
 from datetime import datetime, timezone
+from api.rollups import STAT_FIELDS, percentile
 
 class MetricsRequestSchema(Schema):
     name = fields.Str(required=True)
@@ -21,6 +22,10 @@ class MetricsRequestSchema(Schema):
     endDate = fields.Str(allow_none=True)    # Allow null values
     interval = fields.Str(required=True)
     include_zeros = fields.Bool(missing=False)
+    max_points = fields.Int(allow_none=True, missing=None, validate=validate.Range(min=3))  # Downsample above this many buckets
+    downsample = fields.Str(missing='lttb', validate=validate.OneOf(['lttb', 'minmax']))
+    stats = fields.List(fields.Str(), missing=lambda: ['avg'], validate=validate.Length(min=1))  # e.g. ['avg', 'max', 'p95']
+    columnar = fields.Bool(missing=False)  # Socket.IO replies as binary column buffers (see api.encoding)
 
     @validates('interval')
     def validate_interval(self, value):
@@ -28,6 +33,13 @@ class MetricsRequestSchema(Schema):
         if value.lower() not in valid_intervals:
             raise ValidationError(f'Invalid interval. Supported intervals: {", ".join(valid_intervals)}')
 
+    @validates('stats')
+    def validate_stats(self, value):
+        invalid = [stat for stat in value if stat not in STAT_FIELDS and percentile(stat) is None]
+        if invalid:
+            raise ValidationError(f'Invalid statistics: {", ".join(invalid)}. '
+                                  f'Supported: {", ".join(STAT_FIELDS)} and percentiles such as p50, p95, p99.9')
+
     @validates_schema
     def validate_dates(self, data, **kwargs):
         start_date = (
@@ -43,3 +55,18 @@ class MetricsRequestSchema(Schema):
 
         if start_date > end_date:
             raise ValidationError("Start date must be less than or equal to end date.")
+
+class MultiMetricsRequestSchema(MetricsRequestSchema):
+    name = fields.Str(allow_none=True, missing=None)
+    names = fields.List(fields.Str(), validate=validate.Length(min=1))
+    pattern = fields.Str(validate=validate.Length(min=1))  # Glob such as 'cpu.*'
+
+    @validates_schema
+    def validate_selector(self, data, **kwargs):
+        if ('names' in data) == ('pattern' in data):
+            raise ValidationError("Provide exactly one of 'names' or 'pattern'.")
+
+class CatalogQuerySchema(Schema):
+    prefix = fields.Str(missing='')
+    after = fields.Str(missing=None)  # Last name of the previous page
+    limit = fields.Int(missing=None, validate=validate.Range(min=1, max=1000))
@@ -0,0 +1,121 @@
+import json
+import uuid
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional
+from bson import ObjectId
+from loguru import logger
+from api.cache import SeriesBuckets, SeriesKey, SeriesStore
+from api.rollups import ROLLUP_INTERVALS
+
+SERIES_KEY_PREFIX = 'metrics:series:'
+INVALIDATION_CHANNEL = 'metrics:points'
+
+
+def redis_client(url: str):
+    """Redis client for ``url``; redis-py is only needed when a shared cache is configured."""
+    import redis
+
+    return redis.Redis.from_url(url)
+
+def encode_series(series: SeriesBuckets) -> bytes:
+    return json.dumps({
+        'buckets': [[bucket.isoformat(), stats] for bucket, stats in series.buckets.items()],
+        'covered': [[lo.isoformat(), hi.isoformat()] for lo, hi in series.covered],
+        'high_water': str(series.high_water),
+    }).encode()
+
+def decode_series(data: bytes, interval: str) -> SeriesBuckets:
+    decoded = json.loads(data)
+    series = SeriesBuckets(ROLLUP_INTERVALS[interval])
+    series.buckets = {datetime.fromisoformat(bucket): stats for bucket, stats in decoded['buckets']}
+    series.covered = [[datetime.fromisoformat(lo), datetime.fromisoformat(hi)] for lo, hi in decoded['covered']]
+    series.high_water = ObjectId(decoded['high_water'])
+    return series
+
+
+class RedisSeriesStore(SeriesStore):
+    """Series kept as JSON strings in Redis, expiring ``ttl`` seconds after they were last written.
+
+    Redis' own maxmemory policy bounds the total size; failures are logged and treated as
+    misses so that a Redis outage only costs MongoDB queries.
+    """
+
+    def __init__(self, client, ttl: Optional[float] = 1800, prefix: str = SERIES_KEY_PREFIX):
+        self.client = client
+        self.ttl = int(ttl) if ttl else None
+        self.prefix = prefix
+
+    def get(self, key: SeriesKey) -> Optional[SeriesBuckets]:
+        try:
+            data = self.client.get(self._key(key))
+            return None if data is None else decode_series(data, key[1])
+        except Exception as e:
+            logger.error(f'Shared cache read failed for {key}: {e}')
+            return None
+
+    def set(self, key: SeriesKey, series: SeriesBuckets) -> None:
+        try:
+            self.client.set(self._key(key), encode_series(series), ex=self.ttl)
+        except Exception as e:
+            logger.error(f'Shared cache write failed for {key}: {e}')
+
+    def delete(self, keys: Iterable[SeriesKey]) -> None:
+        names = [self._key(key) for key in keys]
+        if not names:
+            return
+        try:
+            self.client.delete(*names)
+        except Exception as e:
+            logger.error(f'Shared cache invalidation failed: {e}')
+
+    def _key(self, key: SeriesKey) -> str:
+        name, interval = key
+        return f'{self.prefix}{interval}:{name}'
+
+
+class InvalidationBus:
+    """Broadcasts stored points to the other workers over Redis pub/sub.
+
+    Until connect() is called, publish() does nothing, which is the single-process setup.
+    Each worker ignores its own messages, since it already applied those points locally.
+    """
+
+    def __init__(self, channel: str = INVALIDATION_CHANNEL):
+        self.channel = channel
+        self.origin = uuid.uuid4().hex
+        self.client = None
+        self._thread = None
+
+    def connect(self, client, handler: Callable[[List[Dict]], None]) -> None:
+        self.close()
+        self.client = client
+        pubsub = client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.channel: lambda message: self._receive(message, handler)})
+        self._thread = pubsub.run_in_thread(sleep_time=0.1, daemon=True)
+
+    def publish(self, docs: List[Dict]) -> None:
+        if self.client is None or not docs:
+            return
+        # The _id lets receivers tell these points apart from raw inserts their refresher finds
+        points = [{'_id': str(doc['_id']), 'name': doc['name'], 'value': doc['value'], 'timestamp': doc['timestamp'].isoformat()}
+                  for doc in docs]
+        try:
+            self.client.publish(self.channel, json.dumps({'origin': self.origin, 'points': points}))
+        except Exception as e:
+            logger.error(f'Failed to publish {len(points)} points to {self.channel}: {e}')
+
+    def close(self) -> None:
+        if self._thread is not None:
+            self._thread.stop()
+            self._thread = None
+        self.client = None
+
+    def _receive(self, message: Dict, handler: Callable[[List[Dict]], None]) -> None:
+        try:
+            payload = json.loads(message['data'])
+            if payload['origin'] == self.origin:
+                return
+            handler([{'_id': ObjectId(point['_id']), 'name': point['name'], 'value': point['value'],
+                      'timestamp': datetime.fromisoformat(point['timestamp'])} for point in payload['points']])
+        except Exception as e:
+            logger.error(f'Failed to apply points from {self.channel}: {e}')
@@ -0,0 +1,46 @@
+import math
+from typing import Dict, Optional
+
+# Mergeable quantile sketch in the style of DDSketch: values are counted in logarithmic
+# buckets so that any quantile is estimated within RELATIVE_ACCURACY of the true value.
+# A sketch is a plain dict of bucket key -> count ('p<i>' positive, 'n<i>' negative, 'z'
+# near zero), so rollup documents can maintain it with $inc and sketches merge by addition.
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+MIN_INDEXABLE_VALUE = 1e-9
+
+
+def sketch_key(value: float) -> str:
+    if value > MIN_INDEXABLE_VALUE:
+        return f'p{math.ceil(math.log(value) / LOG_GAMMA)}'
+    if value < -MIN_INDEXABLE_VALUE:
+        return f'n{math.ceil(math.log(-value) / LOG_GAMMA)}'
+    return 'z'
+
+def sketch_add(sketch: Dict[str, int], value: float, count: int = 1) -> None:
+    key = sketch_key(value)
+    sketch[key] = sketch.get(key, 0) + count
+
+def sketch_merge(sketch: Dict[str, int], other: Dict[str, int]) -> None:
+    for key, count in other.items():
+        sketch[key] = sketch.get(key, 0) + count
+
+def _key_value(key: str) -> float:
+    if key == 'z':
+        return 0.0
+    magnitude = 2 * GAMMA ** int(key[1:]) / (GAMMA + 1)
+    return magnitude if key[0] == 'p' else -magnitude
+
+def sketch_quantile(sketch: Dict[str, int], q: float) -> Optional[float]:
+    """Estimate the ``q`` quantile (0 <= q <= 1) of the values counted in ``sketch``."""
+    total = sum(sketch.values())
+    if not total:
+        return None
+    rank = q * (total - 1)
+    seen = 0
+    for key in sorted(sketch, key=_key_value):
+        seen += sketch[key]
+        if seen > rank:
+            return _key_value(key)
+    return _key_value(max(sketch, key=_key_value))
@@ -0,0 +1,130 @@
+from typing import Dict, List, Optional
+from bson import ObjectId
+from pymongo import ASCENDING
+from pymongo.collection import Collection
+from pymongo.command_cursor import CommandCursor
+from pymongo.cursor import Cursor
+from pymongo.errors import CollectionInvalid
+from pymongo.results import InsertManyResult
+
+STORAGE_BACKENDS = ('documents', 'timeseries')
+TIMESERIES_GRANULARITIES = ('seconds', 'minutes', 'hours')
+
+
+class MetricStore:
+    """Raw metric points kept as one document per point in a regular collection.
+
+    Every read and write of raw points goes through the store, so the layout can change
+    without touching the query code. Stores take the database (``mongo.db``) they act on.
+    """
+
+    backend = 'documents'
+
+    def __init__(self, collection: str = 'metrics'):
+        self.collection_name = collection
+
+    def collection(self, db) -> Collection:
+        return db[self.collection_name]
+
+    def ensure(self, db) -> None:
+        """Create what the store needs. Indexes of the documents layout come from manage_indexes.py."""
+
+    def insert_many(self, db, docs: List[Dict]) -> InsertManyResult:
+        """Unordered insert; raises BulkWriteError with per-document errors like insert_many."""
+        return self.collection(db).insert_many(docs, ordered=False)
+
+    def aggregate(self, db, pipeline: List[Dict], **kwargs) -> CommandCursor:
+        return self.collection(db).aggregate(pipeline, **kwargs)
+
+    def find_since(self, db, high_waters: Dict[str, ObjectId]) -> Cursor:
+        """Points of each name inserted after its ``high_waters`` ObjectId (ids are assigned client-side)."""
+        return self.collection(db).find({'$or': [{'name': name, '_id': {'$gt': high_water}}
+                                                 for name, high_water in high_waters.items()]},
+                                        {'name': 1, 'value': 1, 'timestamp': 1})
+
+    def describe(self) -> Dict:
+        return {'backend': self.backend, 'collection': self.collection_name}
+
+
+class TimeSeriesMetricStore(MetricStore):
+    """Raw metric points in a native MongoDB time-series collection (MongoDB 5.0+).
+
+    MongoDB groups the points of each name (the metaField) into compressed buckets, so a
+    point costs a fraction of a document's storage and range scans read far fewer pages.
+    ``granularity`` should match how often a series is written: 'seconds' for sub-minute
+    samples, 'minutes' or 'hours' for sparser ones.
+    """
+
+    backend = 'timeseries'
+
+    def __init__(self, collection: str = 'metrics_ts', granularity: str = 'seconds'):
+        super().__init__(collection)
+        if granularity not in TIMESERIES_GRANULARITIES:
+            raise ValueError(f'Invalid time-series granularity {granularity!r}; expected one of {TIMESERIES_GRANULARITIES}')
+        self.granularity = granularity
+
+    def ensure(self, db) -> None:
+        try:
+            db.create_collection(self.collection_name, timeseries={
+                'timeField': 'timestamp', 'metaField': 'name', 'granularity': self.granularity})
+        except CollectionInvalid:
+            pass  # Already created
+        # The secondary index on (meta, time) serves the name-plus-range queries
+        self.collection(db).create_index([('name', ASCENDING), ('timestamp', ASCENDING)])
+
+    def describe(self) -> Dict:
+        return {**super().describe(), 'granularity': self.granularity}
+
+
+def create_metric_store(backend: str = 'documents', collection: Optional[str] = None,
+                        granularity: str = 'seconds') -> MetricStore:
+    """The store for a METRICS_STORAGE setting: 'documents' (default) or 'timeseries'."""
+    if backend == 'documents':
+        return MetricStore(collection or 'metrics')
+    if backend == 'timeseries':
+        return TimeSeriesMetricStore(collection or 'metrics_ts', granularity)
+    raise ValueError(f'Invalid metrics storage backend {backend!r}; expected one of {STORAGE_BACKENDS}')
+
+def store_from_config(config) -> MetricStore:
+    return create_metric_store(config.get('METRICS_STORAGE', 'documents'), config.get('METRICS_COLLECTION'),
+                               config.get('METRICS_TIMESERIES_GRANULARITY', 'seconds'))
+
+def storage_stats(db, collection: str) -> Dict:
+    """On-disk footprint of a collection from collStats (not supported by mongomock)."""
+    stats = db.command('collStats', collection)
+    return {'count': stats.get('count'), 'size': stats.get('size'), 'storage_size': stats.get('storageSize'),
+            'index_size': stats.get('totalIndexSize')}
+
+def copy_points(db, source: MetricStore, target: MetricStore, batch_size: int = 10000,
+                after: Optional[ObjectId] = None, progress=None) -> int:
+    """Copy every point of ``source`` with an _id above ``after`` into ``target``, in _id order.
+
+    Points keep their _id, so cache high-water marks stay valid after switching stores.
+    ``progress`` is called with the last copied _id after each batch, to resume from it.
+    Points whose _id is already in ``target`` (from an interrupted batch) are skipped, and
+    nothing is removed from ``target``, so a rerun after the app has started writing there
+    is safe. Returns the number copied.
+    """
+    target.ensure(db)
+    query = {'_id': {'$gt': after}} if after is not None else {}
+    copied = 0
+    batch = []
+    for doc in source.collection(db).find(query, {'name': 1, 'value': 1, 'timestamp': 1}).sort('_id', ASCENDING):
+        batch.append(doc)
+        if len(batch) == batch_size:
+            copied += _copy_batch(db, target, batch, progress)
+            batch = []
+    if batch:
+        copied += _copy_batch(db, target, batch, progress)
+    return copied
+
+def _copy_batch(db, target: MetricStore, batch: List[Dict], progress) -> int:
+    # A range on _id rather than $in, so a time-series target can prune its buckets
+    existing = {doc['_id'] for doc in target.collection(db).find(
+        {'_id': {'$gte': batch[0]['_id'], '$lte': batch[-1]['_id']}}, {'_id': 1})}
+    missing = [doc for doc in batch if doc['_id'] not in existing]
+    if missing:
+        target.insert_many(db, missing)
+    if progress is not None:
+        progress(batch[-1]['_id'])
+    return len(missing)
@@ -0,0 +1,139 @@
+import threading
+import uuid
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from api.rollups import as_utc, bucket_start
+
+# (name, interval, startDate, endDate, options) as sent by the client; None dates are open-ended.
+# options holds what shapes the rendered series: (stats, include_zeros, max_points, downsample)
+SubscriptionKey = Tuple[str, str, Optional[str], Optional[str], Tuple]
+
+
+def subscription_key(data: Dict) -> SubscriptionKey:
+    """Identity of a subscription for a request validated by MetricsRequestSchema."""
+    options = (tuple(data.get('stats') or ('avg',)), bool(data.get('include_zeros')),
+               data.get('max_points'), data.get('downsample', 'lttb'))
+    return data['name'], data['interval'], data.get('startDate'), data.get('endDate'), options
+
+def subscription_request(key: SubscriptionKey) -> Dict:
+    """The MetricsRequestSchema-shaped request a subscription stands for."""
+    name, interval, start, end, (stats, include_zeros, max_points, method) = key
+    return {'name': name, 'interval': interval, 'startDate': start, 'endDate': end, 'stats': list(stats),
+            'include_zeros': include_zeros, 'max_points': max_points, 'downsample': method}
+
+def _parse_date(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value).replace(tzinfo=timezone.utc) if value else None
+
+
+class SubscriptionIndex:
+    """Which Socket.IO clients watch which (name, interval, window), for targeted fan-out.
+
+    Every subscription maps to one room. Lookups go through the metric name, so finding the
+    rooms affected by a point costs the number of subscriptions to that metric, however many
+    clients are connected. The index also coalesces changes: points mark the buckets they
+    touch per subscription, and drain() hands them over once per push tick, each delta
+    getting the next sequence number of its room.
+
+    Room names carry a per-index ``scope``: with a Socket.IO message queue every worker keeps
+    its own index and sequence numbers, so rooms must not be shared between workers.
+    """
+
+    def __init__(self, scope: Optional[str] = None):
+        self.scope = scope or uuid.uuid4().hex[:8]
+        self._lock = threading.Lock()
+        self._windows: Dict[str, Dict[SubscriptionKey, Tuple[Optional[datetime], Optional[datetime]]]] = {}
+        self._members: Dict[SubscriptionKey, Set[str]] = {}
+        self._by_sid: Dict[str, Set[SubscriptionKey]] = {}
+        self._dirty: Dict[SubscriptionKey, Set[datetime]] = {}
+        self._sequences: Dict[SubscriptionKey, int] = {}
+
+    def room(self, key: SubscriptionKey) -> str:
+        name, interval, start, end, (stats, include_zeros, max_points, method) = key
+        return (f'metrics:{self.scope}:{name}|{interval}|{start or ""}|{end or ""}|{",".join(stats)}|'
+                f'{int(include_zeros)}|{max_points or ""}|{method}')
+
+    def subscribe(self, sid: str, key: SubscriptionKey) -> str:
+        name, interval, start, end, _ = key
+        start_date, end_date = _parse_date(start), _parse_date(end)
+        window = (start_date and bucket_start(start_date, interval), end_date and bucket_start(end_date, interval))
+        with self._lock:
+            self._windows.setdefault(name, {})[key] = window
+            self._members.setdefault(key, set()).add(sid)
+            self._by_sid.setdefault(sid, set()).add(key)
+            self._sequences.setdefault(key, 0)
+        return self.room(key)
+
+    def unsubscribe(self, sid: str, key: SubscriptionKey) -> Optional[str]:
+        with self._lock:
+            if key not in self._by_sid.get(sid, ()):
+                return None
+            self._remove(sid, key)
+        return self.room(key)
+
+    def drop(self, sid: str) -> List[str]:
+        """Forget every subscription of a disconnected client; returns the rooms it left."""
+        with self._lock:
+            keys = list(self._by_sid.get(sid, ()))
+            for key in keys:
+                self._remove(sid, key)
+        return [self.room(key) for key in keys]
+
+    def keys_for_point(self, name: str, timestamp: datetime) -> List[SubscriptionKey]:
+        """Subscriptions whose window contains the bucket of a point of ``name`` at ``timestamp``."""
+        timestamp = as_utc(timestamp)
+        with self._lock:
+            windows = list(self._windows.get(name, {}).items())
+        keys = []
+        for key, (first, last) in windows:
+            bucket = bucket_start(timestamp, key[1])
+            if (first is None or first <= bucket) and (last is None or bucket <= last):
+                keys.append(key)
+        return keys
+
+    def mark_points(self, docs: Iterable[Dict]) -> None:
+        """Record the buckets touched by ``docs`` for every subscription watching them."""
+        for doc in docs:
+            timestamp = as_utc(doc['timestamp'])
+            for key in self.keys_for_point(doc['name'], timestamp):
+                with self._lock:
+                    if key in self._members:
+                        self._dirty.setdefault(key, set()).add(bucket_start(timestamp, key[1]))
+
+    def drain(self) -> Dict[SubscriptionKey, Tuple[int, Set[datetime]]]:
+        """Take the pending changes: subscription -> (sequence number of the delta, changed buckets)."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            drained = {}
+            for key, buckets in dirty.items():
+                if key in self._sequences:
+                    self._sequences[key] += 1
+                    drained[key] = (self._sequences[key], buckets)
+            return drained
+
+    def sequence(self, key: SubscriptionKey) -> int:
+        """Sequence number of the last delta sent for ``key``; a snapshot is current as of it."""
+        with self._lock:
+            return self._sequences.get(key, 0)
+
+    def subscribers(self, key: SubscriptionKey) -> int:
+        with self._lock:
+            return len(self._members.get(key, ()))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._members)
+
+    def _remove(self, sid: str, key: SubscriptionKey) -> None:
+        self._by_sid[sid].discard(key)
+        if not self._by_sid[sid]:
+            del self._by_sid[sid]
+        members = self._members[key]
+        members.discard(sid)
+        if not members:
+            del self._members[key]
+            self._dirty.pop(key, None)
+            self._sequences.pop(key, None)
+            windows = self._windows[key[0]]
+            del windows[key]
+            if not windows:
+                del self._windows[key[0]]
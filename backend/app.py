@@ -9,6 +9,7 @@ from flask_login import LoginManager
 from flask_pymongo import PyMongo
 from loguru import logger
 import config
+from api.instrumentation import command_timer, init_instrumentation_module
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -24,17 +25,18 @@ CORS(app, supports_credentials=True, resources={r"/*": {
 }})
 
 
-mongo = PyMongo(app)
+mongo = PyMongo(app, event_listeners=[command_timer])
 jwt = JWTManager(app)
 login_manager = LoginManager(app)
 bcrypt = Bcrypt(app)  
 limiter = Limiter(app=app, key_func=get_remote_address)
-socketio = SocketIO(app, cors_allowed_origins='*')
+socketio = SocketIO(app, cors_allowed_origins='*', message_queue=app.config.get('SOCKETIO_MESSAGE_QUEUE'))
 # Import and initialize modules
 from api.auth import init_auth_module
-from api.metrics import init_metrics_module
+from api.metrics import ingest_self_metrics, init_metrics_module
 from api.books import init_books_module
 
+init_instrumentation_module(app, socketio, lambda readings: ingest_self_metrics(readings, mongo))
 init_auth_module(app, mongo, login_manager, bcrypt, limiter)
 init_metrics_module(app, mongo, socketio, login_manager)
 init_books_module(app, mongo, login_manager)
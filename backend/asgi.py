@@ -0,0 +1,15 @@
+"""asyncio serving mode: ``uvicorn asgi:application`` (requires uvicorn and asgiref).
+
+REST routes are served by the Flask app; Socket.IO runs on an AsyncServer, which also
+runs the cache refresher and the live update pusher.
+"""
+import os
+
+# Background tasks belong to the AsyncServer here, not to Flask-SocketIO
+os.environ.setdefault('METRICS_BACKGROUND_TASKS', 'false')
+
+from app import app, mongo  # noqa: E402
+from api.async_server import AsyncMetricsServer  # noqa: E402
+
+metrics_server = AsyncMetricsServer(app, mongo)
+application = metrics_server.asgi_app()
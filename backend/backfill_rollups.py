@@ -0,0 +1,23 @@
+import argparse
+from pymongo import MongoClient
+from api.catalog import rebuild_catalog
+from api.rollups import rebuild_rollups
+from api.storage import store_from_config
+from config import Config
+
+
+def backfill(name=None):
+    client = MongoClient(Config.MONGO_URI)
+    db = client.get_default_database()
+    raw_collection = store_from_config(vars(Config)).collection_name
+    rebuild_rollups(db, name, raw_collection)
+    print(f"Rollups rebuilt for {name or 'all metrics'}.")
+    if name is None:
+        rebuild_catalog(db, raw_collection)
+        print("Metric catalog rebuilt.")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build minute/hour/day rollups and the metric catalog from existing raw metrics.')
+    parser.add_argument('--name', help='Only rebuild rollups for this metric name')
+    args = parser.parse_args()
+    backfill(args.name)
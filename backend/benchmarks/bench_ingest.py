@@ -0,0 +1,78 @@
+"""Compare ingest throughput of /metrics/log_metrics and /metrics/log_metrics_batch.
+
+Run from the backend directory:
+    python -m benchmarks.bench_ingest --points 20000
+    python -m benchmarks.bench_ingest --mongo-uri mongodb://localhost:27017/benchdb
+"""
+import argparse
+import json
+import time
+from datetime import datetime, timedelta, timezone
+from flask import Flask
+from flask_login import LoginManager
+from flask_socketio import SocketIO
+from api.metrics import init_metrics_module
+
+
+def create_app(mongo_uri=None):
+    app = Flask(__name__)
+    app.config['TESTING'] = True
+    app.config['SECRET_KEY'] = 'bench_secret_key'
+    if mongo_uri:
+        from flask_pymongo import PyMongo
+        mongo = PyMongo(app, uri=mongo_uri)
+    else:
+        from mongomock import MongoClient
+        mongo = MongoClient()
+    socketio = SocketIO(app, cors_allowed_origins='*')
+    init_metrics_module(app, mongo, socketio, LoginManager(app))
+    return app, mongo
+
+def make_points(n, names=10):
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    return [{'name': f'bench_metric_{i % names}', 'value': float(i % 997),
+             'timestamp': (start + timedelta(seconds=i)).isoformat()} for i in range(n)]
+
+def bench_single(client, points):
+    started = time.perf_counter()
+    for point in points:
+        client.post('/metrics/log_metrics', json={'name': point['name'], 'value': point['value']})
+    return time.perf_counter() - started
+
+def bench_batch(client, points, batch_size):
+    started = time.perf_counter()
+    for offset in range(0, len(points), batch_size):
+        client.post('/metrics/log_metrics_batch', json=points[offset:offset + batch_size])
+    return time.perf_counter() - started
+
+def bench_ndjson(client, points, batch_size):
+    started = time.perf_counter()
+    for offset in range(0, len(points), batch_size):
+        body = '\n'.join(json.dumps(point) for point in points[offset:offset + batch_size])
+        client.post('/metrics/log_metrics_batch', data=body, content_type='application/x-ndjson')
+    return time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--points', type=int, default=10000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--mongo-uri', default=None, help='Benchmark against a real MongoDB instead of mongomock')
+    args = parser.parse_args()
+
+    points = make_points(args.points)
+    results = {}
+    for label, run in (('single', lambda c: bench_single(c, points)),
+                       ('batch_json', lambda c: bench_batch(c, points, args.batch_size)),
+                       ('batch_ndjson', lambda c: bench_ndjson(c, points, args.batch_size))):
+        app, mongo = create_app(args.mongo_uri)
+        mongo.db.metrics.delete_many({'name': {'$regex': '^bench_metric_'}})
+        with app.test_client() as client:
+            elapsed = run(client)
+        results[label] = args.points / elapsed
+        print(f'{label:>14}: {results[label]:>12,.0f} points/sec ({elapsed:.2f}s)')
+        mongo.db.metrics.delete_many({'name': {'$regex': '^bench_metric_'}})
+    print(f'{"speedup":>14}: {results["batch_json"] / results["single"]:.1f}x (JSON), '
+          f'{results["batch_ndjson"] / results["single"]:.1f}x (NDJSON)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Compare the document and time-series storage backends: on-disk size and range-aggregation latency.
+
+Needs a real MongoDB 5.0+ (mongomock has neither time-series collections nor collStats).
+Run from the backend directory:
+    python -m benchmarks.bench_storage --points 500000
+    python -m benchmarks.bench_storage --mongo-uri mongodb://localhost:27017/benchdb --granularity minutes
+"""
+import argparse
+import statistics
+import time
+from datetime import datetime, timedelta, timezone
+from pymongo import MongoClient
+from api.storage import MetricStore, TIMESERIES_GRANULARITIES, TimeSeriesMetricStore, storage_stats
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def range_pipeline(name, start, end, interval):
+    """Average and maximum per bucket of one series over a range of raw points."""
+    date_format = {'day': '%Y-%m-%d', 'hour': '%Y-%m-%d %H:00', 'minute': '%Y-%m-%d %H:%M'}[interval]
+    return [{'$match': {'name': name, 'timestamp': {'$gte': start, '$lte': end}}},
+            {'$group': {'_id': {'$dateToString': {'format': date_format, 'date': '$timestamp'}},
+                        'average_value': {'$avg': '$value'}, 'max': {'$max': '$value'}}},
+            {'$sort': {'_id': 1}}]
+
+def make_points(n, names, step):
+    for i in range(n):
+        yield {'name': f'bench_metric_{i % names}', 'value': float(i % 997), 'timestamp': START + timedelta(seconds=step * (i // names))}
+
+def load(db, store, points, batch_size):
+    started = time.perf_counter()
+    batch = []
+    for point in points:
+        batch.append(point)
+        if len(batch) == batch_size:
+            store.insert_many(db, batch)
+            batch = []
+    if batch:
+        store.insert_many(db, batch)
+    return time.perf_counter() - started
+
+def time_range_queries(db, store, names, span, interval, repeats):
+    timings = []
+    for i in range(repeats):
+        name = f'bench_metric_{i % names}'
+        pipeline = range_pipeline(name, START, START + span, interval)
+        started = time.perf_counter()
+        list(store.aggregate(db, pipeline))
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings), max(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--points', type=int, default=200000)
+    parser.add_argument('--names', type=int, default=10)
+    parser.add_argument('--step', type=int, default=10, help='Seconds between two points of a series')
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--granularity', default='seconds', choices=TIMESERIES_GRANULARITIES)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--mongo-uri', default='mongodb://localhost:27017/benchdb')
+    args = parser.parse_args()
+
+    db = MongoClient(args.mongo_uri).get_default_database()
+    span = timedelta(seconds=args.step * args.points // args.names)
+    stores = (MetricStore('bench_documents'), TimeSeriesMetricStore('bench_timeseries', args.granularity))
+    try:
+        for store in stores:
+            db.drop_collection(store.collection_name)
+            store.ensure(db)
+        # The documents layout gets the indexes of the latest migration, like a migrated deployment
+        db.bench_documents.create_index([('name', 1), ('timestamp', 1)])
+        db.bench_documents.create_index([('timestamp', 1)])
+        print(f'{args.points:,} points, {args.names} series, one point every {args.step}s per series')
+        for store in stores:
+            elapsed = load(db, store, make_points(args.points, args.names, args.step), args.batch_size)
+            stats = storage_stats(db, store.collection_name)
+            full_median, full_max = time_range_queries(db, store, args.names, span, 'hour', args.repeats)
+            day_median, _ = time_range_queries(db, store, args.names, timedelta(days=1), 'minute', args.repeats)
+            print(f'{store.backend:>11}: load {args.points / elapsed:>10,.0f} points/sec, '
+                  f'storage {stats["storage_size"] / 1e6:>8.1f} MB + indexes {stats["index_size"] / 1e6:>7.1f} MB, '
+                  f'full-range hourly {full_median * 1000:>7.1f} ms (max {full_max * 1000:.1f}), '
+                  f'one day by minute {day_median * 1000:>7.1f} ms')
+    finally:
+        for store in stores:
+            db.drop_collection(store.collection_name)
+
+if __name__ == '__main__':
+    main()
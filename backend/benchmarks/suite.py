@@ -0,0 +1,275 @@
+"""Benchmark suite over a synthetic workload, writing JSON results that can be compared between commits.
+
+Benchmarks: ingest throughput (log_metrics, log_metrics_batch), aggregation latency per
+interval and window (get_metrics_data, cold and cached), cache hit rate under a skewed
+dashboard query mix, fill_missing_dates, and Socket.IO fan-out of live updates. The
+workload (see benchmarks.workload) is reproducible from its parameters and seed.
+
+Run from the backend directory against a local mongod (only bench_metric_* data is touched):
+    python -m benchmarks.suite --output results-base.json
+    python -m benchmarks.suite --output results-new.json --compare results-base.json
+    python -m benchmarks.suite --mongomock --points 5000 --only ingest aggregate   # quick smoke run
+The exit status is 1 when --compare finds a regression beyond --threshold.
+"""
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional
+import numpy as np
+from api import metrics
+from api.buckets import fill_missing_dates
+from api.catalog import CATALOG_COLLECTION, bump_catalog_version
+from api.rollups import ROLLUP_COLLECTIONS, bucket_start
+from api.schemas import MetricsRequestSchema
+from benchmarks.bench_ingest import create_app
+from benchmarks.workload import Workload
+
+BENCHMARKS = ('ingest', 'aggregate', 'cache', 'fill', 'fanout')
+# Windows per interval, ending at the end of the workload
+WINDOWS = {'minute': (timedelta(hours=1), timedelta(days=1)),
+           'hour': (timedelta(days=1), timedelta(days=7)),
+           'day': (timedelta(days=30), timedelta(days=365))}
+
+
+def latency(timings: List[float]) -> Dict:
+    """Median latency in milliseconds, with the spread of the runs."""
+    ms = sorted(t * 1000 for t in timings)
+    return {'value': round(statistics.median(ms), 4), 'unit': 'ms', 'better': 'lower',
+            'p95': round(ms[min(len(ms) - 1, int(0.95 * len(ms)))], 4), 'min': round(ms[0], 4), 'runs': len(ms)}
+
+def throughput(count: int, elapsed: float, unit: str = 'points/s') -> Dict:
+    return {'value': round(count / elapsed, 2), 'unit': unit, 'better': 'higher', 'count': count,
+            'seconds': round(elapsed, 4)}
+
+def timed(fn: Callable[[], object], repeats: int) -> List[float]:
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return timings
+
+def clear_bench_data(mongo) -> None:
+    query = {'name': {'$regex': '^bench_metric_'}}
+    for collection in (metrics.metric_store.collection_name, *ROLLUP_COLLECTIONS.values()):
+        mongo.db[collection].delete_many(query)
+    mongo.db[CATALOG_COLLECTION].delete_many({'_id': {'$regex': '^bench_metric_'}})
+    bump_catalog_version(mongo.db)
+    clear_caches()
+
+def clear_caches() -> None:
+    metrics.metric_cache.clear()
+    metrics.downsample_cache.clear()
+    metrics.metric_catalog.invalidate()
+
+def load_workload(client, workload: Workload, batch_size: int) -> float:
+    batch = []
+    started = time.perf_counter()
+    for record in workload.records():
+        batch.append(record)
+        if len(batch) == batch_size:
+            client.post('/metrics/log_metrics_batch', json=batch)
+            batch = []
+    if batch:
+        client.post('/metrics/log_metrics_batch', json=batch)
+    return time.perf_counter() - started
+
+def metrics_request(name: str, interval: str, start: datetime, end: datetime) -> Dict:
+    return MetricsRequestSchema().load({'name': name, 'interval': interval, 'include_zeros': False,
+                                        'startDate': start.replace(tzinfo=None).isoformat(),
+                                        'endDate': end.replace(tzinfo=None).isoformat()})
+
+def bench_ingest(app, mongo, workload: Workload, batch_size: int, single_points: int) -> Dict:
+    results = {}
+    clear_bench_data(mongo)
+    with app.test_client() as client:
+        started = time.perf_counter()
+        for record in list(workload.records())[:single_points]:
+            client.post('/metrics/log_metrics', json={'name': record['name'], 'value': record['value']})
+        if app.extensions.get('metrics_ingest') is not None:
+            app.extensions['metrics_ingest'].flush()
+        results['ingest.log_metrics'] = throughput(single_points, time.perf_counter() - started)
+        clear_bench_data(mongo)
+        results['ingest.log_metrics_batch'] = throughput(workload.points, load_workload(client, workload, batch_size))
+    return results
+
+def bench_aggregate(mongo, workload: Workload, repeats: int) -> Dict:
+    """Latency of get_metrics_data for the most popular series: cold (caches cleared) and warm."""
+    results = {}
+    end = workload.start + workload.span()
+    name = workload.hot_names(1)[0]
+    for interval, windows in WINDOWS.items():
+        for window in windows:
+            data = metrics_request(name, interval, end - window, end)
+            label = f'aggregate.{interval}.{window.days}d' if window.days else f'aggregate.{interval}.{window.seconds // 3600}h'
+
+            def cold():
+                clear_caches()
+                metrics.get_metrics_data(data, mongo)
+
+            results[f'{label}.cold'] = latency(timed(cold, repeats))
+            results[f'{label}.warm'] = latency(timed(lambda: metrics.get_metrics_data(data, mongo), repeats))
+    return results
+
+def bench_cache(mongo, workload: Workload, queries: int) -> Dict:
+    """Hit rate and latency of a dashboard query mix: series by popularity, a few preset windows
+    whose end advances as time passes."""
+    rng = np.random.default_rng(workload.seed)
+    end = workload.start + workload.span()
+    presets = [(interval, window) for interval, windows in WINDOWS.items() for window in windows]
+    ranks = rng.choice(workload.names, size=queries, p=workload.popularity())
+    choices = rng.integers(len(presets), size=queries)
+    clear_caches()
+    timings = []
+    for i, (rank, choice) in enumerate(zip(ranks.tolist(), choices.tolist())):
+        interval, window = presets[choice]
+        query_end = end - timedelta(minutes=queries - i)
+        data = metrics_request(workload.name(rank), interval, query_end - window, query_end)
+        timings.extend(timed(lambda: metrics.get_metrics_data(data, mongo), 1))
+    stats = metrics.metric_cache.stats()['queries']
+    return {'cache.query': latency(timings),
+            'cache.hit_rate': {'value': stats['hit_rate'], 'unit': 'ratio', 'better': 'higher',
+                               'hits': stats['hits'], 'partial_hits': stats['partial_hits'], 'misses': stats['misses']}}
+
+def bench_fill(repeats: int) -> Dict:
+    """fill_missing_dates over a week of minute buckets of which one in ten holds data."""
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    end = start + timedelta(days=7)
+    data = [{'_id': (start + timedelta(minutes=m)).strftime('%Y-%m-%d %H:%M'), 'average_value': float(m)}
+            for m in range(0, 7 * 24 * 60, 10)]
+    return {'fill_missing_dates.minute.7d': latency(timed(lambda: fill_missing_dates(data, start, end, 'minute'), repeats))}
+
+def bench_fanout(app, mongo, workload: Workload, clients: int, ticks: int, points_per_tick: int) -> Dict:
+    """Socket.IO clients subscribed to the hot series; each tick stores new points and pushes the deltas."""
+    socketio = app.extensions['socketio']
+    end = workload.start + workload.span()
+    names = workload.hot_names(max(1, clients // 10))
+    subscribers = []
+    for i in range(clients):
+        subscriber = socketio.test_client(app)
+        subscriber.emit('subscribe_metrics', {'name': names[i % len(names)], 'interval': 'minute', 'include_zeros': False,
+                                              'startDate': (end - timedelta(hours=1)).replace(tzinfo=None).isoformat(),
+                                              'endDate': (end + timedelta(hours=1)).replace(tzinfo=None).isoformat()})
+        subscriber.get_received()
+        subscribers.append(subscriber)
+    rng = np.random.default_rng(workload.seed)
+    timings = []
+    delivered = 0
+    with app.test_client() as client:
+        for tick in range(ticks):
+            at = bucket_start(end, 'minute') + timedelta(seconds=tick)
+            client.post('/metrics/log_metrics_batch', json=[
+                {'name': names[int(rank)], 'value': float(value), 'timestamp': at.isoformat()}
+                for rank, value in zip(rng.integers(len(names), size=points_per_tick), rng.normal(500, 25, points_per_tick))])
+            timings.extend(timed(lambda: metrics.push_metric_updates(socketio, mongo), 1))
+            delivered += sum(len(subscriber.get_received()) for subscriber in subscribers)
+    for subscriber in subscribers:
+        subscriber.disconnect()
+    return {'fanout.push': {**latency(timings), 'clients': clients},
+            'fanout.deltas_per_tick': {'value': round(delivered / ticks, 2), 'unit': 'messages', 'better': 'higher'}}
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(base: Dict, new: Dict, threshold: float) -> List[Dict]:
+    """Per shared benchmark, the change of its value and whether it regressed by more than ``threshold``."""
+    rows = []
+    for key, result in new['results'].items():
+        previous = base['results'].get(key)
+        if previous is None or not previous['value']:
+            continue
+        change = result['value'] / previous['value'] - 1
+        worse = -change if result['better'] == 'higher' else change
+        rows.append({'benchmark': key, 'base': previous['value'], 'new': result['value'], 'unit': result['unit'],
+                     'change': round(change, 4), 'regression': worse > threshold})
+    return rows
+
+def run(args) -> Dict:
+    workload = Workload(points=args.points, names=args.names, skew=args.skew, rate=args.rate,
+                        late_fraction=args.late_fraction, seed=args.seed)
+    app, mongo = create_app(None if args.mongomock else args.mongo_uri)
+    if not args.mongomock:
+        from api.indexes import migrate
+        from api.storage import store_from_config
+        store = store_from_config(app.config)
+        migrate(mongo.db, raw_collection=store.collection_name, timeseries=store.backend == 'timeseries')
+    results = {}
+    selected = args.only or BENCHMARKS
+    if 'ingest' in selected:
+        results.update(bench_ingest(app, mongo, workload, args.batch_size, min(args.single_points, workload.points)))
+    elif {'aggregate', 'cache', 'fanout'} & set(selected):
+        clear_bench_data(mongo)
+        with app.test_client() as client:
+            load_workload(client, workload, args.batch_size)
+    if 'aggregate' in selected:
+        results.update(bench_aggregate(mongo, workload, args.repeats))
+    if 'cache' in selected:
+        results.update(bench_cache(mongo, workload, args.queries))
+    if 'fill' in selected:
+        results.update(bench_fill(args.repeats))
+    if 'fanout' in selected:
+        results.update(bench_fanout(app, mongo, workload, args.clients, args.ticks, args.points_per_tick))
+    clear_bench_data(mongo)
+    return {
+        'meta': {'revision': git_revision(), 'created': datetime.now(timezone.utc).isoformat(),
+                 'python': platform.python_version(), 'platform': platform.platform(),
+                 'database': 'mongomock' if args.mongomock else args.mongo_uri, 'workload': workload.describe()},
+        'results': results,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mongo-uri', default='mongodb://localhost:27017/benchdb')
+    parser.add_argument('--mongomock', action='store_true', help='Use mongomock instead of a mongod (smoke runs only)')
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, help='Benchmarks to run (default: all)')
+    parser.add_argument('--points', type=int, default=100000)
+    parser.add_argument('--names', type=int, default=200)
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent of metric name popularity')
+    parser.add_argument('--rate', type=float, default=0.2, help='Mean point arrivals per second')
+    parser.add_argument('--late-fraction', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--single-points', type=int, default=2000, help='Points posted one by one to log_metrics')
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--queries', type=int, default=500, help='Queries of the cache benchmark')
+    parser.add_argument('--clients', type=int, default=100, help='Socket.IO subscribers of the fan-out benchmark')
+    parser.add_argument('--ticks', type=int, default=20)
+    parser.add_argument('--points-per-tick', type=int, default=100)
+    parser.add_argument('--output', help='Write the JSON results here (default: stdout)')
+    parser.add_argument('--compare', help='Earlier results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative change counted as a regression')
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    for key, result in report['results'].items():
+        print(f"{key:>36}: {result['value']:>14,.4f} {result['unit']}", file=sys.stderr)
+    if args.compare:
+        with open(args.compare) as f:
+            base = json.load(f)
+        if base['meta']['workload'] != report['meta']['workload'] or base['meta']['database'] != report['meta']['database']:
+            print('Warning: the results come from different workloads or databases', file=sys.stderr)
+        rows = compare(base, report, args.threshold)
+        for row in rows:
+            flag = '  REGRESSION' if row['regression'] else ''
+            print(f"{row['benchmark']:>36}: {row['base']:>12,.4f} -> {row['new']:>12,.4f} {row['unit']} "
+                  f"({row['change']:+.1%}){flag}", file=sys.stderr)
+        if any(row['regression'] for row in rows):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
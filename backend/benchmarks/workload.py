@@ -0,0 +1,65 @@
+"""Reproducible synthetic metric workloads for the benchmarks.
+
+A workload is fully determined by its parameters and seed: metric names are drawn with a
+Zipf-like skew (a few hot series, a long tail), points arrive as a Poisson process at
+``rate`` points per second, and a ``late_fraction`` of them carry a timestamp up to
+``max_lateness`` seconds before their arrival, as buffered or retried writers produce.
+"""
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List
+import numpy as np
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+@dataclass(frozen=True)
+class Workload:
+    points: int = 100000
+    names: int = 200
+    skew: float = 1.1  # Zipf exponent of the name popularity; 0 spreads points evenly
+    rate: float = 0.2  # Mean arrivals per second; the defaults span almost six days
+    late_fraction: float = 0.05
+    max_lateness: float = 3600.0  # Seconds
+    seed: int = 42
+    start: datetime = START
+
+    def name(self, rank: int) -> str:
+        return f'bench_metric_{rank:04d}'
+
+    def popularity(self) -> np.ndarray:
+        """Probability of each name, most popular (rank 0) first."""
+        weights = 1.0 / np.arange(1, self.names + 1) ** self.skew
+        return weights / weights.sum()
+
+    def hot_names(self, count: int) -> List[str]:
+        return [self.name(rank) for rank in range(min(count, self.names))]
+
+    def generate(self) -> Dict[str, np.ndarray]:
+        """Columns of the workload in arrival order: name ranks, arrival and point timestamps
+        (seconds since ``start``) and values."""
+        rng = np.random.default_rng(self.seed)
+        ranks = rng.choice(self.names, size=self.points, p=self.popularity())
+        arrivals = np.cumsum(rng.exponential(1.0 / self.rate, size=self.points))
+        late = rng.random(self.points) < self.late_fraction
+        timestamps = np.maximum(arrivals - late * rng.uniform(0, self.max_lateness, size=self.points), 0)
+        # Each series wanders around its own level
+        levels = rng.uniform(0, 1000, size=self.names)
+        values = levels[ranks] + rng.normal(0, 25, size=self.points)
+        return {'ranks': ranks, 'arrivals': arrivals, 'timestamps': timestamps, 'values': values, 'late': late}
+
+    def records(self) -> Iterator[Dict]:
+        """Points as /metrics/log_metrics_batch records, in arrival order."""
+        columns = self.generate()
+        for rank, offset, value in zip(columns['ranks'].tolist(), columns['timestamps'].tolist(), columns['values'].tolist()):
+            yield {'name': self.name(rank), 'value': round(value, 3),
+                   'timestamp': (self.start + timedelta(seconds=offset)).isoformat()}
+
+    def span(self) -> timedelta:
+        """Time covered by the workload's arrivals."""
+        return timedelta(seconds=self.points / self.rate)
+
+    def describe(self) -> Dict:
+        return {'points': self.points, 'names': self.names, 'skew': self.skew, 'rate': self.rate,
+                'late_fraction': self.late_fraction, 'max_lateness': self.max_lateness, 'seed': self.seed,
+                'start': self.start.isoformat()}
@@ -7,3 +7,47 @@ class Config:
     FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:3000")
     SECRET_KEY = os.environ.get('SECRET_KEY', 'default_fallback_key')
     SESSION_TYPE = os.environ.get('SESSION_TYPE', 'filesystem')
+    INGEST_WRITE_BEHIND = os.getenv('INGEST_WRITE_BEHIND', 'true').lower() == 'true'
+    INGEST_FLUSH_SIZE = int(os.getenv('INGEST_FLUSH_SIZE', 500))
+    INGEST_FLUSH_INTERVAL = float(os.getenv('INGEST_FLUSH_INTERVAL', 1.0))
+    INGEST_MAX_QUEUE = int(os.getenv('INGEST_MAX_QUEUE', 50000))
+    INGEST_MAX_RETRIES = int(os.getenv('INGEST_MAX_RETRIES', 3))
+    METRICS_CACHE_MAX_SERIES = int(os.getenv('METRICS_CACHE_MAX_SERIES', 1000))
+    METRICS_CACHE_MAX_BYTES = int(os.getenv('METRICS_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+    METRICS_CACHE_TTL = float(os.getenv('METRICS_CACHE_TTL', 1800))
+    METRICS_MAX_BUCKETS = int(os.getenv('METRICS_MAX_BUCKETS', 600000))
+    METRICS_MAX_SERIES = int(os.getenv('METRICS_MAX_SERIES', 100))
+    METRICS_PUSH_INTERVAL = float(os.getenv('METRICS_PUSH_INTERVAL', 0.5))  # seconds between coalesced live updates
+    METRICS_CACHE_REFRESH_INTERVAL = float(os.getenv('METRICS_CACHE_REFRESH_INTERVAL', 300))
+    # Run cache maintenance on Flask-SocketIO's background tasks; asgi.py turns this off and runs them on asyncio
+    METRICS_BACKGROUND_TASKS = os.getenv('METRICS_BACKGROUND_TASKS', 'true').lower() == 'true'
+    # Share cached series and stored points between workers through Redis (e.g. redis://localhost:6379/0)
+    METRICS_REDIS_URL = os.getenv('METRICS_REDIS_URL')
+    # Socket.IO message queue so emits reach clients connected to any worker
+    SOCKETIO_MESSAGE_QUEUE = os.getenv('SOCKETIO_MESSAGE_QUEUE')
+    # Raw point storage: 'documents' (one document per point) or 'timeseries' (MongoDB 5.0+ time-series collection)
+    METRICS_STORAGE = os.getenv('METRICS_STORAGE', 'documents')
+    METRICS_COLLECTION = os.getenv('METRICS_COLLECTION')  # Defaults to metrics, or metrics_ts for timeseries
+    METRICS_TIMESERIES_GRANULARITY = os.getenv('METRICS_TIMESERIES_GRANULARITY', 'seconds')
+    # Latest points kept in memory per metric (16 bytes each; 0, the default, disables) and how many metrics
+    # are kept. Only enable it when every point reaches this worker: a single worker that is the only writer,
+    # or several with METRICS_REDIS_URL set and no points written straight to the raw collection.
+    METRICS_HOT_WINDOW_POINTS = int(os.getenv('METRICS_HOT_WINDOW_POINTS', 0))
+    METRICS_HOT_WINDOW_METRICS = int(os.getenv('METRICS_HOT_WINDOW_METRICS', 1000))
+    # Days raw points and minute/hour/day rollups are kept before MongoDB expires them (0 keeps forever).
+    # Applied to the collections with: python manage_indexes.py retention
+    METRICS_RETENTION_RAW_DAYS = float(os.getenv('METRICS_RETENTION_RAW_DAYS', 0))
+    METRICS_RETENTION_MINUTE_DAYS = float(os.getenv('METRICS_RETENTION_MINUTE_DAYS', 0))
+    METRICS_RETENTION_HOUR_DAYS = float(os.getenv('METRICS_RETENTION_HOUR_DAYS', 0))
+    METRICS_RETENTION_DAY_DAYS = float(os.getenv('METRICS_RETENTION_DAY_DAYS', 0))
+    # Users resolved for sessions and tokens are cached in memory for this many seconds
+    USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 60))
+    USER_CACHE_MAX_ENTRIES = int(os.getenv('USER_CACHE_MAX_ENTRIES', 10000))
+    USER_CACHE_MISS_TTL = float(os.getenv('USER_CACHE_MISS_TTL', 5))  # 0 looks unknown ids up every time
+    # Seconds the books collection version behind /books ETags is reused before it is read again
+    BOOKS_VERSION_TTL = float(os.getenv('BOOKS_VERSION_TTL', 5))
+    # Metrics responses at least this many bytes are brotli (if installed) or gzip compressed
+    METRICS_COMPRESS_MIN_BYTES = int(os.getenv('METRICS_COMPRESS_MIN_BYTES', 1024))
+    # Prometheus scrape endpoint, and seconds between self-ingests of the service's own readings as metrics (0 disables)
+    INSTRUMENTATION_PATH = os.getenv('INSTRUMENTATION_PATH', '/prometheus')
+    INSTRUMENTATION_SELF_INGEST_INTERVAL = float(os.getenv('INSTRUMENTATION_SELF_INGEST_INTERVAL', 0))
@@ -0,0 +1,59 @@
+import argparse
+from pymongo import MongoClient
+from api.indexes import advise, applied_versions, migrate, MIGRATIONS
+from api.retention import RetentionPolicy, apply_retention
+from api.storage import store_from_config
+from config import Config
+
+
+def print_report(report):
+    for collection, info in report['indexes'].items():
+        print(f"{collection}: {', '.join(info['indexes']) or 'no indexes'}")
+        for index, covering in info['redundant']:
+            print(f'  redundant: {index} is a prefix of {covering}')
+    for query in report['queries']:
+        verdict = '; '.join(query['problems']) or 'ok'
+        print(f"{query['query']}: {' > '.join(query['stages'])} "
+              f"(examined {query['examined']}, returned {query['returned']}) - {verdict}")
+    if report['pending_migrations']:
+        print(f"Pending migrations: {', '.join(map(str, report['pending_migrations']))}. Run: python manage_indexes.py migrate")
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect and migrate the indexes of the metrics collections.')
+    parser.add_argument('--mongo-uri', default=Config.MONGO_URI)
+    commands = parser.add_subparsers(dest='command', required=True)
+    advise_parser = commands.add_parser('advise', help='Explain the hot queries and report scans, inefficient plans and redundant indexes')
+    advise_parser.add_argument('--name', help='Metric name to explain the queries with (default: the newest point)')
+    advise_parser.add_argument('--collection', default=store_from_config(vars(Config)).collection_name,
+                               help='Collection holding the raw points (default: the one of METRICS_STORAGE)')
+    migrate_parser = commands.add_parser('migrate', help='Apply pending index migrations')
+    migrate_parser.add_argument('--dry-run', action='store_true', help='Only print what would be done')
+    migrate_parser.add_argument('--target', type=int, help='Stop after this migration version')
+    migrate_parser.add_argument('--commit-quorum', help="Replica set members that must finish each build, e.g. 'majority'")
+    commands.add_parser('status', help='List applied and pending migrations')
+    retention_parser = commands.add_parser('retention', help='Set the TTL expiry of raw points and rollups from METRICS_RETENTION_*_DAYS')
+    retention_parser.add_argument('--dry-run', action='store_true', help='Only print what would be done')
+    args = parser.parse_args()
+
+    db = MongoClient(args.mongo_uri).get_default_database()
+    store = store_from_config(vars(Config))
+    if args.command == 'advise':
+        print_report(advise(db, args.name, args.collection))
+    elif args.command == 'migrate':
+        actions = migrate(db, dry_run=args.dry_run, commit_quorum=args.commit_quorum, target=args.target,
+                          raw_collection=store.collection_name, timeseries=store.backend == 'timeseries')
+        print('\n'.join(actions) if actions else 'No pending migrations.')
+    elif args.command == 'retention':
+        policy = RetentionPolicy(raw=Config.METRICS_RETENTION_RAW_DAYS, minute=Config.METRICS_RETENTION_MINUTE_DAYS,
+                                 hour=Config.METRICS_RETENTION_HOUR_DAYS, day=Config.METRICS_RETENTION_DAY_DAYS)
+        actions = apply_retention(db, policy, store.collection_name, timeseries=store.backend == 'timeseries',
+                                  dry_run=args.dry_run)
+        print('\n'.join(actions) if actions else 'Retention already up to date.')
+    else:
+        applied = set(applied_versions(db))
+        for migration in MIGRATIONS:
+            state = 'applied' if migration['version'] in applied else 'pending'
+            print(f"{migration['version']} [{state}] {migration['description']}")
+
+if __name__ == '__main__':
+    main()
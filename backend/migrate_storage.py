@@ -0,0 +1,43 @@
+import argparse
+from datetime import datetime, timezone
+from pymongo import MongoClient
+from api.storage import MetricStore, TIMESERIES_GRANULARITIES, TimeSeriesMetricStore, copy_points, storage_stats
+from config import Config
+
+PROGRESS_COLLECTION = 'storage_migrations'
+
+
+def migrate(source_name='metrics', target_name='metrics_ts', granularity='seconds', batch_size=10000, restart=False):
+    client = MongoClient(Config.MONGO_URI)
+    db = client.get_default_database()
+    source = MetricStore(source_name)
+    target = TimeSeriesMetricStore(target_name, granularity)
+    progress_id = f'{source_name}->{target_name}'
+    progress = None if restart else db[PROGRESS_COLLECTION].find_one({'_id': progress_id})
+    after = progress['last_id'] if progress else None
+    if after is not None:
+        print(f'Resuming after {after}.')
+
+    def save_progress(last_id):
+        db[PROGRESS_COLLECTION].update_one({'_id': progress_id},
+                                           {'$set': {'last_id': last_id, 'updated': datetime.now(timezone.utc)}},
+                                           upsert=True)
+
+    copied = copy_points(db, source, target, batch_size=batch_size, after=after, progress=save_progress)
+    print(f'Copied {copied} points from {source_name} into the time-series collection {target_name}.')
+    for name in (source_name, target_name):
+        stats = storage_stats(db, name)
+        print(f"{name}: {stats['count']} points, {stats['storage_size']} bytes on disk, {stats['index_size']} bytes of indexes")
+    print(f'Set METRICS_STORAGE=timeseries (and METRICS_COLLECTION={target_name} if renamed), then rerun this '
+          f'command once the app writes to {target_name} to copy points stored in between; points already '
+          f'in {target_name} are kept.')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Copy raw metrics into a MongoDB time-series collection (MongoDB 5.0+).')
+    parser.add_argument('--source', default='metrics')
+    parser.add_argument('--target', default='metrics_ts')
+    parser.add_argument('--granularity', default=Config.METRICS_TIMESERIES_GRANULARITY, choices=TIMESERIES_GRANULARITIES)
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--restart', action='store_true', help='Ignore saved progress and copy from the first point')
+    args = parser.parse_args()
+    migrate(args.source, args.target, args.granularity, args.batch_size, args.restart)
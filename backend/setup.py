@@ -4,6 +4,9 @@ from faker import Faker
 import datetime
 from datetime import timezone, timedelta
 import random
+from api.catalog import rebuild_catalog
+from api.indexes import migrate
+from api.rollups import rebuild_rollups
 
 fake = Faker()
 
@@ -81,10 +84,14 @@ def setup():
             }
             metrics.insert_one(metric_data)
 
-        # Create indexes
-        metrics.create_index([('name', 1)])
-        metrics.create_index([('value', 1)])
-        metrics.create_index([('timestamp', 1)])
+        # Create the indexes of the latest migration
+        migrate(db)
+
+        # Build the minute/hour/day rollups used by queries
+        rebuild_rollups(db)
+
+        # List the seeded metric names
+        rebuild_catalog(db)
 
         print('Metrics setup complete.')
 
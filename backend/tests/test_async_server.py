@@ -0,0 +1,82 @@
+import asyncio
+import pytest
+from flask import Flask
+from flask_login import LoginManager
+from flask_socketio import SocketIO
+from mongomock import MongoClient
+from api.async_server import AsyncMetricsServer
+from api.instrumentation import registry, socketio_event_seconds
+from api.metrics import init_metrics_module, metric_cache, subscriptions
+
+
+class RecordingServer:
+    """Stands in for the AsyncServer's emit and room calls, recording what would be sent."""
+
+    def __init__(self, server):
+        self.sent = []
+        self.rooms = {}
+        server.sio.emit = self.emit
+        server.sio.enter_room = self.enter_room
+        server.sio.leave_room = self.leave_room
+
+    async def emit(self, event, data, to=None):
+        self.sent.append((event, data, to))
+
+    async def enter_room(self, sid, room):
+        self.rooms.setdefault(room, set()).add(sid)
+
+    async def leave_room(self, sid, room):
+        self.rooms[room].discard(sid)
+
+@pytest.fixture
+def async_server():
+    mongo = MongoClient()
+    app = Flask(__name__)
+    app.config['TESTING'] = True
+    app.config['INGEST_WRITE_BEHIND'] = False
+    app.config['METRICS_BACKGROUND_TASKS'] = False
+    init_metrics_module(app, mongo, SocketIO(app), LoginManager(app))
+    metric_cache.clear()
+    server = AsyncMetricsServer(app, mongo)
+    yield server, RecordingServer(server), app
+    mongo.drop_database('db')
+
+SUBSCRIPTION = {'name': 'async_metric', 'startDate': '2021-01-01T00:00:00', 'endDate': '2021-01-01T05:00:00',
+                'interval': 'hour', 'include_zeros': False}
+
+def test_request_metrics_replies_to_sender(async_server):
+    server, recorder, app = async_server
+    app.test_client().post('/metrics/log_metrics_batch', json=[
+        {'name': 'async_metric', 'value': 4, 'timestamp': '2021-01-01T01:00:00+00:00'}])
+
+    asyncio.run(server.handle_request_metrics('sid-1', SUBSCRIPTION))
+    assert recorder.sent == [('metrics_data', [{'_id': '2021-01-01 01:00', 'average_value': 4}], 'sid-1')]
+
+def test_subscription_receives_deltas(async_server):
+    server, recorder, app = async_server
+
+    async def scenario():
+        await server.handle_subscribe_metrics('sid-1', SUBSCRIPTION)
+        app.test_client().post('/metrics/log_metrics_batch', json=[
+            {'name': 'async_metric', 'value': 8, 'timestamp': '2021-01-01T02:00:00+00:00'}])
+        assert await server.push_updates() == 1
+        await server.handle_disconnect('sid-1')
+
+    asyncio.run(scenario())
+    (snapshot_event, snapshot, _), (delta_event, delta, room) = recorder.sent
+    assert (snapshot_event, snapshot['seq'], snapshot['metrics']) == ('metrics_snapshot', 0, [])
+    assert recorder.rooms[room] == {'sid-1'}
+    assert (delta_event, delta['seq'], delta['metrics']) == ('metrics_delta', 1, [{'_id': '2021-01-01 02:00', 'average_value': 8}])
+    assert len(subscriptions) == 0
+
+def test_handlers_are_instrumented(async_server):
+    server, recorder, app = async_server
+
+    def count(event):
+        return sum(value for name, labels, value in socketio_event_seconds.samples()
+                   if name.endswith('_count') and dict(labels)['event'] == event)
+
+    before = count('request_metrics')
+    asyncio.run(server.sio.handlers['/']['request_metrics']('sid-1', SUBSCRIPTION))
+    assert count('request_metrics') == before + 1
+    assert 'socketio_connections 0' in registry.render()
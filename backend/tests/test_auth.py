@@ -1,11 +1,13 @@
+import mongomock
 import pytest
 from flask import Flask
 from flask_bcrypt import Bcrypt
 from flask_login import LoginManager
-from flask_jwt_extended import JWTManager
+from flask_jwt_extended import JWTManager, create_access_token
 from flask_limiter import Limiter
 from mongomock import MongoClient
-from api.auth import init_auth_module
+from api import auth
+from api.auth import init_auth_module, invalidate_user
 from datetime import datetime, timezone
 
 # Flask app setup for testing
@@ -89,5 +91,61 @@ def test_validate_token(client, example_user):
     response = client.post('/validate_token', headers={'Authorization': f'Bearer {token}'})
     assert response.status_code == 200
 
+def test_validate_token_uses_user_cache(client, example_user, mock_db):
+    response = client.post('/login', json={
+        'username': example_user['username'],
+        'password': 'password'
+    })
+    token = response.json.get('token')
+    headers = {'Authorization': f'Bearer {token}'}
+
+    # The user cached at login answers without MongoDB until it is invalidated
+    mock_db.db.users.delete_many({})
+    assert client.post('/validate_token', headers=headers).status_code == 200
+    invalidate_user(example_user['_id'])
+    assert client.post('/validate_token', headers=headers).status_code == 401
+
+    # A password change makes the tokens issued before it invalid
+    mock_db.db.users.insert_one({**example_user, 'password': bcrypt.generate_password_hash('changed').decode('utf-8')})
+    invalidate_user(example_user['_id'])
+    assert client.post('/validate_token', headers=headers).status_code == 401
+
+    stats = client.get('/user_cache_stats').json
+    assert stats['hits'] >= 1 and stats['misses'] >= 2
+    assert 'password' not in auth.user_cache.peek(example_user['_id']).user_data
+
+def test_validate_token_reads_mongodb_once_per_cache_miss(client, example_user, mock_db, monkeypatch):
+    limiter.reset()
+    response = client.post('/login', json={'username': example_user['username'], 'password': 'password'})
+    headers = {'Authorization': f"Bearer {response.json.get('token')}"}
+    invalidate_user(example_user['_id'])
+    lookups = []
+    find_one = mongomock.Collection.find_one
+
+    def counting_find_one(self, *args, **kwargs):
+        lookups.append(args)
+        return find_one(self, *args, **kwargs)
+
+    monkeypatch.setattr(mongomock.Collection, 'find_one', counting_find_one)
+    for _ in range(2):
+        assert client.post('/validate_token', headers=headers).status_code == 200
+    # The claims are checked against the user read on the first miss; later calls are cache hits
+    assert lookups == [({'_id': example_user['_id']},)]
+
+def test_user_cache_stats_needs_login(init_auth):
+    assert app.test_client().get('/user_cache_stats').status_code == 401
+
+def test_validate_token_rejects_tokens_without_credentials(client, example_user):
+    with app.app_context():
+        token = create_access_token(identity=str(example_user['_id']))
+    assert client.post('/validate_token', headers={'Authorization': f'Bearer {token}'}).status_code == 401
+
+def test_unknown_users_are_not_cached_for_long(mock_db, example_user, monkeypatch):
+    monkeypatch.setattr(auth, 'user_cache_miss_ttl', 0)
+    invalidate_user(2)
+    assert auth.cached_user(mock_db, 2) is None
+    mock_db.db.users.insert_one({**example_user, '_id': 2, 'username': 'newuser'})
+    assert auth.cached_user(mock_db, 2).get_id() == '2'
+
 if __name__ == '__main__':
     pytest.main()
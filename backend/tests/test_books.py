@@ -5,7 +5,6 @@ from flask import Flask, json
 from flask_login import LoginManager
 import pytest
 from api.books import init_books_module
-from flask.testing import FlaskClient
 from flask_jwt_extended import JWTManager
 from flask_limiter import Limiter
 from api.auth import init_auth_module
@@ -82,3 +81,58 @@ def test_add_book_invalid_data(client, mocker):
     assert 'message' in data
     assert 'errors' in data
 
+
+@pytest.fixture
+def mock_client():
+    from mongomock import MongoClient
+    app = Flask(__name__)
+    app.config['TESTING'] = True
+    app.config['SECRET_KEY'] = 'test_secret_key'
+    mongo = MongoClient()
+    mongo.db.books.insert_many([{'title': f'Book {i}', 'author': 'Author', 'isbn': str(i)} for i in range(5)])
+    init_books_module(app, mongo, LoginManager(app))
+    return app.test_client(), mongo
+
+def test_get_books_pages_by_id(mock_client):
+    client, mongo = mock_client
+    response = client.get('/books/?limit=2&fields=title')
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert [book['title'] for book in data['books']] == ['Book 0', 'Book 1']
+    assert set(data['books'][0]) == {'_id', 'title'}
+
+    data = json.loads(client.get(f"/books/?limit=2&after={data['next']}").data)
+    assert [book['isbn'] for book in data['books']] == ['2', '3']
+    data = json.loads(client.get(f"/books/?limit=2&after={data['next']}").data)
+    assert [book['isbn'] for book in data['books']] == ['4'] and data['next'] is None
+
+    # Without limit and after, the whole collection as before pagination
+    data = json.loads(client.get('/books/').data)
+    assert len(data['books']) == 5 and data['next'] is None
+
+    assert client.get('/books/?fields=password').status_code == 400
+    assert client.get('/books/?after=nope').status_code == 400
+
+def test_get_books_etag(mock_client, mocker):
+    client, mongo = mock_client
+    response = client.get('/books/')
+    etag = response.headers['ETag']
+
+    find = mocker.spy(mongo.db.books, 'find')
+    response = client.get('/books/', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    find.assert_not_called()
+
+    mocker.patch('flask_login.utils._get_user', return_value=Mock(is_authenticated=True))
+    client.post('/books/add', json={'title': 'New', 'author': 'Author', 'isbn': '9'})
+    response = client.get('/books/', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert len(json.loads(response.data)['books']) == 6
+
+def test_get_books_query_error(mock_client, mocker):
+    client, mongo = mock_client
+    cursor = mocker.MagicMock()
+    cursor.sort.return_value = cursor
+    cursor.__next__.side_effect = RuntimeError('connection lost')
+    mocker.patch.object(mongo.db.books, 'find', return_value=cursor)
+    assert client.get('/books/').status_code == 500
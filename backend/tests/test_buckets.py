@@ -0,0 +1,39 @@
+import pytest
+from datetime import datetime, timezone
+from api.buckets import TooManyBuckets, bucket_count, bucket_labels, bucket_range, fill_missing_dates
+
+
+def test_bucket_labels_match_aggregation_format():
+    start = datetime(2021, 1, 1, 23, 58, 30, tzinfo=timezone.utc)
+    end = datetime(2021, 1, 2, 0, 1, tzinfo=timezone.utc)
+    assert bucket_labels(bucket_range(start, end, 'minute'), 'minute').tolist() == [
+        '2021-01-01 23:58', '2021-01-01 23:59', '2021-01-02 00:00', '2021-01-02 00:01']
+    assert bucket_labels(bucket_range(start, end, 'hour'), 'hour').tolist() == ['2021-01-01 23:00', '2021-01-02 00:00']
+    assert bucket_labels(bucket_range(start, end, 'day'), 'day').tolist() == ['2021-01-01', '2021-01-02']
+
+def test_fill_missing_dates():
+    data = [{'_id': '2021-01-01 02:00', 'average_value': 5}]
+    filled = fill_missing_dates(data, datetime(2021, 1, 1, 0, 30, tzinfo=timezone.utc),
+                                datetime(2021, 1, 1, 3, tzinfo=timezone.utc), 'hour')
+    assert filled == [
+        {'_id': '2021-01-01 00:00', 'average_value': 0},
+        {'_id': '2021-01-01 01:00', 'average_value': 0},
+        {'_id': '2021-01-01 02:00', 'average_value': 5},
+        {'_id': '2021-01-01 03:00', 'average_value': 0},
+    ]
+
+def test_fill_a_year_of_minutes():
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    end = datetime(2024, 12, 31, 23, 59, tzinfo=timezone.utc)
+    filled = fill_missing_dates([], start, end, 'minute')
+    assert len(filled) == 366 * 24 * 60
+    assert filled[-1] == {'_id': '2024-12-31 23:59', 'average_value': 0}
+
+def test_bucket_cap():
+    start = datetime(2021, 1, 1, tzinfo=timezone.utc)
+    end = datetime(2021, 1, 2, tzinfo=timezone.utc)
+    assert bucket_count(start, end, 'minute') == 1441
+    with pytest.raises(TooManyBuckets):
+        bucket_range(start, end, 'minute', max_buckets=1000)
+    with pytest.raises(TooManyBuckets):
+        bucket_range(datetime.min.replace(tzinfo=timezone.utc), datetime.max.replace(tzinfo=timezone.utc), 'minute')
@@ -0,0 +1,220 @@
+import pytest
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from api.cache import BucketCache, LRUCache, SingleFlight
+from api.rollups import point_stats
+from api.sketch import sketch_key
+
+
+NOW = datetime(2021, 1, 2, 12, 30, tzinfo=timezone.utc)
+
+def hour(h, day=1):
+    return datetime(2021, 1, day, h, tzinfo=timezone.utc)
+
+class RecordingFetcher:
+    """Serves one point per hour with value == hour, recording the requested ranges."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, first, last):
+        self.calls.append((first, last))
+        buckets = {}
+        bucket = first
+        while bucket <= last:
+            buckets[bucket] = point_stats(bucket.hour)
+            bucket += timedelta(hours=1)
+        return buckets
+
+def test_overlapping_windows_fetch_only_missing_buckets():
+    cache = BucketCache()
+    fetch = RecordingFetcher()
+
+    first = cache.get_buckets('test_metric', 'hour', hour(0), hour(10), fetch, now=NOW)
+    assert len(first) == 11
+    second = cache.get_buckets('test_metric', 'hour', hour(5), hour(15), fetch, now=NOW)
+    assert sorted(second) == [hour(h) for h in range(5, 16)]
+    assert fetch.calls == [(hour(0), hour(10)), (hour(11), hour(15))]
+
+    cache.get_buckets('test_metric', 'hour', hour(2), hour(14), fetch, now=NOW)
+    assert len(fetch.calls) == 2
+    assert (cache.hits, cache.partial_hits, cache.misses) == (1, 1, 1)
+
+def test_open_bucket_is_fetched_again():
+    cache = BucketCache()
+    fetch = RecordingFetcher()
+
+    cache.get_buckets('test_metric', 'hour', hour(10, day=2), hour(12, day=2), fetch, now=NOW)
+    cache.get_buckets('test_metric', 'hour', hour(10, day=2), hour(12, day=2), fetch, now=NOW)
+    assert fetch.calls == [(hour(10, day=2), hour(12, day=2)), (hour(12, day=2), hour(12, day=2))]
+
+def test_late_points_update_covered_buckets():
+    cache = BucketCache()
+    fetch = RecordingFetcher()
+    cache.get_buckets('test_metric', 'hour', hour(0), hour(3), fetch, now=NOW)
+
+    cache.apply_points([{'name': 'test_metric', 'value': 10, 'timestamp': hour(2) + timedelta(minutes=5)},
+                        {'name': 'other_metric', 'value': 10, 'timestamp': hour(2)}])
+    buckets = cache.get_buckets('test_metric', 'hour', hour(0), hour(3), fetch, now=NOW)
+    assert buckets[hour(2)] == {'sum': 12, 'count': 2, 'min': 2, 'max': 10, 'sketch': {sketch_key(2): 1, sketch_key(10): 1}}
+    assert len(fetch.calls) == 1
+
+def test_many_series_share_one_fetch():
+    cache = BucketCache()
+    fetch = RecordingFetcher()
+    cache.get_buckets('cpu', 'hour', hour(0), hour(5), fetch, now=NOW)
+    calls = []
+
+    def fetch_many(names, first, last):
+        calls.append((names, first, last))
+        return {name: fetch(first, last) for name in names}
+
+    series = cache.get_many_buckets(['cpu', 'mem', 'disk'], 'hour', hour(3), hour(8), fetch_many, now=NOW)
+    assert calls == [(['cpu', 'mem', 'disk'], hour(3), hour(8))]
+    assert all(sorted(buckets) == [hour(h) for h in range(3, 9)] for buckets in series.values())
+    assert cache.get_many_buckets(['cpu', 'mem', 'disk'], 'hour', hour(3), hour(8), fetch_many, now=NOW) == series
+    assert len(calls) == 1
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def test_series_expire_after_ttl():
+    cache = BucketCache(ttl=60)
+    clock = cache._series.clock = FakeClock()
+    cache.get_buckets('test_metric', 'hour', hour(0), hour(3), RecordingFetcher(), now=NOW)
+    clock.now = 30
+    assert cache.expire() == []
+    clock.now = 61
+    assert cache.expire() == [('test_metric', 'hour')]
+    assert len(cache) == 0
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert 'b' not in cache
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.stats()['evictions'] == 1
+
+def test_lru_respects_byte_budget():
+    cache = LRUCache(max_entries=100, max_bytes=250, sizeof=lambda value: 100)
+    for key in 'abc':
+        cache.set(key, key)
+    assert len(cache) == 2
+    assert cache.stats()['bytes'] == 200
+    assert cache.get('a') is None
+
+def test_lru_per_key_ttl():
+    clock = FakeClock()
+    cache = LRUCache(ttl=10, clock=clock)
+    cache.set('short', 1, ttl=1)
+    cache.set('default', 2)
+    clock.now = 5
+    assert cache.get('short') is None
+    assert cache.get('default') == 2
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['expirations']) == (1, 1, 1)
+
+def test_bucket_cache_evicts_series_over_budget():
+    cache = BucketCache(max_series=1)
+    cache.get_buckets('test_metric', 'hour', hour(0), hour(3), RecordingFetcher(), now=NOW)
+    cache.get_buckets('other_metric', 'hour', hour(0), hour(3), RecordingFetcher(), now=NOW)
+    assert cache.series_keys() == [('other_metric', 'hour')]
+    assert cache.stats()['series']['evictions'] == 1
+
+def test_merge_new_points_drops_covered_buckets_of_raw_points():
+    cache = BucketCache(ttl=60)
+    fetch = RecordingFetcher()
+    cache.get_buckets('test_metric', 'hour', hour(0), hour(5), fetch, now=NOW)
+    high_water = cache.high_waters()[('test_metric', 'hour')]
+
+    late = [{'_id': ObjectId(), 'value': 1, 'timestamp': hour(2) + timedelta(minutes=1)},
+            {'_id': ObjectId(), 'value': 1, 'timestamp': NOW}]
+    merged = cache.merge_new_points('test_metric', late, now=NOW)
+    # Only the covered bucket is dropped, and read again from the rollups; the open tail is read fresh
+    assert merged == {'hour': late[:1]}
+    cache.get_buckets('test_metric', 'hour', hour(0), hour(5), fetch, now=NOW)
+    assert fetch.calls[1:] == [(hour(2), hour(2))]
+    assert cache.high_waters()[('test_metric', 'hour')] == late[-1]['_id'] > high_water
+    assert cache.merge_new_points('test_metric', [], now=NOW) == {}
+
+def test_merge_new_points_skips_applied_points():
+    cache = BucketCache()
+    fetch = RecordingFetcher()
+    cache.get_buckets('test_metric', 'hour', hour(0), hour(5), fetch, now=NOW)
+    before = cache.get_buckets('test_metric', 'hour', hour(2), hour(2), fetch, now=NOW)[hour(2)]['count']
+    ingested = {'_id': ObjectId(), 'name': 'test_metric', 'value': 1, 'timestamp': hour(2)}
+    external = {'_id': ObjectId(), 'name': 'test_metric', 'value': 1, 'timestamp': hour(3)}
+
+    # Points ingested through the app are already applied; raw inserts by others are not
+    cache.apply_points([ingested], now=NOW)
+    assert cache.merge_new_points('test_metric', [ingested, external], now=NOW) == {'hour': [external]}
+    assert cache.get_buckets('test_metric', 'hour', hour(2), hour(2), fetch, now=NOW)[hour(2)]['count'] == before + 1
+    # ...and a point the refresher saw first is not applied when its ingest catches up
+    late_ingested = {'_id': ObjectId(), 'name': 'test_metric', 'value': 1, 'timestamp': hour(2)}
+    cache.merge_new_points('test_metric', [late_ingested], now=NOW)
+    cache.apply_points([late_ingested], now=NOW)
+    cache.get_buckets('test_metric', 'hour', hour(0), hour(5), fetch, now=NOW)
+    assert fetch.calls[1:] == [(hour(2), hour(3))]
+
+    # Every id is at or below the high-water mark now
+    cache.prune_accounted(now=datetime.now(timezone.utc) + timedelta(hours=1))
+    assert not cache._accounted
+
+def test_apply_points_leaves_unmerged_points_to_the_refresher():
+    cache = BucketCache()
+    fetch = RecordingFetcher()
+    cache.get_buckets('test_metric', 'hour', hour(0), hour(1), fetch, now=NOW)
+    # Hour 4 is not covered yet, as while a gap fetch that read it before the insert is in flight
+    point = {'_id': ObjectId(), 'name': 'test_metric', 'value': 1, 'timestamp': hour(4)}
+    cache.apply_points([point], now=NOW)
+    assert point['_id'] not in cache._accounted
+    cache.get_buckets('test_metric', 'hour', hour(0), hour(5), fetch, now=NOW)
+    assert cache.merge_new_points('test_metric', [point], now=NOW) == {'hour': [point]}
+
+def test_single_flight_shares_one_call():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return ['result']
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do('key', slow)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(flight.do('key', slow))) for _ in range(4)]
+    for follower in followers:
+        follower.start()
+    while flight.stats()['shared'] < 4:
+        time.sleep(0.01)
+    release.set()
+    for thread in [leader, *followers]:
+        thread.join(5)
+    assert len(calls) == 1
+    assert results == [['result']] * 5
+    assert flight.stats() == {'calls': 1, 'shared': 4, 'in_flight': 0}
+    # Once done, the next call runs again
+    assert flight.do('key', lambda: 'again') == 'again'
+
+def test_single_flight_shares_errors():
+    def fail():
+        raise ValueError('boom')
+
+    flight = SingleFlight()
+    with pytest.raises(ValueError):
+        flight.do('key', fail)
+    assert flight.stats()['in_flight'] == 0
@@ -0,0 +1,78 @@
+from datetime import datetime, timezone
+from mongomock import MongoClient
+from api.catalog import MetricCatalog, bump_catalog_version, catalog_version, glob_prefix
+
+
+def point(name, value, hour):
+    return {'name': name, 'value': value, 'timestamp': datetime(2021, 1, 1, hour, tzinfo=timezone.utc)}
+
+def test_record_keeps_collection_and_copy_in_step():
+    mongo = MongoClient()
+    catalog = MetricCatalog()
+    catalog.record([point('cpu.user', 1, 3), point('cpu.user', 2, 5), point('cpu.user', 3, 4)], mongo)
+    catalog.record([point('cpu.user', 7, 1), point('mem.used', 9, 2)], mongo)
+
+    stored = mongo.db.metric_catalog.find_one({'_id': 'cpu.user'})
+    assert (stored['count'], stored['last_value']) == (4, 2)
+    assert (stored['first_seen'], stored['last_seen']) == (datetime(2021, 1, 1, 1), datetime(2021, 1, 1, 5))
+
+    entry = catalog.entries(mongo, 'cpu')[0]
+    assert (entry['count'], entry['last_value'], entry['first_seen'].hour, entry['last_seen'].hour) == (4, 2, 1, 5)
+
+    reloaded = MetricCatalog()
+    assert reloaded.entries(mongo) == catalog.entries(mongo)
+
+def test_prefix_search_and_pages():
+    mongo = MongoClient()
+    catalog = MetricCatalog()
+    names = ['cpu.system', 'cpu.user', 'disk.read', 'mem.free', 'mem.used', 'cpu.idle']
+    catalog.record([point(name, 1, 1) for name in names], mongo)
+
+    assert catalog.names(mongo) == sorted(names)
+    assert catalog.names(mongo, 'cpu.') == ['cpu.idle', 'cpu.system', 'cpu.user']
+    assert catalog.names(mongo, 'cpu.', limit=2) == ['cpu.idle', 'cpu.system']
+    assert catalog.names(mongo, 'cpu.', after='cpu.system', limit=2) == ['cpu.user']
+    assert catalog.names(mongo, after='disk.read', limit=2) == ['mem.free', 'mem.used']
+    assert catalog.names(mongo, 'net') == []
+    assert catalog.match(mongo, 'mem.*') == ['mem.free', 'mem.used']
+    assert catalog.match(mongo, '*.u?ed') == ['mem.used']
+    assert glob_prefix('cpu.*.user') == 'cpu.'
+
+def test_refresh_reloads_names_added_elsewhere():
+    mongo = MongoClient()
+    catalog = MetricCatalog()
+    catalog.record([point('cpu.user', 1, 1)], mongo)
+    assert catalog.names(mongo) == ['cpu.user']
+    assert not catalog.refresh(mongo)
+
+    MetricCatalog().record([point('mem.used', 1, 1)], mongo)
+    assert catalog.names(mongo) == ['cpu.user']
+    assert catalog.refresh(mongo)
+    assert catalog.names(mongo) == ['cpu.user', 'mem.used']
+
+def test_refresh_reloads_entries_changed_elsewhere():
+    mongo = MongoClient()
+    catalog = MetricCatalog()
+    catalog.record([point('cpu.user', 1, 1), point('mem.used', 1, 1)], mongo)
+    assert catalog.names(mongo) == ['cpu.user', 'mem.used']
+
+    # Same number of names: one deleted, one added, and a count updated
+    mongo.db.metric_catalog.delete_one({'_id': 'mem.used'})
+    bump_catalog_version(mongo.db)
+    MetricCatalog().record([point('disk.free', 1, 2), point('cpu.user', 3, 4)], mongo)
+    assert catalog.refresh(mongo)
+    assert catalog.names(mongo) == ['cpu.user', 'disk.free']
+    assert catalog.entries(mongo, 'cpu')[0]['count'] == 2
+    assert not catalog.refresh(mongo)
+
+def test_record_bumps_version_only_for_new_names():
+    mongo = MongoClient()
+    catalog = MetricCatalog()
+    catalog.record([point('cpu.user', 1, 1)], mongo)
+    assert catalog_version(mongo.db) == 1
+    catalog.record([point('cpu.user', 2, 2)], mongo)
+    assert catalog_version(mongo.db) == 1
+    assert catalog.entries(mongo)[0]['count'] == 2
+    catalog.record([point('mem.used', 1, 3)], mongo)
+    assert catalog_version(mongo.db) == 2
+    assert not catalog.refresh(mongo)
@@ -0,0 +1,31 @@
+import numpy as np
+from api.downsample import downsample, lttb_indices, minmax_indices
+
+
+def minute_series(values):
+    return [{'_id': f'2021-01-01 {i // 60:02d}:{i % 60:02d}', 'average_value': v} for i, v in enumerate(values)]
+
+def test_lttb_keeps_endpoints_and_spikes():
+    y = np.zeros(1000)
+    y[437] = 100
+    indices = lttb_indices(np.arange(1000, dtype=np.float64), y, 50)
+    assert len(indices) == 50
+    assert indices[0] == 0 and indices[-1] == 999
+    assert 437 in indices
+    assert np.all(np.diff(indices) > 0)
+
+def test_minmax_keeps_extremes():
+    y = np.sin(np.linspace(0, 20, 1000))
+    y[10] = -5
+    y[900] = 5
+    indices = minmax_indices(y, 40)
+    assert len(indices) <= 40
+    assert 10 in indices and 900 in indices
+
+def test_downsample_series():
+    data = minute_series(list(range(600)))
+    assert downsample(data, 1000) is data
+    reduced = downsample(data, 100)
+    assert len(reduced) == 100
+    assert reduced[0] == data[0] and reduced[-1] == data[-1]
+    assert len(downsample(data, 100, method='minmax')) <= 100
@@ -0,0 +1,77 @@
+import gzip
+import json
+import numpy as np
+import pytest
+from flask import Flask, Response, request
+from api.encoding import (ARROW_STREAM, COLUMNS_JSON, MSGPACK, ROWS_JSON, binary_columns, compress_response,
+                          encode_columns, negotiate, series_columns)
+
+ROWS = [{'_id': '2021-01-01 00:00', 'average_value': 1.5, 'p95': None},
+        {'_id': '2021-01-01 01:00', 'average_value': 2.5, 'p95': 3.0}]
+EPOCH_MS = [1609459200000, 1609462800000]
+
+app = Flask(__name__)
+
+
+def test_series_columns():
+    columns = series_columns(ROWS)
+    assert columns['timestamps'].tolist() == EPOCH_MS
+    assert columns['average_value'].tolist() == [1.5, 2.5]
+    assert np.isnan(columns['p95'][0])
+    assert series_columns([])['timestamps'].tolist() == []
+    assert series_columns([{'_id': '2021-01-02', 'count': 3}])['timestamps'].tolist() == [1609545600000]
+
+def test_binary_columns_are_little_endian():
+    buffers = binary_columns(series_columns(ROWS))
+    assert np.frombuffer(buffers['timestamps'], dtype='<i8').tolist() == EPOCH_MS
+    assert np.frombuffer(buffers['average_value'], dtype='<f8').tolist() == [1.5, 2.5]
+
+def test_negotiate():
+    with app.test_request_context(headers={'Accept': '*/*'}):
+        assert negotiate(request) == ROWS_JSON
+    with app.test_request_context():
+        assert negotiate(request) == ROWS_JSON
+    with app.test_request_context(headers={'Accept': f'{ARROW_STREAM}, application/json;q=0.5'}):
+        assert negotiate(request) == ARROW_STREAM
+
+def test_encode_columns_json():
+    pytest.importorskip('orjson')
+    decoded = json.loads(encode_columns({'cpu': ROWS}, COLUMNS_JSON))
+    assert decoded == {'series': {'cpu': {'timestamps': EPOCH_MS, 'average_value': [1.5, 2.5], 'p95': [None, 3.0]}}}
+
+def test_encode_columns_msgpack():
+    msgpack = pytest.importorskip('msgpack')
+    decoded = msgpack.unpackb(encode_columns({'cpu': ROWS}, MSGPACK))
+    assert np.frombuffer(decoded['series']['cpu']['timestamps'], dtype='<i8').tolist() == EPOCH_MS
+
+def test_encode_columns_arrow():
+    pa = pytest.importorskip('pyarrow')
+    table = pa.ipc.open_stream(encode_columns({'cpu': ROWS, 'mem': ROWS[:1]}, ARROW_STREAM)).read_all()
+    assert table.num_rows == 3
+    assert table.column('name').to_pylist() == ['cpu', 'cpu', 'mem']
+    assert table.column('average_value').to_pylist() == [1.5, 2.5, 1.5]
+    assert table.column('p95').null_count == 2
+
+def test_encode_columns_empty_series():
+    columns = series_columns([], ['average_value', 'max'])
+    assert {field: array.tolist() for field, array in columns.items()} == {'timestamps': [], 'average_value': [], 'max': []}
+    assert columns['max'].dtype == np.float64
+    pa = pytest.importorskip('pyarrow')
+    # The empty series comes first, so its batch must carry the statistic columns too
+    stream = encode_columns({'missing': [], 'cpu': ROWS}, ARROW_STREAM, ['average_value', 'p95'])
+    table = pa.ipc.open_stream(stream).read_all()
+    assert table.column_names == ['name', 'timestamp', 'average_value', 'p95']
+    assert table.column('name').to_pylist() == ['cpu', 'cpu']
+    assert pa.ipc.open_stream(encode_columns({}, ARROW_STREAM, ['average_value'])).read_all().num_rows == 0
+
+def test_compress_response():
+    body = json.dumps(ROWS * 100)
+    with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+        response = compress_response(Response(body), request, min_size=1024)
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(response.get_data()).decode() == body
+        assert 'Accept-Encoding' in response.vary
+        small = compress_response(Response('{}'), request, min_size=1024)
+        assert 'Content-Encoding' not in small.headers
+    with app.test_request_context():
+        assert 'Content-Encoding' not in compress_response(Response(body), request, min_size=1024).headers
@@ -0,0 +1,82 @@
+import random
+from datetime import datetime, timedelta, timezone
+from api.hot_window import HotWindow, to_micros
+from api.rollups import bucket_start, merge_stats, point_stats
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def window(points_per_metric=1000, max_metrics=10):
+    return HotWindow(points_per_metric, max_metrics, clock=lambda: START)
+
+def point(name, value, seconds):
+    return {'name': name, 'value': value, 'timestamp': START + timedelta(seconds=seconds)}
+
+def expected_buckets(points, interval):
+    buckets = {}
+    for doc in points:
+        bucket = bucket_start(doc['timestamp'], interval)
+        if bucket in buckets:
+            merge_stats(buckets[bucket], point_stats(doc['value']))
+        else:
+            buckets[bucket] = point_stats(doc['value'])
+    return buckets
+
+def test_buckets_match_rollups():
+    rng = random.Random(7)
+    points = [point('cpu', rng.choice([0.0, -rng.uniform(0, 50), rng.uniform(0, 1000)]), rng.randrange(3 * 3600))
+              for _ in range(500)]
+    hot = window()
+    hot.add(points)
+    for interval in ('minute', 'hour', 'day'):
+        first = bucket_start(START, interval)
+        buckets = hot.buckets('cpu', interval, first, bucket_start(START + timedelta(hours=3), interval))
+        expected = expected_buckets(points, interval)
+        assert buckets.keys() == expected.keys()
+        for bucket, stats in buckets.items():
+            assert stats['count'] == expected[bucket]['count']
+            assert abs(stats['sum'] - expected[bucket]['sum']) < 1e-6
+            assert (stats['min'], stats['max']) == (expected[bucket]['min'], expected[bucket]['max'])
+            assert stats['sketch'] == expected[bucket]['sketch']
+    assert hot.buckets('cpu', 'hour', START + timedelta(hours=1), START + timedelta(hours=1), sketches=False)[
+        START + timedelta(hours=1)]['sketch'] == {}
+    assert hot.buckets('mem', 'hour', START, START) == {}
+
+def test_overwritten_points_move_complete_range():
+    hot = window(points_per_metric=4)
+    assert hot.first_bucket('cpu', 'minute') is None
+    hot.add([point('cpu', 1, 10), point('cpu', 2, 70)])
+    assert hot.first_bucket('cpu', 'minute') == START
+    # Points from before the window started are not held
+    hot.add([point('cpu', 3, -30)])
+    assert hot.buckets('cpu', 'minute', START, START)[START]['count'] == 1
+
+    hot.add([point('cpu', value, 120 + value) for value in range(3)])
+    assert hot.first_bucket('cpu', 'minute') == START + timedelta(minutes=1)
+    assert hot.first_bucket('cpu', 'hour') == START + timedelta(hours=1)
+    assert sorted(hot.buckets('cpu', 'minute', START + timedelta(minutes=1), START + timedelta(minutes=2))) == [
+        START + timedelta(minutes=1), START + timedelta(minutes=2)]
+
+    hot.add([point('cpu', value, 200 + value) for value in range(6)])
+    assert hot.first_bucket('cpu', 'minute') == START + timedelta(minutes=4)
+    assert hot.buckets('cpu', 'minute', START + timedelta(minutes=3), START + timedelta(minutes=3))[
+        START + timedelta(minutes=3)]['count'] == 4
+
+def test_least_recently_written_metrics_are_dropped():
+    hot = window(points_per_metric=8, max_metrics=2)
+    hot.add([point('a', 1, 30)])
+    hot.add([point('b', 1, 90)])
+    versions = [hot.version('b')]
+    hot.add([point('a', 2, 100)])
+    hot.add([point('c', 1, 40)])
+    assert hot.first_bucket('b', 'minute') is None
+    versions.append(hot.version('b'))
+    assert hot.stats() == {'metrics': 2, 'max_metrics': 2, 'points': 3, 'points_per_metric': 8, 'bytes': 256}
+    # The dropped points could have belonged to any metric, so new buffers start after them
+    hot.add([point('b', 2, 95)])
+    assert to_micros(hot.first_bucket('b', 'minute')) == to_micros(START + timedelta(minutes=2))
+    # Versions are never reused, so results derived before the drop do not match
+    assert hot.version('b') not in versions
+    versions.append(hot.version('b'))
+    hot.clear()
+    assert hot.version('b') not in versions
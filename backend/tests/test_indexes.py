@@ -0,0 +1,63 @@
+from mongomock import MongoClient
+from api.indexes import analyze_plan, find_index, migrate, redundant_indexes
+
+
+def test_migrate_is_idempotent():
+    db = MongoClient().db
+    db.metrics.create_index([('name', 1)])
+    db.metrics.create_index([('value', 1)])
+    db.metrics.create_index([('timestamp', 1)])
+
+    planned = migrate(db, dry_run=True)
+    assert 'drop metrics value_1' in planned
+    assert find_index(db.metrics, [('value', 1)]) == 'value_1'
+
+    actions = migrate(db)
+    assert actions == planned
+    assert find_index(db.metrics, [('name', 1), ('timestamp', 1)]) is not None
+    assert find_index(db.metrics, [('name', 1)]) is None
+    assert find_index(db.metrics, [('value', 1)]) is None
+    assert find_index(db.metrics, [('timestamp', 1)]) == 'timestamp_1'
+    assert db.metrics_hour.index_information()['name_1_bucket_1']['unique']
+    assert redundant_indexes(db.metrics) == []
+    assert migrate(db) == []
+
+def test_migrate_uses_configured_raw_collection():
+    db = MongoClient().db
+    migrate(db, raw_collection='points')
+    assert find_index(db.points, [('name', 1), ('timestamp', 1)]) is not None
+    assert 'metrics' not in db.list_collection_names()
+
+    db = MongoClient().db
+    actions = migrate(db, raw_collection='metrics_ts', timeseries=True)
+    assert not any('metrics_ts' in action for action in actions)
+    assert db.metrics_hour.index_information()['name_1_bucket_1']['unique']
+
+def test_redundant_indexes():
+    db = MongoClient().db
+    db.metrics.create_index([('name', 1)])
+    db.metrics.create_index([('name', 1), ('timestamp', 1)])
+    db.metrics_hour.create_index([('name', 1)], unique=True)
+    db.metrics_hour.create_index([('name', 1), ('bucket', 1)])
+    assert redundant_indexes(db.metrics) == [('name_1', 'name_1_timestamp_1')]
+    assert redundant_indexes(db.metrics_hour) == []
+
+def test_analyze_plan():
+    collscan = {'queryPlanner': {'winningPlan': {'stage': 'COLLSCAN'}},
+                'executionStats': {'nReturned': 5, 'totalDocsExamined': 1000, 'totalKeysExamined': 0,
+                                   'executionStages': {'stage': 'COLLSCAN', 'nReturned': 5}}}
+    report = analyze_plan({'stages': [{'$cursor': collscan}, {'$group': {}}]})
+    assert report['stages'] == ['COLLSCAN']
+    assert report['problems'] == ['collection scan', 'examined 1000 documents or keys for 5 returned']
+
+    # A name-only index scanning every point of the series to keep the ones in range
+    prefix_scan = {'queryPlanner': {'winningPlan': {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN'}}},
+                   'executionStats': {'nReturned': 1, 'totalDocsExamined': 500, 'totalKeysExamined': 500,
+                                      'executionStages': {'stage': 'FETCH', 'nReturned': 20,
+                                                          'inputStage': {'stage': 'IXSCAN', 'nReturned': 500}}}}
+    assert analyze_plan(prefix_scan)['problems'] == ['examined 500 documents or keys for 20 returned']
+
+    compound = {'queryPlanner': {'winningPlan': {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN'}}},
+                'executionStats': {'nReturned': 20, 'totalDocsExamined': 20, 'totalKeysExamined': 21,
+                                   'executionStages': {'stage': 'FETCH', 'nReturned': 20}}}
+    assert analyze_plan(compound) == {'stages': ['FETCH', 'IXSCAN'], 'examined': 21, 'returned': 20, 'problems': []}
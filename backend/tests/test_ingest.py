@@ -0,0 +1,97 @@
+import time
+import pytest
+from api.ingest import IngestBuffer, IngestQueueFull
+
+
+class RecordingWriter:
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, docs):
+        self.batches.append(list(docs))
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+def test_flushes_when_size_threshold_reached():
+    writer = RecordingWriter()
+    buffer = IngestBuffer(writer, flush_size=3, flush_interval=60, max_size=10)
+    buffer.submit([{'value': i} for i in range(3)])
+    assert wait_for(lambda: writer.batches)
+    assert writer.batches == [[{'value': 0}, {'value': 1}, {'value': 2}]]
+    buffer.close()
+
+def test_flushes_when_time_threshold_reached():
+    writer = RecordingWriter()
+    buffer = IngestBuffer(writer, flush_size=100, flush_interval=0.05, max_size=1000)
+    buffer.submit([{'value': 1}])
+    assert wait_for(lambda: writer.batches)
+    assert buffer.stats()['flushed'] == 1
+    buffer.close()
+
+def test_rejects_when_full():
+    writer = RecordingWriter()
+    buffer = IngestBuffer(writer, flush_size=100, flush_interval=60, max_size=2)
+    buffer.submit([{'value': 1}, {'value': 2}])
+    with pytest.raises(IngestQueueFull):
+        buffer.submit([{'value': 3}])
+    stats = buffer.stats()
+    assert stats['queue_depth'] == 2
+    assert stats['rejected'] == 1
+    buffer.close()
+
+def test_close_flushes_pending_metrics():
+    writer = RecordingWriter()
+    buffer = IngestBuffer(writer, flush_size=100, flush_interval=60, max_size=100)
+    buffer.submit([{'value': 1}, {'value': 2}])
+    buffer.close()
+    assert sum(len(batch) for batch in writer.batches) == 2
+    assert buffer.stats()['queue_depth'] == 0
+
+def test_failed_batch_is_retried():
+    writer = RecordingWriter()
+    failures = [RuntimeError('down'), RuntimeError('down')]
+
+    def flaky(docs):
+        if failures:
+            raise failures.pop()
+        writer(docs)
+
+    buffer = IngestBuffer(flaky, flush_size=2, flush_interval=0.05, max_size=10, max_retries=3)
+    buffer.submit([{'value': 1}, {'value': 2}])
+    assert wait_for(lambda: writer.batches)
+    assert writer.batches == [[{'value': 1}, {'value': 2}]]
+    stats = buffer.stats()
+    assert (stats['flushed'], stats['retried'], stats['dropped']) == (2, 4, 0)
+    buffer.close()
+
+def test_batch_dropped_after_max_retries():
+    def failing(docs):
+        raise RuntimeError('down')
+
+    buffer = IngestBuffer(failing, flush_size=1, flush_interval=0.02, max_size=10, max_retries=2)
+    buffer.submit([{'value': 1}])
+    assert wait_for(lambda: buffer.stats()['dropped'] == 1)
+    stats = buffer.stats()
+    assert (stats['retried'], stats['failed'], stats['queue_depth']) == (2, 3, 0)
+    buffer.close()
+
+def test_retries_are_spaced_when_queue_is_full():
+    calls = []
+
+    def failing(docs):
+        calls.append(time.monotonic())
+        raise RuntimeError('down')
+
+    buffer = IngestBuffer(failing, flush_size=10, flush_interval=0.05, max_size=100, max_retries=2)
+    buffer.submit([{'value': i} for i in range(50)])
+    assert wait_for(lambda: buffer.stats()['dropped'] >= 10)
+    # The first batch was tried three times, a flush interval apart
+    assert len(calls) >= 3
+    assert all(later - earlier >= 0.045 for earlier, later in zip(calls[:2], calls[1:3]))
+    assert buffer.stats()['dropped'] < 50
+    buffer.close()
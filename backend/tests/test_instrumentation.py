@@ -0,0 +1,67 @@
+from types import SimpleNamespace
+from flask import Flask
+from flask_login import LoginManager
+from flask_socketio import SocketIO
+from mongomock import MongoClient
+from api import instrumentation
+from api.instrumentation import CommandTimer, Histogram, Registry, init_instrumentation_module, self_metrics
+from api.metrics import ingest_self_metrics, init_metrics_module, maintain_metrics_cache
+
+
+def test_histogram_render():
+    registry = Registry()
+    histogram = registry.register(Histogram('op_seconds', 'Op latency.', ('op',), buckets=(0.1, 1.0)))
+    histogram.observe(0.05, op='read')
+    histogram.observe(0.5, op='read')
+    histogram.observe(5, op='read')
+    registry.gauge('queue_depth', 'Queue depth.', lambda: 3)
+    registry.gauge('broken', 'Fails to collect.', lambda: 1 / 0)
+    text = registry.render()
+    assert '# TYPE op_seconds histogram' in text
+    assert 'op_seconds_bucket{op="read",le="0.1"} 1\n' in text
+    assert 'op_seconds_bucket{op="read",le="1.0"} 2\n' in text
+    assert 'op_seconds_bucket{op="read",le="+Inf"} 3\n' in text
+    assert 'op_seconds_count{op="read"} 3\n' in text
+    assert 'op_seconds_sum{op="read"} 5.55\n' in text
+    assert 'queue_depth 3\n' in text
+    assert 'broken' not in text
+
+def test_command_timer():
+    histogram = Histogram('mongodb_command_seconds', 'Commands.', ('command', 'outcome'))
+    timer = CommandTimer(histogram)
+    timer.succeeded(SimpleNamespace(command_name='find', duration_micros=1500))
+    timer.failed(SimpleNamespace(command_name='insert', duration_micros=200))
+    samples = {(name, labels): value for name, labels, value in histogram.samples()}
+    assert samples[('mongodb_command_seconds_sum', (('command', 'find'), ('outcome', 'success')))] == 0.0015
+    assert samples[('mongodb_command_seconds_count', (('command', 'insert'), ('outcome', 'failure')))] == 1
+
+def test_scrape_endpoint():
+    app = Flask(__name__)
+    app.config['TESTING'] = True
+    app.config['SECRET_KEY'] = 'test_secret_key'
+    socketio = SocketIO(app, cors_allowed_origins='*')
+    mongo = MongoClient()
+    init_instrumentation_module(app, socketio)
+    init_metrics_module(app, mongo, socketio, LoginManager(app))
+    client = app.test_client()
+    socket_client = socketio.test_client(app)
+    socket_client.emit('request_metrics', {'name': 'cpu', 'interval': 'hour', 'startDate': None, 'endDate': None})
+    client.get('/metrics/cache_stats')
+    maintain_metrics_cache(mongo)
+
+    response = client.get('/prometheus')
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain; version=0.0.4')
+    text = response.get_data(as_text=True)
+    assert 'http_request_seconds_count{route="/metrics/cache_stats",method="GET",status="200"} 1' in text
+    assert 'socketio_event_seconds_count{event="request_metrics"}' in text
+    assert 'metrics_cache_refresh_seconds_count' in text
+    assert 'socketio_connections 1' in text
+    assert 'metrics_cache_misses_total' in text
+    socket_client.disconnect()
+    assert instrumentation.registry.render().count('socketio_connections 0') == 1
+
+    readings = self_metrics()
+    assert readings['socketio_connections'] == 0 and readings['http_request_seconds_count'] >= 2
+    ingest_self_metrics(readings, mongo)
+    assert mongo.db.metrics.count_documents({'name': 'metricshandler.http_request_seconds_mean'}) == 1
@@ -1,16 +1,22 @@
+import gzip
+import threading
+import time
 from unittest.mock import Mock
 from flask_pymongo import PyMongo
 from flask_bcrypt import Bcrypt
 from flask import Flask, json
 from flask_login import LoginManager
 from flask_socketio import SocketIO
+import numpy as np
 import pytest
-from api.metrics import init_metrics_module
+from api.metrics import answer_metrics_request, downsample_cache, hot_window, init_metrics_module, metric_cache, refresh_metrics_cache
+from api.rollups import update_rollups
 from flask.testing import FlaskClient
 from flask_jwt_extended import JWTManager
 from flask_limiter import Limiter
 from api.auth import init_auth_module
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
+from mongomock import MongoClient
 
 # Fixture for Flask app
 @pytest.fixture
@@ -79,3 +85,347 @@ def test_get_metrics(client, mocker):
     assert 'metrics' in data
     assert isinstance(data['metrics'], list)
 
+
+# Fixture for a Flask app backed by mongomock, for tests that need to inspect stored data
+@pytest.fixture
+def mock_mongo():
+    mongo = MongoClient()
+    yield mongo
+    mongo.drop_database('db')
+
+@pytest.fixture
+def mock_client(mock_mongo):
+    app = Flask(__name__)
+    app.config['TESTING'] = True
+    app.config['SECRET_KEY'] = 'test_secret_key'
+    socketio = SocketIO(app, cors_allowed_origins='*')
+    init_metrics_module(app, mock_mongo, socketio, LoginManager(app))
+    metric_cache.clear()
+    with app.test_client() as client:
+        yield client
+
+# Test logging a JSON array of metrics with per-record errors
+def test_log_metrics_batch(mock_client, mock_mongo):
+    batch = [
+        {'name': 'test_metric', 'value': 1, 'timestamp': '2021-01-01T01:00:00+00:00'},
+        {'name': 'test_metric', 'value': 'not a number'},
+        {'name': 'other_metric', 'value': 3},
+    ]
+
+    response = mock_client.post('/metrics/log_metrics_batch', json=batch)
+    assert response.status_code == 207
+    data = json.loads(response.data)
+    assert data['inserted'] == 2
+    assert [error['index'] for error in data['errors']] == [1]
+    assert mock_mongo.db.metrics.count_documents({}) == 2
+    stored = mock_mongo.db.metrics.find_one({'name': 'test_metric'})
+    assert stored['timestamp'] == datetime(2021, 1, 1, 1, 0)
+
+# Test logging an NDJSON stream of metrics
+def test_log_metrics_batch_ndjson(mock_client, mock_mongo):
+    body = '\n'.join([
+        '{"name": "test_metric", "value": 1}',
+        '{"name": "test_metric", "value": 2}',
+        '{not json',
+        '',
+    ])
+
+    response = mock_client.post('/metrics/log_metrics_batch', data=body, content_type='application/x-ndjson')
+    assert response.status_code == 207
+    data = json.loads(response.data)
+    assert data['inserted'] == 2
+    assert data['errors'][0]['index'] == 2
+    assert mock_mongo.db.metrics.count_documents({'name': 'test_metric'}) == 2
+
+def test_log_metrics_batch_rejects_non_array(mock_client):
+    response = mock_client.post('/metrics/log_metrics_batch', json={'name': 'test_metric', 'value': 1})
+    assert response.status_code == 400
+
+# Test that single metrics are queued and written on flush
+def test_log_metrics_write_behind(mock_client, mock_mongo):
+    response = mock_client.post('/metrics/log_metrics', json={'name': 'test_metric', 'value': 5})
+    assert response.status_code == 200
+
+    mock_client.application.extensions['metrics_ingest'].flush()
+    assert mock_mongo.db.metrics.count_documents({'name': 'test_metric'}) == 1
+    stats = json.loads(mock_client.get('/metrics/ingest_stats').data)
+    assert stats['flushed'] == 1
+    assert stats['queue_depth'] == 0
+
+def test_log_metrics_backpressure(mock_client):
+    mock_client.application.extensions['metrics_ingest'].max_size = 1
+
+    assert mock_client.post('/metrics/log_metrics', json={'name': 'test_metric', 'value': 1}).status_code == 200
+    response = mock_client.post('/metrics/log_metrics', json={'name': 'test_metric', 'value': 2})
+    assert response.status_code == 429
+
+# Test that batch-logged metrics are served from the rollups
+def test_get_metrics_from_rollups(mock_client):
+    batch = [{'name': 'rollup_metric', 'value': value, 'timestamp': f'2021-01-01T0{hour}:15:00+00:00'}
+             for hour, value in ((1, 10), (1, 30), (3, 50))]
+    assert mock_client.post('/metrics/log_metrics_batch', json=batch).status_code == 200
+
+    response = mock_client.post('/metrics/get_metrics', json={
+        'name': 'rollup_metric',
+        'startDate': '2021-01-01T00:00:00',
+        'endDate': '2021-01-01T05:00:00',
+        'interval': 'hour',
+        'include_zeros': True
+    })
+    metrics = json.loads(response.data)['metrics']
+    assert len(metrics) == 6
+    assert metrics[1] == {'_id': '2021-01-01 01:00', 'average_value': 20}
+    assert metrics[3] == {'_id': '2021-01-01 03:00', 'average_value': 50}
+    assert metrics[0]['average_value'] == 0
+
+def test_cache_stats(mock_client):
+    request = {'name': 'cached_metric', 'startDate': '2021-01-01T00:00:00', 'endDate': '2021-01-01T05:00:00',
+               'interval': 'hour', 'include_zeros': False}
+    mock_client.post('/metrics/get_metrics', json=request)
+    mock_client.post('/metrics/get_metrics', json=request)
+
+    stats = json.loads(mock_client.get('/metrics/cache_stats').data)
+    assert stats['series']['entries'] == 1
+    assert stats['queries']['misses'] == 1
+    assert stats['queries']['hits'] == 1
+
+# Test that the cache refresher picks up points stored by another process
+def test_refresh_metrics_cache(mock_client, mock_mongo):
+    request = {'name': 'late_metric', 'startDate': '2021-01-01T00:00:00', 'endDate': '2021-01-01T05:00:00',
+               'interval': 'hour', 'include_zeros': False}
+    assert json.loads(mock_client.post('/metrics/get_metrics', json=request).data)['metrics'] == []
+
+    # Stored by another worker: raw point and rollups, but not this worker's cache
+    late_point = {'name': 'late_metric', 'value': 42.0, 'timestamp': datetime(2021, 1, 1, 2, 30, tzinfo=timezone.utc)}
+    mock_mongo.db.metrics.insert_one(dict(late_point))
+    update_rollups([late_point], mock_mongo)
+
+    assert refresh_metrics_cache(mock_mongo) == [('late_metric', 'hour')]
+    metrics = json.loads(mock_client.post('/metrics/get_metrics', json=request).data)['metrics']
+    assert metrics == [{'_id': '2021-01-01 02:00', 'average_value': 42.0}]
+    assert refresh_metrics_cache(mock_mongo) == []
+
+    # Points ingested through the app are counted once
+    mock_client.post('/metrics/log_metrics_batch', json=[{'name': 'late_metric', 'value': 40.0,
+                                                          'timestamp': '2021-01-01T02:45:00+00:00'}])
+    assert refresh_metrics_cache(mock_mongo) == []
+    metrics = json.loads(mock_client.post('/metrics/get_metrics', json=request).data)['metrics']
+    assert metrics == [{'_id': '2021-01-01 02:00', 'average_value': 41.0}]
+
+    # Written straight to the raw collection: the cache keeps agreeing with the rollups
+    mock_mongo.db.metrics.insert_one({'name': 'late_metric', 'value': 0.0,
+                                      'timestamp': datetime(2021, 1, 1, 2, 50, tzinfo=timezone.utc)})
+    assert refresh_metrics_cache(mock_mongo) == [('late_metric', 'hour')]
+    metrics = json.loads(mock_client.post('/metrics/get_metrics', json=request).data)['metrics']
+    assert metrics == [{'_id': '2021-01-01 02:00', 'average_value': 41.0}]
+
+# Test that open-ended ranges are clamped to the data instead of datetime.min/max
+def test_get_metrics_open_range(mock_client):
+    batch = [{'name': 'open_metric', 'value': 1, 'timestamp': '2021-01-01T01:15:00+00:00'},
+             {'name': 'open_metric', 'value': 3, 'timestamp': '2021-01-01T03:45:00+00:00'}]
+    mock_client.post('/metrics/log_metrics_batch', json=batch)
+
+    response = mock_client.post('/metrics/get_metrics', json={
+        'name': 'open_metric', 'startDate': None, 'endDate': None, 'interval': 'minute', 'include_zeros': True})
+    assert response.status_code == 200
+    metrics = json.loads(response.data)['metrics']
+    assert len(metrics) == 151
+    assert metrics[0] == {'_id': '2021-01-01 01:15', 'average_value': 1}
+    assert metrics[-1] == {'_id': '2021-01-01 03:45', 'average_value': 3}
+
+def test_get_metrics_too_many_buckets(mock_client):
+    response = mock_client.post('/metrics/get_metrics', json={
+        'name': 'test_metric', 'startDate': '2000-01-01T00:00:00', 'endDate': '2021-01-01T00:00:00',
+        'interval': 'minute', 'include_zeros': True})
+    assert response.status_code == 400
+
+# Test server-side downsampling with max_points
+def test_get_metrics_max_points(mock_client):
+    batch = [{'name': 'dense_metric', 'value': i % 17, 'timestamp': f'2021-01-01T{i // 60:02d}:{i % 60:02d}:00+00:00'}
+             for i in range(600)]
+    mock_client.post('/metrics/log_metrics_batch', json=batch)
+    request = {'name': 'dense_metric', 'startDate': '2021-01-01T00:00:00', 'endDate': '2021-01-01T09:59:00',
+               'interval': 'minute', 'include_zeros': True, 'max_points': 50}
+
+    metrics = json.loads(mock_client.post('/metrics/get_metrics', json=request).data)['metrics']
+    assert len(metrics) == 50
+    assert metrics[0]['_id'] == '2021-01-01 00:00'
+    assert metrics[-1]['_id'] == '2021-01-01 09:59'
+    hits = downsample_cache.hits
+    assert json.loads(mock_client.post('/metrics/get_metrics', json=request).data)['metrics'] == metrics
+    assert downsample_cache.hits == hits + 1
+
+# Test that several statistics are returned per bucket, percentiles included
+def test_get_metrics_stats(mock_client):
+    batch = [{'name': 'latency', 'value': value, 'timestamp': f'2021-01-01T01:{value % 60:02d}:00+00:00'}
+             for value in range(1, 101)]
+    mock_client.post('/metrics/log_metrics_batch', json=batch)
+    request = {'name': 'latency', 'startDate': '2021-01-01T00:00:00', 'endDate': '2021-01-01T01:59:00',
+               'interval': 'hour', 'include_zeros': True, 'stats': ['avg', 'count', 'max', 'p95']}
+
+    metrics = json.loads(mock_client.post('/metrics/get_metrics', json=request).data)['metrics']
+    assert metrics[0] == {'_id': '2021-01-01 00:00', 'average_value': 0, 'count': 0, 'max': 0, 'p95': 0}
+    assert (metrics[1]['average_value'], metrics[1]['count'], metrics[1]['max']) == (50.5, 100, 100)
+    assert abs(metrics[1]['p95'] - 95) <= 1
+
+    request['stats'] = ['p101']
+    assert mock_client.post('/metrics/get_metrics', json=request).status_code == 400
+
+# Test fetching several series in one request, by names and by glob
+def test_get_metrics_multi(mock_client):
+    batch = [{'name': name, 'value': value, 'timestamp': '2021-01-01T01:15:00+00:00'}
+             for name, value in (('cpu.user', 10), ('cpu.system', 20), ('mem.used', 30))]
+    mock_client.post('/metrics/log_metrics_batch', json=batch)
+    request = {'startDate': '2021-01-01T00:00:00', 'endDate': '2021-01-01T02:00:00', 'interval': 'hour',
+               'include_zeros': True, 'names': ['cpu.user', 'mem.used', 'missing']}
+
+    response = mock_client.post('/metrics/get_metrics_multi', json=request)
+    assert response.status_code == 200
+    series = json.loads(response.data)['series']
+    assert sorted(series) == ['cpu.user', 'mem.used', 'missing']
+    assert series['cpu.user'][1] == {'_id': '2021-01-01 01:00', 'average_value': 10}
+    assert series['mem.used'][1]['average_value'] == 30
+    assert [point['average_value'] for point in series['missing']] == [0, 0, 0]
+    assert metric_cache.stats()['queries']['misses'] == 3
+
+    del request['names']
+    request['pattern'] = 'cpu.*'
+    series = json.loads(mock_client.post('/metrics/get_metrics_multi', json=request).data)['series']
+    assert sorted(series) == ['cpu.system', 'cpu.user']
+    assert series['cpu.system'][1]['average_value'] == 20
+    assert metric_cache.stats()['queries']['hits'] == 1
+
+    request['names'] = ['cpu.user']
+    assert mock_client.post('/metrics/get_metrics_multi', json=request).status_code == 400
+
+# Test listing metric names from the catalog, with prefix search and keyset pages
+def test_metric_catalog(mock_client):
+    batch = [{'name': name, 'value': value, 'timestamp': f'2021-01-01T0{value}:00:00+00:00'}
+             for name, value in (('cpu.user', 1), ('cpu.system', 2), ('mem.used', 3), ('cpu.user', 4))]
+    mock_client.post('/metrics/log_metrics_batch', json=batch)
+
+    assert json.loads(mock_client.get('/metrics/get_metric_names').data) == ['cpu.system', 'cpu.user', 'mem.used']
+    assert json.loads(mock_client.get('/metrics/get_metric_names?prefix=cpu.').data) == ['cpu.system', 'cpu.user']
+
+    page = json.loads(mock_client.get('/metrics/catalog?limit=2').data)
+    assert [entry['name'] for entry in page['metrics']] == ['cpu.system', 'cpu.user']
+    assert page['metrics'][1]['count'] == 2
+    assert page['metrics'][1]['last_value'] == 4
+    assert page['metrics'][1]['last_seen'] == '2021-01-01T04:00:00+00:00'
+    page = json.loads(mock_client.get(f"/metrics/catalog?limit=2&after={page['next']}").data)
+    assert [entry['name'] for entry in page['metrics']] == ['mem.used']
+    assert page['next'] is None
+
+    assert mock_client.get('/metrics/catalog?limit=0').status_code == 400
+
+# Test columnar, compressed and binary Socket.IO representations of a series
+def test_get_metrics_columnar(mock_client, mock_mongo):
+    batch = [{'name': 'columnar_metric', 'value': hour + 1, 'timestamp': f'2021-01-01T{hour:02d}:15:00+00:00'}
+             for hour in range(24)]
+    assert mock_client.post('/metrics/log_metrics_batch', json=batch).status_code == 200
+    query = {'name': 'columnar_metric', 'startDate': '2021-01-01T00:00:00', 'endDate': '2021-01-01T23:59:00',
+             'interval': 'minute', 'include_zeros': True, 'stats': ['avg', 'max']}
+
+    response = mock_client.post('/metrics/get_metrics', json=query,
+                                headers={'Accept': 'application/vnd.metrics.columns+json', 'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    columns = json.loads(gzip.decompress(response.data))['series']['columnar_metric']
+    assert len(columns['timestamps']) == 1440
+    assert columns['timestamps'][1] - columns['timestamps'][0] == 60 * 1000
+    assert columns['average_value'][75] == 2
+
+    rows = json.loads(mock_client.post('/metrics/get_metrics', json=query).data)['metrics']
+    assert rows[75] == {'_id': '2021-01-01 01:15', 'average_value': 2, 'max': 2}
+
+    event, payload = answer_metrics_request({**query, 'columnar': True}, mock_mongo)
+    assert event == 'metrics_data'
+    assert np.frombuffer(payload['columns']['max'], dtype='<f8')[15::60].tolist() == list(range(1, 25))
+
+    # A name without data keeps every requested column, in every representation
+    multi = {**query, 'names': ['columnar_metric', 'columnar_missing'], 'include_zeros': False}
+    columns = json.loads(mock_client.post('/metrics/get_metrics_multi', json=multi,
+                                          headers={'Accept': 'application/vnd.metrics.columns+json'}).data)['series']
+    assert columns['columnar_missing'] == {'timestamps': [], 'average_value': [], 'max': []}
+    event, payload = answer_metrics_request({**multi, 'columnar': True}, mock_mongo)
+    assert payload['series']['columnar_missing'] == {'timestamps': b'', 'average_value': b'', 'max': b''}
+    pa = pytest.importorskip('pyarrow')
+    response = mock_client.post('/metrics/get_metrics_multi', json=multi,
+                                headers={'Accept': 'application/vnd.apache.arrow.stream'})
+    assert response.status_code == 200
+    table = pa.ipc.open_stream(response.data).read_all()
+    assert table.column_names == ['name', 'timestamp', 'average_value', 'max']
+    assert table.num_rows == 24
+
+# Test answering recent buckets from the hot window and older ones from the rollups
+def test_get_metrics_hot_window(mock_client, mock_mongo):
+    hot_window.configure(3600, 1000)
+    try:
+        check_hot_window(mock_client, mock_mongo)
+    finally:
+        hot_window.configure(0, 1000)
+
+def check_hot_window(mock_client, mock_mongo):
+    # The window holds points from when it was configured, so use a bucket after that
+    recent = datetime.now(timezone.utc).replace(second=0, microsecond=0) + timedelta(minutes=2)
+    old = recent - timedelta(hours=2)
+    batch = [{'name': 'hot_metric', 'value': value, 'timestamp': timestamp.isoformat()}
+             for value, timestamp in ((1, old), (3, recent), (5, recent + timedelta(seconds=30)))]
+    mock_client.post('/metrics/log_metrics_batch', json=batch)
+    request = {'name': 'hot_metric', 'startDate': old.replace(tzinfo=None).isoformat(),
+               'endDate': recent.replace(tzinfo=None).isoformat(), 'interval': 'minute', 'stats': ['avg', 'count', 'p50']}
+
+    # Recent buckets no longer need the rollups
+    mock_mongo.db.metrics_minute.delete_many({'bucket': {'$gte': recent}})
+    metrics = json.loads(mock_client.post('/metrics/get_metrics', json=request).data)['metrics']
+    assert [(point['average_value'], point['count']) for point in metrics] == [(1, 1), (4, 2)]
+    assert abs(metrics[1]['p50'] - 3) < 0.1
+    # The old point predates the window and is only read from the rollups
+    assert json.loads(mock_client.get('/metrics/cache_stats').data)['hot_window']['points'] == 2
+
+# Test that concurrent identical requests run the rollup query once
+def test_get_metrics_coalesces_identical_requests(mock_client, mock_mongo, monkeypatch):
+    from api import metrics
+    update_rollups([{'name': 'busy_metric', 'value': 7.0, 'timestamp': datetime(2021, 1, 1, 1, tzinfo=timezone.utc)}], mock_mongo)
+    queries = []
+
+    def slow_rollup_buckets(*args):
+        queries.append(args)
+        time.sleep(0.2)
+        return get_rollup_buckets(*args)
+
+    get_rollup_buckets = metrics.get_rollup_buckets
+    monkeypatch.setattr(metrics, 'get_rollup_buckets', slow_rollup_buckets)
+    request = {'name': 'busy_metric', 'startDate': '2021-01-01T00:00:00', 'endDate': '2021-01-01T05:00:00',
+               'interval': 'hour'}
+    responses = []
+    app = mock_client.application
+    threads = [threading.Thread(target=lambda: responses.append(app.test_client().post('/metrics/get_metrics', json=request)))
+               for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert len(queries) == 1
+    assert [json.loads(response.data)['metrics'] for response in responses] == [
+        [{'_id': '2021-01-01 01:00', 'average_value': 7.0}]] * 5
+
+# Test that responses report the coarser interval a range past the retention is served at
+def test_get_metrics_reports_served_interval(mock_client, mock_mongo, monkeypatch):
+    from api import metrics
+    from api.retention import RetentionPolicy
+    monkeypatch.setattr(metrics, 'retention', RetentionPolicy(minute=7))
+    start = (datetime.now(timezone.utc) - timedelta(days=30)).replace(tzinfo=None, microsecond=0)
+    request = {'name': 'retained_metric', 'startDate': start.isoformat(),
+               'endDate': (start + timedelta(hours=2)).isoformat(), 'interval': 'minute'}
+
+    response = mock_client.post('/metrics/get_metrics', json=request)
+    assert json.loads(response.data)['interval'] == 'hour'
+    assert response.headers['X-Metrics-Interval'] == 'hour'
+    response = mock_client.post('/metrics/get_metrics_multi', json={**request, 'name': None, 'names': ['retained_metric']})
+    assert json.loads(response.data)['interval'] == 'hour'
+    event, payload = answer_metrics_request({**request, 'name': None, 'names': ['retained_metric']}, mock_mongo)
+    assert payload['interval'] == 'hour'
+    recent = {**request, 'startDate': (datetime.now(timezone.utc) - timedelta(hours=1)).replace(tzinfo=None).isoformat(),
+              'endDate': None}
+    assert json.loads(mock_client.post('/metrics/get_metrics', json=recent).data)['interval'] == 'minute'
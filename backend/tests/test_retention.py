@@ -0,0 +1,74 @@
+import pytest
+from datetime import datetime, timedelta, timezone
+from mongomock import MongoClient
+from api import metrics
+from api.retention import RetentionPolicy, apply_retention
+
+NOW = datetime(2021, 6, 1, tzinfo=timezone.utc)
+
+
+class CommandRecordingDb:
+    """mongomock database that records the commands it does not implement (collMod)."""
+
+    def __init__(self):
+        self.db = MongoClient().db
+        self.commands = []
+
+    def __getitem__(self, name):
+        return self.db[name]
+
+    def command(self, *args, **kwargs):
+        self.commands.append((args, kwargs))
+
+
+def test_policy_validation():
+    with pytest.raises(ValueError):
+        RetentionPolicy(minute=30, hour=7)
+    with pytest.raises(ValueError):
+        RetentionPolicy(hour=30)  # minute rollups kept forever, hour rollups not
+    with pytest.raises(ValueError):
+        RetentionPolicy(week=30)
+    policy = RetentionPolicy(raw=1, minute=7, hour=90)
+    assert policy.expire_after('raw') == 86400
+    assert policy.expire_after('day') is None
+
+def test_query_interval_steps_up_to_a_retained_tier():
+    policy = RetentionPolicy(raw=1, minute=7, hour=90)
+    assert policy.query_interval('minute', NOW - timedelta(days=3), NOW) == 'minute'
+    assert policy.query_interval('minute', NOW - timedelta(days=30), NOW) == 'hour'
+    assert policy.query_interval('minute', NOW - timedelta(days=365), NOW) == 'day'
+    assert policy.query_interval('hour', NOW - timedelta(days=3), NOW) == 'hour'
+    assert RetentionPolicy().query_interval('minute', NOW - timedelta(days=365), NOW) == 'minute'
+
+def test_apply_retention_sets_ttl_indexes():
+    db = CommandRecordingDb()
+    db['metrics'].create_index([('timestamp', 1)])
+    db['metrics_minute'].create_index([('bucket', 1)], expireAfterSeconds=3600)
+    policy = RetentionPolicy(raw=1, minute=7)
+
+    assert len(apply_retention(db, policy, dry_run=True)) == 2
+    assert 'expireAfterSeconds' not in db['metrics'].index_information()['timestamp_1']
+
+    actions = apply_retention(db, policy)
+    assert len(actions) == 2
+    # A plain index is rebuilt with a TTL, an existing TTL is changed in place
+    assert db['metrics'].index_information()['timestamp_1']['expireAfterSeconds'] == 86400
+    assert db.commands == [(('collMod', 'metrics_minute'), {'index': {'keyPattern': {'bucket': 1}, 'expireAfterSeconds': 7 * 86400}})]
+    assert 'bucket_1' not in db['metrics_hour'].index_information()
+
+    actions = apply_retention(db, RetentionPolicy(minute=7))
+    assert actions[0] == 'metrics: index on timestamp expireAfterSeconds 86400 -> None'
+    assert 'expireAfterSeconds' not in db['metrics'].index_information()['timestamp_1']
+
+def test_apply_retention_timeseries():
+    db = CommandRecordingDb()
+    db.command = lambda *args, **kwargs: (db.commands.append((args, kwargs)) or
+                                          {'cursor': {'firstBatch': [{'name': 'metrics_ts', 'options': {}}]}})
+    apply_retention(db, RetentionPolicy(raw=2), 'metrics_ts', timeseries=True)
+    assert (('collMod', 'metrics_ts'), {'expireAfterSeconds': 2 * 86400}) in db.commands
+
+def test_metrics_query_uses_retained_interval(monkeypatch):
+    monkeypatch.setattr(metrics, 'retention', RetentionPolicy(minute=7))
+    data = {'name': 'cpu', 'interval': 'minute'}
+    assert metrics.retained_interval(data, datetime.now(timezone.utc) - timedelta(days=1)) is data
+    assert metrics.retained_interval(data, datetime.now(timezone.utc) - timedelta(days=30)) == {'name': 'cpu', 'interval': 'hour'}
@@ -0,0 +1,87 @@
+import mongomock
+import pytest
+from datetime import datetime, timezone
+from mongomock import MongoClient
+from pymongo.errors import ConnectionFailure
+from api.rollups import (ROLLUP_COLLECTIONS, bucket_start, coarsest_rollup, format_buckets, get_rollup_buckets,
+                         pending_rollups, retry_rollups, update_rollups)
+
+
+@pytest.fixture
+def mock_mongo():
+    mongo = MongoClient()
+    yield mongo
+    mongo.drop_database('db')
+
+def point(value, hour, minute=0, name='test_metric'):
+    return {'name': name, 'value': value, 'timestamp': datetime(2021, 1, 1, hour, minute, tzinfo=timezone.utc)}
+
+def test_bucket_start():
+    timestamp = datetime(2021, 1, 1, 5, 42, 17, 123, tzinfo=timezone.utc)
+    assert bucket_start(timestamp, 'minute') == datetime(2021, 1, 1, 5, 42, tzinfo=timezone.utc)
+    assert bucket_start(timestamp, 'hour') == datetime(2021, 1, 1, 5, tzinfo=timezone.utc)
+    assert bucket_start(timestamp, 'day') == datetime(2021, 1, 1, tzinfo=timezone.utc)
+
+def test_coarsest_rollup():
+    assert coarsest_rollup('minute') == 'minute'
+    assert coarsest_rollup('hour') == 'hour'
+    assert coarsest_rollup('day') == 'day'
+
+def test_update_rollups_accumulates(mock_mongo):
+    update_rollups([point(10, 1), point(20, 1, 30)], mock_mongo)
+    update_rollups([point(60, 1, 45), point(5, 2)], mock_mongo)
+
+    hour = mock_mongo.db[ROLLUP_COLLECTIONS['hour']].find_one({'bucket': datetime(2021, 1, 1, 1)})
+    assert (hour['sum'], hour['count'], hour['min'], hour['max']) == (90, 3, 10, 60)
+    day = mock_mongo.db[ROLLUP_COLLECTIONS['day']].find_one({'name': 'test_metric'})
+    assert (day['sum'], day['count'], day['min'], day['max']) == (95, 4, 5, 60)
+    assert mock_mongo.db[ROLLUP_COLLECTIONS['minute']].count_documents({}) == 4
+
+def rollup_metrics(name, start_date, end_date, interval, mongo, stats=('avg',)):
+    """Rollup buckets of ``name`` rendered as get_metrics_data renders them."""
+    buckets = get_rollup_buckets(name, bucket_start(start_date, interval), bucket_start(end_date, interval), interval, mongo)
+    return format_buckets(buckets, interval, stats)
+
+def test_get_rollup_buckets(mock_mongo):
+    update_rollups([point(10, 1), point(20, 1, 30), point(5, 2), point(7, 3, name='other_metric')], mock_mongo)
+
+    start = datetime(2021, 1, 1, 0, 30, tzinfo=timezone.utc)
+    end = datetime(2021, 1, 1, 23, tzinfo=timezone.utc)
+    assert rollup_metrics('test_metric', start, end, 'hour', mock_mongo) == [
+        {'_id': '2021-01-01 01:00', 'average_value': 15},
+        {'_id': '2021-01-01 02:00', 'average_value': 5},
+    ]
+    assert rollup_metrics('test_metric', start, end, 'day', mock_mongo) == [
+        {'_id': '2021-01-01', 'average_value': 35 / 3},
+    ]
+
+def test_percentiles_merge_across_rollups(mock_mongo):
+    update_rollups([point(value, value % 24, value % 60) for value in range(1, 1001)], mock_mongo)
+
+    start = datetime(2021, 1, 1, tzinfo=timezone.utc)
+    [day] = rollup_metrics('test_metric', start, start, 'day', mock_mongo, ['count', 'min', 'max', 'p50', 'p95'])
+    assert (day['count'], day['min'], day['max']) == (1000, 1, 1000)
+    assert abs(day['p50'] - 500) <= 5
+    assert abs(day['p95'] - 950) <= 10
+
+def test_failed_rollup_write_is_retried(mock_mongo, monkeypatch):
+    bulk_write = mongomock.Collection.bulk_write
+    failing = {ROLLUP_COLLECTIONS['hour']}
+
+    def flaky_bulk_write(self, requests, **kwargs):
+        if self.name in failing:
+            raise ConnectionFailure('down')
+        return bulk_write(self, requests, **kwargs)
+
+    monkeypatch.setattr(mongomock.Collection, 'bulk_write', flaky_bulk_write)
+    update_rollups([point(10, 1), point(20, 1, 30)], mock_mongo)
+    assert mock_mongo.db[ROLLUP_COLLECTIONS['hour']].count_documents({}) == 0
+    assert mock_mongo.db[ROLLUP_COLLECTIONS['day']].count_documents({}) == 1
+    assert pending_rollups() == 1
+
+    failing.clear()
+    assert retry_rollups(mock_mongo) == 0
+    hour = mock_mongo.db[ROLLUP_COLLECTIONS['hour']].find_one({'name': 'test_metric'})
+    assert (hour['sum'], hour['count']) == (30, 2)
+    day = mock_mongo.db[ROLLUP_COLLECTIONS['day']].find_one({'name': 'test_metric'})
+    assert (day['sum'], day['count']) == (30, 2)
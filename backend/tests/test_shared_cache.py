@@ -0,0 +1,57 @@
+import time
+import fakeredis
+from bson import ObjectId
+from datetime import datetime, timezone
+from api.cache import BucketCache
+from api.rollups import point_stats
+from api.shared_cache import InvalidationBus, RedisSeriesStore
+
+
+NOW = datetime(2021, 1, 2, 12, 30, tzinfo=timezone.utc)
+
+def hour(h):
+    return datetime(2021, 1, 1, h, tzinfo=timezone.utc)
+
+def fetch_hours(calls):
+    def fetch(first, last):
+        calls.append((first, last))
+        return {hour(h): point_stats(h) for h in range(first.hour, last.hour + 1)}
+    return fetch
+
+def worker(server):
+    cache = BucketCache()
+    cache.configure(max_series=10, max_bytes=1024 * 1024, ttl=60, store=RedisSeriesStore(fakeredis.FakeRedis(server=server)))
+    return cache
+
+def test_series_are_shared_between_workers():
+    server = fakeredis.FakeServer()
+    first, second = worker(server), worker(server)
+    calls = []
+
+    first.get_buckets('cpu', 'hour', hour(0), hour(5), fetch_hours(calls), now=NOW)
+    buckets = second.get_buckets('cpu', 'hour', hour(0), hour(5), fetch_hours(calls), now=NOW)
+    assert len(calls) == 1
+    assert buckets[hour(3)] == point_stats(3)
+
+    # A late point drops the shared copy, so a cold worker reads fresh data
+    first.apply_points([{'name': 'cpu', 'value': 30, 'timestamp': hour(3)}], now=NOW)
+    worker(server).get_buckets('cpu', 'hour', hour(0), hour(5), fetch_hours(calls), now=NOW)
+    assert len(calls) == 2
+
+def test_invalidation_bus_delivers_to_other_workers():
+    server = fakeredis.FakeServer()
+    received = []
+    publisher, listener = InvalidationBus(), InvalidationBus()
+    publisher.connect(fakeredis.FakeRedis(server=server), lambda points: received.append(('self', points)))
+    listener.connect(fakeredis.FakeRedis(server=server), lambda points: received.append(('other', points)))
+    try:
+        time.sleep(0.2)
+        point = {'_id': ObjectId(), 'name': 'cpu', 'value': 1.5, 'timestamp': hour(3)}
+        publisher.publish([point])
+        deadline = time.time() + 5
+        while not received and time.time() < deadline:
+            time.sleep(0.05)
+        assert received == [('other', [point])]
+    finally:
+        publisher.close()
+        listener.close()
@@ -0,0 +1,26 @@
+import random
+from api.sketch import RELATIVE_ACCURACY, sketch_add, sketch_merge, sketch_quantile
+
+
+def exact_quantile(values, q):
+    return sorted(values)[int(q * (len(values) - 1))]
+
+def test_quantiles_within_relative_accuracy():
+    rng = random.Random(7)
+    values = [rng.lognormvariate(3, 1.5) for _ in range(10000)] + [0.0, -5.0, -20.0]
+    sketch = {}
+    for value in values:
+        sketch_add(sketch, value)
+    for q in (0.0, 0.5, 0.9, 0.95, 0.99, 1.0):
+        expected = exact_quantile(values, q)
+        assert abs(sketch_quantile(sketch, q) - expected) <= RELATIVE_ACCURACY * abs(expected) + 1e-9
+
+def test_merged_sketches_match_a_single_sketch():
+    values = [float(v) for v in range(1, 1001)]
+    whole, first, second = {}, {}, {}
+    for value in values:
+        sketch_add(whole, value)
+        sketch_add(first if value % 2 else second, value)
+    sketch_merge(first, second)
+    assert first == whole
+    assert sketch_quantile({}, 0.5) is None
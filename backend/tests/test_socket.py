@@ -1,7 +1,8 @@
 import pytest
 from flask import Flask
 from flask_socketio import SocketIO
-from api.metrics import init_metrics_module
+from api.metrics import init_metrics_module, store_metrics
+from api.rollups import ROLLUP_COLLECTIONS
 from flask_pymongo import PyMongo
 from flask_login import LoginManager
 from api.auth import init_auth_module
@@ -49,12 +50,13 @@ def test_request_metrics(app, client):
     with app.app_context():
         # Clear previous data and insert new test data
         app.mongo.db.metrics.delete_many({})
-        for i in range(1, 6):
-            app.mongo.db.metrics.insert_one({
-                'name': 'test_metric',
-                'value': i * 100,
-                'timestamp': datetime(2021, 1, 1, i, 0, 0, tzinfo=timezone.utc)
-            })
+        for collection in ROLLUP_COLLECTIONS.values():
+            app.mongo.db[collection].delete_many({})
+        store_metrics([{
+            'name': 'test_metric',
+            'value': i * 100,
+            'timestamp': datetime(2021, 1, 1, i, 0, 0, tzinfo=timezone.utc)
+        } for i in range(1, 6)], app.mongo)
 
     client.connect()
     test_data = {
@@ -78,3 +80,81 @@ def test_request_metrics(app, client):
 
 
 
+@pytest.fixture
+def mock_app():
+    from mongomock import MongoClient
+    from api.metrics import metric_cache
+
+    mongo = MongoClient()
+    app = Flask(__name__)
+    app.config['TESTING'] = True
+    app.config['SECRET_KEY'] = 'test_secret_key'
+    app.config['INGEST_WRITE_BEHIND'] = False
+    app.config['METRICS_PUSH_INTERVAL'] = 3600  # tests push explicitly
+    socketio = SocketIO(app, cors_allowed_origins='*')
+    init_metrics_module(app, mongo, socketio, LoginManager(app))
+    metric_cache.clear()
+    app.socketio = socketio
+    app.mongo = mongo
+    yield app
+    mongo.drop_database('db')
+
+def event_names(received):
+    return [event['name'] for event in received]
+
+SUBSCRIPTION = {'name': 'room_metric', 'startDate': '2021-01-01T00:00:00', 'endDate': '2021-01-01T05:00:00',
+                'interval': 'hour', 'include_zeros': False}
+
+def log_batch(app, *points):
+    app.test_client().post('/metrics/log_metrics_batch', json=[
+        {'name': 'room_metric', 'value': value, 'timestamp': timestamp} for value, timestamp in points])
+
+# Test that results and updates only reach the subscribed clients
+def test_subscriptions_are_delivered_to_rooms(mock_app):
+    from api.metrics import push_metric_updates
+
+    watcher = mock_app.socketio.test_client(mock_app)
+    bystander = mock_app.socketio.test_client(mock_app)
+    watcher.emit('subscribe_metrics', SUBSCRIPTION)
+    assert event_names(watcher.get_received()) == ['metrics_snapshot']
+    bystander.emit('request_metrics', SUBSCRIPTION)
+    assert event_names(bystander.get_received()) == ['metrics_data']
+    assert watcher.get_received() == []
+
+    log_batch(mock_app, (1, '2021-01-01T02:00:00+00:00'), (1, '2021-01-02T02:00:00+00:00'))
+    assert push_metric_updates(mock_app.socketio, mock_app.mongo) == 1
+    assert event_names(watcher.get_received()) == ['metrics_delta']
+    assert bystander.get_received() == []
+
+    watcher.emit('unsubscribe_metrics', SUBSCRIPTION)
+    assert event_names(watcher.get_received()) == ['unsubscribed']
+    log_batch(mock_app, (2, '2021-01-01T03:00:00+00:00'))
+    assert push_metric_updates(mock_app.socketio, mock_app.mongo) == 0
+    assert watcher.get_received() == []
+    watcher.disconnect()
+    bystander.disconnect()
+
+# Test that updates within a tick are coalesced into one sequenced delta of changed buckets
+def test_coalesced_deltas(mock_app):
+    from api.metrics import push_metric_updates
+
+    log_batch(mock_app, (5, '2021-01-01T01:10:00+00:00'))
+    client = mock_app.socketio.test_client(mock_app)
+    client.emit('subscribe_metrics', SUBSCRIPTION)
+    snapshot = client.get_received()[0]['args'][0]
+    assert (snapshot['seq'], snapshot['metrics']) == (0, [{'_id': '2021-01-01 01:00', 'average_value': 5}])
+
+    log_batch(mock_app, (10, '2021-01-01T02:05:00+00:00'), (20, '2021-01-01T02:35:00+00:00'))
+    log_batch(mock_app, (30, '2021-01-01T04:00:00+00:00'))
+    push_metric_updates(mock_app.socketio, mock_app.mongo)
+    [delta] = [event['args'][0] for event in client.get_received()]
+    assert delta['seq'] == 1
+    assert delta['full'] is False
+    assert delta['metrics'] == [{'_id': '2021-01-01 02:00', 'average_value': 15}, {'_id': '2021-01-01 04:00', 'average_value': 30}]
+    assert push_metric_updates(mock_app.socketio, mock_app.mongo) == 0
+
+    client.emit('resync_metrics', SUBSCRIPTION)
+    snapshot = client.get_received()[0]['args'][0]
+    assert snapshot['seq'] == 1
+    assert len(snapshot['metrics']) == 3
+    client.disconnect()
@@ -0,0 +1,84 @@
+import json
+import pytest
+from datetime import datetime, timezone
+from flask import Flask
+from flask_login import LoginManager
+from flask_socketio import SocketIO
+from bson import ObjectId
+from mongomock import MongoClient
+from api import metrics
+from api.metrics import init_metrics_module, metric_cache
+from api.storage import MetricStore, TimeSeriesMetricStore, copy_points, create_metric_store
+
+
+def point(name, value, hour):
+    return {'name': name, 'value': value, 'timestamp': datetime(2021, 1, 1, hour, tzinfo=timezone.utc)}
+
+def test_create_metric_store():
+    assert create_metric_store().describe() == {'backend': 'documents', 'collection': 'metrics'}
+    assert create_metric_store('timeseries', granularity='minutes').describe() == {
+        'backend': 'timeseries', 'collection': 'metrics_ts', 'granularity': 'minutes'}
+    with pytest.raises(ValueError):
+        create_metric_store('parquet')
+    with pytest.raises(ValueError):
+        TimeSeriesMetricStore(granularity='days')
+
+def test_timeseries_store_creates_collection():
+    class RecordingDb(dict):
+        def __init__(self):
+            super().__init__(metrics_ts=MongoClient().db.metrics_ts)
+            self.created = []
+
+        def create_collection(self, name, **options):
+            self.created.append((name, options))
+
+    db = RecordingDb()
+    TimeSeriesMetricStore(granularity='minutes').ensure(db)
+    assert db.created == [('metrics_ts', {'timeseries': {'timeField': 'timestamp', 'metaField': 'name', 'granularity': 'minutes'}})]
+    assert 'name_1_timestamp_1' in db['metrics_ts'].index_information()
+
+def test_copy_points_resumes():
+    db = MongoClient().db
+    source, target = MetricStore('metrics'), MetricStore('metrics_copy')
+    source.insert_many(db, [point('cpu', value, value) for value in range(5)])
+    saved = []
+    assert copy_points(db, source, target, batch_size=2, progress=saved.append) == 5
+    assert len(saved) == 3
+
+    # An interrupted run: the first batch was saved, part of the next one was written
+    db.metrics_copy.delete_many({'_id': {'$gt': saved[1]}})
+    assert copy_points(db, source, target, batch_size=2, after=saved[0]) == 1  # The rest was already there
+    assert [doc['_id'] for doc in db.metrics_copy.find().sort('_id')] == [doc['_id'] for doc in db.metrics.find().sort('_id')]
+
+def test_copy_points_rerun_keeps_points_written_to_target():
+    db = MongoClient().db
+    source, target = MetricStore('metrics'), MetricStore('metrics_copy')
+    source.insert_many(db, [point('cpu', value, value) for value in range(3)])
+    saved = []
+    copy_points(db, source, target, batch_size=2, progress=saved.append)
+
+    # Points stored in the source before the switch, then by the app in the target after it
+    source.insert_many(db, [point('cpu', 3, 3)])
+    target.insert_many(db, [point('cpu', value, value) for value in (4, 5)])
+    assert copy_points(db, source, target, batch_size=2, after=saved[-1]) == 1
+    assert sorted(doc['value'] for doc in db.metrics_copy.find()) == [0, 1, 2, 3, 4, 5]
+    # Running it again copies nothing and removes nothing
+    assert copy_points(db, source, target, batch_size=2, after=saved[-1]) == 0
+    assert db.metrics_copy.count_documents({}) == 6
+
+def test_app_uses_configured_store():
+    mongo = MongoClient()
+    app = Flask(__name__)
+    app.config.update(TESTING=True, SECRET_KEY='test_secret_key', METRICS_COLLECTION='points', INGEST_WRITE_BEHIND=False)
+    init_metrics_module(app, mongo, SocketIO(app, cors_allowed_origins='*'), LoginManager(app))
+    metric_cache.clear()
+    try:
+        with app.test_client() as client:
+            client.post('/metrics/log_metrics_batch', json=[{'name': 'cpu', 'value': 4, 'timestamp': '2021-01-01T01:00:00+00:00'}])
+            assert mongo.db.points.count_documents({}) == 1
+            assert mongo.db.metrics.count_documents({}) == 0
+            assert [doc['value'] for doc in metrics.metric_store.find_since(mongo.db, {'cpu': ObjectId('0' * 24)})] == [4]
+            request = {'name': 'cpu', 'startDate': '2021-01-01T01:00:00', 'endDate': '2021-01-01T01:00:00', 'interval': 'hour'}
+            assert json.loads(client.post('/metrics/get_metrics', json=request).data)['metrics'][0]['average_value'] == 4
+    finally:
+        metrics.metric_store = MetricStore()
@@ -0,0 +1,44 @@
+from datetime import datetime, timezone
+from api.subscriptions import SubscriptionIndex, subscription_key, subscription_request
+
+
+WINDOW = subscription_key({'name': 'cpu', 'interval': 'hour', 'startDate': '2021-01-01T00:00:00',
+                           'endDate': '2021-01-01T05:30:00', 'include_zeros': False})
+OPEN = subscription_key({'name': 'cpu', 'interval': 'day', 'startDate': None, 'endDate': None, 'stats': ['max']})
+
+def point(hour, minute=0, name='cpu'):
+    return {'name': name, 'timestamp': datetime(2021, 1, 1, hour, minute, tzinfo=timezone.utc)}
+
+def test_keys_for_point_match_window_buckets():
+    index = SubscriptionIndex()
+    index.subscribe('a', WINDOW)
+    index.subscribe('b', WINDOW)
+    index.subscribe('b', OPEN)
+
+    assert sorted(index.keys_for_point('cpu', point(5, 45)['timestamp'])) == sorted([WINDOW, OPEN])
+    assert index.keys_for_point('cpu', point(6)['timestamp']) == [OPEN]
+    assert index.keys_for_point('mem', point(1)['timestamp']) == []
+    assert index.subscribers(WINDOW) == 2
+    assert subscription_request(OPEN)['stats'] == ['max']
+
+def test_drain_coalesces_marked_buckets():
+    index = SubscriptionIndex()
+    index.subscribe('a', WINDOW)
+    index.mark_points([point(1, 5), point(1, 50), point(3), point(7), point(1, name='mem')])
+
+    assert index.drain() == {WINDOW: (1, {point(1)['timestamp'], point(3)['timestamp']})}
+    assert index.drain() == {}
+    assert index.sequence(WINDOW) == 1
+
+def test_drop_forgets_client():
+    index = SubscriptionIndex()
+    index.subscribe('a', WINDOW)
+    index.subscribe('b', WINDOW)
+    assert index.unsubscribe('a', OPEN) is None
+
+    assert len(index.drop('a')) == 1
+    assert index.subscribers(WINDOW) == 1
+    index.drop('b')
+    index.mark_points([point(1)])
+    assert len(index) == 0
+    assert index.drain() == {}
@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import DatePicker from 'react-datepicker';
 import 'react-datepicker/dist/react-datepicker.css';
 import { Line } from 'react-chartjs-2';
@@ -9,6 +9,16 @@ import { Chart, CategoryScale, LinearScale, LineController, LineElement, PointEl
 
 Chart.register(CategoryScale, LinearScale, LineController, LineElement, PointElement);
 
+// The chart cannot show more points than it has pixels; the server downsamples above this
+const MAX_CHART_POINTS = 500;
+
+// Apply changed buckets to the series, keeping it ordered by bucket
+const mergeBuckets = (current, changed) => {
+    const byId = new Map(current.map(d => [d._id, d]));
+    changed.forEach(d => byId.set(d._id, d));
+    return Array.from(byId.values()).sort((a, b) => (a._id < b._id ? -1 : a._id > b._id ? 1 : 0));
+};
+
 const Metrics = () => {
     const [startDate, setStartDate] = useState(null);
     const [endDate, setEndDate] = useState(null);
@@ -22,10 +32,8 @@ const Metrics = () => {
     const [logMetricValue, setLogMetricValue] = useState('');
     const [socketError, setSocketError] = useState('');
     const [logMetricError, setLogMetricError] = useState('');
-
-    const cache_key = (name, startDate, endDate, interval, includeZeros) => {
-        return `${name}_${startDate ? startDate.toISOString() : 'null'}_${endDate ? endDate.toISOString() : 'null'}_${interval}_${includeZeros}`;
-    };
+    // Sequence number of the last snapshot or delta applied; null while a snapshot is awaited
+    const lastSeq = useRef(null);
 
     useEffect(() => {
         const token = localStorage.getItem('token');
@@ -34,36 +42,27 @@ const Metrics = () => {
         socket.on('connect', () => {
             console.log('Connected to WebSocket');
             setSocketError('');
-            requestMetrics(socket);
+            lastSeq.current = null;
+            socket.emit('subscribe_metrics', metricsRequest());
         });
 
-        socket.on('metrics_data', (data) => {
-            setMetricsData(data);
+        socket.on('metrics_snapshot', (snapshot) => {
+            lastSeq.current = snapshot.seq;
+            setMetricsData(snapshot.metrics);
         });
 
-        socket.on('metrics_update', (data) => {
-            if (data.key === cache_key(selectedMetricName, startDate, endDate, interval, addZeros)) {
-                setMetricsData(data.metrics);
+        // Coalesced changes for this subscription; a skipped sequence number means we missed one
+        socket.on('metrics_delta', (delta) => {
+            if (lastSeq.current === null || delta.seq <= lastSeq.current) {
+                return;
             }
-        });
-
-        socket.on('metrics_update', (data) => {
-            if (data.metrics) {
-                if (data.key === cache_key(selectedMetricName, startDate, endDate, interval, addZeros)) {
-                    setMetricsData(data.metrics);
-                }
-            } else if (data.name && data.value && data.timestamp) {
-                const newMetricTimestamp = new Date(data.timestamp);
-                const isWithinRange = (!startDate || newMetricTimestamp >= startDate) &&
-                                      (!endDate || newMetricTimestamp <= endDate) &&
-                                      data.name === selectedMetricName;
-
-                if (isWithinRange) {
-                    requestMetrics(socket);
-                } else {
-                    fetchMetricNames();
-                }
+            if (delta.seq !== lastSeq.current + 1) {
+                lastSeq.current = null;
+                socket.emit('resync_metrics', metricsRequest());
+                return;
             }
+            lastSeq.current = delta.seq;
+            setMetricsData(current => (delta.full ? delta.metrics : mergeBuckets(current, delta.metrics)));
         });
 
         socket.on('connect_error', (err) => {
@@ -71,20 +70,22 @@ const Metrics = () => {
             setSocketError('WebSocket connection error');
         });
 
-        fetchMetricNames();
-
         return () => socket.disconnect();
     }, [selectedMetricName, startDate, endDate, interval, addZeros]);
 
-    const requestMetrics = (socket) => {
-        socket.emit('request_metrics', {
-            name: selectedMetricName,
-            startDate: startDate ? startDate.toISOString() : null,
-            endDate: endDate ? endDate.toISOString() : null,
-            interval: interval,
-            include_zeros: addZeros
-        });
-    };
+    // Names come from the server's metric catalog; they are not refetched on every reconnect
+    useEffect(() => {
+        fetchMetricNames();
+    }, []);
+
+    const metricsRequest = () => ({
+        name: selectedMetricName,
+        startDate: startDate ? startDate.toISOString() : null,
+        endDate: endDate ? endDate.toISOString() : null,
+        interval: interval,
+        include_zeros: addZeros,
+        max_points: MAX_CHART_POINTS
+    });
 
     const fetchMetricNames = async () => {
         try {